@@ -1,57 +1,315 @@
-﻿import os
-import patoolib
-import fnmatch
-from typing import Dict, Any, List
-
-def extract_archive(archive_path: str, output_dir: str) -> None:
-    """Распаковывает архив в указанную директорию"""
-    try:
-        patoolib.extract_archive(archive_path, outdir=output_dir)
-    except Exception as e:
-        raise Exception(f"Ошибка распаковки архива: {e}")
-
-def scan_archive_content(directory: str) -> Dict[str, Any]:
-    """Сканирует содержимое распакованного архива"""
-    content = {
-        'files': [],
-        'metadata_content': {}
-    }
-    
-    for root, dirs, files in os.walk(directory):
-        for name in files + dirs:
-            full_path = os.path.join(root, name)
-            rel_path = os.path.relpath(full_path, directory)
-            
-            item_info = {
-                'name': rel_path,
-                'type': 'directory' if os.path.isdir(full_path) else 'file',
-                'size': os.path.getsize(full_path) if os.path.isfile(full_path) else None
-            }
-            
-            content['files'].append(item_info)
-            
-            # Метаданные из DIZ/README
-            if name.lower() in ['file_id.diz', 'readme.txt', 'readme.md', '*.nfo'] or \
-               fnmatch.fnmatch(name.lower(), 'read*me*'):
-                try:
-                    # Пытаемся прочитать в разных кодировках
-                    for encoding in ['utf-8', 'cp1251', 'cp866']:
-                        try:
-                            with open(full_path, 'r', encoding=encoding, errors='ignore') as f:
-                                content['metadata_content'][name] = f.read(2000)
-                                break
-                        except:
-                            continue
-                except:
-                    pass
-    
-    return content
-
-def find_file_by_pattern(files_list: list, pattern: str) -> str:
-    """
-    Возвращает первый файл, подходящий под шаблон (wildcard)
-    """
-    for file_info in files_list:
-        if file_info['type'] == 'file' and fnmatch.fnmatch(file_info['name'], pattern):
-            return file_info['name']
-    return None
+﻿import io
+import os
+import shutil
+import zipfile
+import patoolib
+import fnmatch
+import logging
+from typing import Dict, Any, List
+from tracing import span
+from formats.sniff import SNIFF_SIZE, sniff_bytes, remember_type, effective_type
+from formats.registry import registry
+from formats.ocr_utils import set_language_hint
+from config import SNIFF_MAX_MEMBERS, RAR_SNIFF_MAX_MEMBERS, NESTED_ARCHIVE_DEPTH, NESTED_ARCHIVE_MAX_BYTES, NESTED_ARCHIVE_MAX_MEMBERS
+
+logger = logging.getLogger(__name__)
+
+try:
+    import rarfile
+except ImportError:
+    rarfile = None
+
+def extract_archive(archive_path: str, output_dir: str) -> None:
+    """Распаковывает архив в указанную директорию"""
+    try:
+        with span('archive.unpack', bytes=os.path.getsize(archive_path)):
+            patoolib.extract_archive(archive_path, outdir=output_dir)
+    except Exception as e:
+        raise Exception(f"Ошибка распаковки архива: {e}")
+
+def scan_archive_content(directory: str) -> Dict[str, Any]:
+    """Сканирует содержимое распакованного архива"""
+    content = {
+        'files': [],
+        'metadata_content': {}
+    }
+    
+    for root, dirs, files in os.walk(directory):
+        for name in files + dirs:
+            full_path = os.path.join(root, name)
+            rel_path = os.path.relpath(full_path, directory)
+            
+            item_info = {
+                'name': rel_path,
+                'type': 'directory' if os.path.isdir(full_path) else 'file',
+                'size': os.path.getsize(full_path) if os.path.isfile(full_path) else None
+            }
+            
+            content['files'].append(item_info)
+            
+            # Метаданные из DIZ/README
+            if name.lower() in ['file_id.diz', 'readme.txt', 'readme.md', '*.nfo'] or \
+               fnmatch.fnmatch(name.lower(), 'read*me*'):
+                try:
+                    # Пытаемся прочитать в разных кодировках
+                    for encoding in ['utf-8', 'cp1251', 'cp866']:
+                        try:
+                            with open(full_path, 'r', encoding=encoding, errors='ignore') as f:
+                                content['metadata_content'][name] = f.read(2000)
+                                break
+                        except:
+                            continue
+                except:
+                    pass
+    
+    return content
+
+def find_file_by_pattern(files_list: list, pattern: str) -> str:
+    """
+    Возвращает первый файл, подходящий под шаблон (wildcard)
+    """
+    for file_info in files_list:
+        if file_info['type'] == 'file' and fnmatch.fnmatch(file_info['name'], pattern):
+            return file_info['name']
+    return None
+
+
+def _zip_member_name(info: zipfile.ZipInfo) -> str:
+    """
+    Имя файла внутри ZIP. Имена без флага UTF-8 zipfile декодирует как cp437,
+    а русские архиваторы под Windows пишут их в cp866
+    """
+    if info.flag_bits & 0x800:
+        return info.filename
+    try:
+        return info.filename.encode('cp437').decode('cp866')
+    except UnicodeError:
+        return info.filename
+
+
+# Расширения, которые в больших архивах не проверяются по содержимому (страницы-сканы и т.п.)
+SNIFF_SKIP_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.tif', '.tiff', '.bmp', '.webp']
+
+# Вложенные архивы, которые раскрываются в памяти (без записи на диск)
+NESTED_ARCHIVE_TYPES = ['.zip', '.rar']
+
+
+class ArchiveReader:
+    """
+    Доступ к архиву без полной распаковки: список файлов строится по оглавлению
+    (ZIP, RAR при наличии модуля rarfile), а отдельные файлы извлекаются по требованию.
+    Для остальных форматов архив целиком распаковывается через patool.
+    Вложенные ZIP и RAR раскрываются в памяти (expand_nested), их файлы получают
+    пути вида 'внешний.zip/внутренний.pdf' и извлекаются так же, как обычные.
+    """
+
+    def __init__(self, archive_path: str, work_dir: str):
+        self.archive_path = archive_path
+        self.work_dir = work_dir
+        self._archive = None
+        self._members = {}
+        self._extracted = 0
+        self._nested = []
+        self._nested_bytes = 0
+        self._nested_members = 0
+
+        if zipfile.is_zipfile(archive_path):
+            self._archive = zipfile.ZipFile(archive_path, 'r')
+            self.backend = 'zip'
+        elif rarfile is not None and rarfile.is_rarfile(archive_path):
+            self._archive = rarfile.RarFile(archive_path, 'r')
+            self.backend = 'rar'
+        else:
+            self.backend = 'patool'
+        # Имя архива подсказывает язык OCR для извлеченных файлов
+        set_language_hint(work_dir, os.path.splitext(os.path.basename(archive_path))[0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self) -> None:
+        set_language_hint(self.work_dir, None)
+        for archive in reversed(self._nested):
+            archive.close()
+        self._nested = []
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+    def list_files(self) -> List[Dict[str, Any]]:
+        """Возвращает список файлов архива; 'path' заполняется после извлечения"""
+        if self.backend == 'patool':
+            return self._list_extracted()
+        return self._list_members(self._archive, self.backend)
+
+    def _list_members(self, archive, backend: str, prefix: str = '') -> List[Dict[str, Any]]:
+        """Файлы из оглавления ZIP или RAR; prefix - путь вложенного архива во внешнем"""
+        files_list = []
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            member = prefix + (_zip_member_name(info) if backend == 'zip' else info.filename)
+            self._members[member] = (archive, info)
+            files_list.append({
+                'name': os.path.basename(member.rstrip('/')),
+                'member': member,
+                'path': None,
+                'type': 'file',
+                'size': info.file_size
+            })
+        return files_list
+
+    def _list_extracted(self) -> List[Dict[str, Any]]:
+        """Полная распаковка для форматов без поддержки чтения оглавления"""
+        extract_archive(self.archive_path, self.work_dir)
+        files_list = []
+        with span('archive.walk') as current:
+            for root, _, files in os.walk(self.work_dir):
+                for f in files:
+                    file_path = os.path.join(root, f)
+                    files_list.append({
+                        'name': f,
+                        'member': os.path.relpath(file_path, self.work_dir),
+                        'path': file_path,
+                        'type': 'file',
+                        'size': os.path.getsize(file_path)
+                    })
+            current.set(files=len(files_list))
+        return files_list
+
+    def open_member(self, file_info: Dict[str, Any]):
+        """Открывает файл архива как поток без записи на диск"""
+        if file_info.get('path'):
+            return open(file_info['path'], 'rb')
+        archive, info = self._members[file_info['member']]
+        return archive.open(info)
+
+    def read_member(self, file_info: Dict[str, Any], size: int = -1) -> bytes:
+        """Читает файл архива (или его начало) в память"""
+        with self.open_member(file_info) as f:
+            return f.read(size)
+
+    def _is_rar_member(self, file_info: Dict[str, Any]) -> bool:
+        """Файл читается из RAR (внешнего или вложенного), а не с диска"""
+        if file_info.get('path') or rarfile is None:
+            return False
+        archive, _ = self._members[file_info['member']]
+        return isinstance(archive, rarfile.RarFile)
+
+    def sniff_members(self, files_list: List[Dict[str, Any]]) -> None:
+        """
+        Определяет тип файлов по первым байтам (из потока архива, без извлечения)
+        и записывает его в file_info['kind']. В больших архивах проверяются только
+        документы и файлы без расширения или с незнакомым расширением.
+        Каждое чтение файла RAR запускает unrar (в solid-архиве - с распаковкой с начала),
+        поэтому в RAR проверяются только файлы без расширения или с незнакомым,
+        не больше RAR_SNIFF_MAX_MEMBERS
+        """
+        check_all = len(files_list) <= SNIFF_MAX_MEMBERS
+        known_extensions = set(registry.extensions())
+        rar_sniffed = 0
+        for file_info in files_list:
+            if 'kind' in file_info:
+                continue
+            ext = os.path.splitext(file_info['name'])[1].lower()
+            if not check_all and ext in SNIFF_SKIP_EXTENSIONS:
+                continue
+            if self._is_rar_member(file_info):
+                if ext in known_extensions or rar_sniffed >= RAR_SNIFF_MAX_MEMBERS:
+                    continue
+                rar_sniffed += 1
+            try:
+                file_info['kind'] = sniff_bytes(self.read_member(file_info, SNIFF_SIZE))
+            except Exception as e:
+                logger.debug(f"Не удалось определить тип {file_info['name']}: {e}")
+                file_info['kind'] = None
+
+    def _open_nested(self, file_info: Dict[str, Any], kind: str):
+        """
+        Открывает вложенный архив: с диска, если он уже там, иначе из памяти.
+        None, если архив не помещается в оставшийся лимит NESTED_ARCHIVE_MAX_BYTES
+        """
+        if kind == '.rar' and rarfile is None:
+            return None
+
+        source = file_info.get('path')
+        if source is None:
+            remaining = NESTED_ARCHIVE_MAX_BYTES - self._nested_bytes
+            # Размер из оглавления может быть занижен, поэтому чтение тоже ограничено лимитом
+            data = None
+            if (file_info.get('size') or 0) <= remaining:
+                data = self.read_member(file_info, remaining + 1)
+            if data is None or len(data) > remaining:
+                logger.warning(f"Вложенный архив {file_info['member']} не раскрыт: превышен лимит объема")
+                return None
+            self._nested_bytes += len(data)
+            source = io.BytesIO(data)
+
+        if kind == '.zip':
+            return zipfile.ZipFile(source, 'r'), 'zip'
+        return rarfile.RarFile(source, 'r'), 'rar'
+
+    def expand_nested(self, files_list: List[Dict[str, Any]], depth: int = NESTED_ARCHIVE_DEPTH) -> None:
+        """
+        Раскрывает вложенные ZIP и RAR не глубже depth уровней: их файлы добавляются
+        в files_list с путями вида 'внешний.zip/внутренний.pdf', а сам архив получает
+        type 'archive' и число файлов в 'entries'. Общий объем вложенных архивов и число
+        их файлов ограничены (защита от zip-бомб)
+        """
+        if depth <= 0:
+            return
+        for file_info in list(files_list):
+            if file_info['type'] != 'file':
+                continue
+            kind = effective_type(file_info['name'], file_info.get('kind'))
+            # Файл .zip, содержимое которого не похоже на архив, не открывается
+            if kind not in NESTED_ARCHIVE_TYPES or file_info.get('kind') not in (None, kind):
+                continue
+            if self._nested_members >= NESTED_ARCHIVE_MAX_MEMBERS:
+                logger.warning(f"Вложенные архивы раскрыты не все: больше {NESTED_ARCHIVE_MAX_MEMBERS} файлов")
+                return
+
+            try:
+                with span('archive.nested', bytes=file_info.get('size') or 0) as current:
+                    opened = self._open_nested(file_info, kind)
+                    if opened is None:
+                        continue
+                    archive, backend = opened
+                    self._nested.append(archive)
+                    inner = self._list_members(archive, backend, file_info['member'].replace('\\', '/') + '/')
+                    current.set(files=len(inner))
+            except Exception as e:
+                logger.warning(f"Не удалось раскрыть вложенный архив {file_info['member']}: {e}")
+                continue
+
+            inner = inner[:NESTED_ARCHIVE_MAX_MEMBERS - self._nested_members]
+            self._nested_members += len(inner)
+            file_info['type'] = 'archive'
+            file_info['entries'] = len(inner)
+            self.sniff_members(inner)
+            self.expand_nested(inner, depth - 1)
+            files_list.extend(inner)
+
+    def extract_member(self, file_info: Dict[str, Any]) -> str:
+        """
+        Извлекает один файл архива во временный каталог и возвращает путь к нему.
+        Повторный вызов для того же файла возвращает уже извлеченную копию
+        """
+        if file_info.get('path'):
+            return file_info['path']
+
+        # Имя в каталоге не зависит от путей внутри архива (защита от '../'),
+        # но сохраняет расширение для выбора обработчика
+        self._extracted += 1
+        target = os.path.join(self.work_dir, f"{self._extracted:04d}_{file_info['name']}")
+        with span('archive.extract', bytes=file_info.get('size') or 0, member=file_info['member']):
+            with self.open_member(file_info) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+
+        file_info['path'] = target
+        if 'kind' in file_info:
+            remember_type(target, file_info['kind'])
+        return target
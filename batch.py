@@ -0,0 +1,182 @@
+import os
+import glob
+import time
+import fnmatch
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Any, List, Optional, Callable, Iterator
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Расширения, которые считаются архивами при обходе каталога
+ARCHIVE_EXTENSIONS = ['.zip', '.rar', '.7z', '.tar', '.gz', '.tgz', '.bz2', '.xz']
+
+
+def is_archive_name(name: str, pattern: Optional[str] = None) -> bool:
+    """Подходит ли имя файла под шаблон pattern (по умолчанию - под ARCHIVE_EXTENSIONS)"""
+    if pattern:
+        return fnmatch.fnmatch(name.lower(), pattern.lower())
+    return os.path.splitext(name)[1].lower() in ARCHIVE_EXTENSIONS
+
+
+def collect_archives(directory: Optional[str] = None, pattern: Optional[str] = None) -> List[str]:
+    """
+    Собирает список архивов для пакетной обработки.
+    С directory обходит дерево каталогов и фильтрует имена по шаблону pattern
+    (по умолчанию - по ARCHIVE_EXTENSIONS); без directory pattern трактуется как glob-путь.
+    """
+    archives = []
+
+    if directory:
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if is_archive_name(name, pattern):
+                    archives.append(os.path.join(root, name))
+    elif pattern:
+        archives = [p for p in glob.glob(pattern, recursive=True) if os.path.isfile(p)]
+
+    return sorted(archives)
+
+
+def _init_worker(llm_slots, initializer, initargs, trace=False, profile=False) -> None:
+    """Инициализация процесса-обработчика: общий семафор для запросов к LLM и трассировка"""
+    import llm_client
+    llm_client.set_request_slots(llm_slots)
+    tracing.configure_tracing(trace, profile)
+    if initializer:
+        initializer(*initargs)
+
+
+def _run_one(func: Callable, archive_path: str, args: tuple = ()) -> Dict[str, Any]:
+    """Выполняет этап обработки одного архива и возвращает результат со статистикой по этапам"""
+    stats = {}
+    start = time.perf_counter()
+    result = None
+    error = None
+    try:
+        with tracing.task_profile(), tracing.span('archive', path=os.path.basename(archive_path)):
+            result = func(archive_path, *args, stats=stats)
+    except Exception as e:
+        logger.error(f"Ошибка при обработке архива {archive_path}: {e}")
+        error = str(e)
+
+    return {
+        'path': archive_path,
+        'result': result,
+        'error': error,
+        'elapsed': time.perf_counter() - start,
+        'stages': stats,
+        # Интервалы и профиль процесса-обработчика передаются в основной процесс
+        'trace': tracing.drain() if tracing.is_tracing() else None
+    }
+
+
+def iter_pool(func: Callable, tasks: List[tuple], workers: Optional[int] = None,
+              llm_slots: Optional[int] = None, initializer: Optional[Callable] = None,
+              initargs: tuple = ()) -> Iterator[Dict[str, Any]]:
+    """
+    Выполняет func(archive_path, *args, stats=...) для задач (archive_path, args)
+    в пуле процессов и выдает результаты по мере готовности.
+    Число одновременных запросов к LLM во всех процессах ограничивается llm_slots,
+    initializer(*initargs) вызывается в каждом процессе-обработчике
+    (при workers == 1 - один раз в текущем процессе)
+    """
+    workers = workers or os.cpu_count() or 1
+
+    if workers == 1:
+        if initializer:
+            initializer(*initargs)
+        for archive_path, args in tasks:
+            result = _run_one(func, archive_path, args)
+            tracing.merge(result.pop('trace'))
+            yield result
+        return
+
+    llm_semaphore = multiprocessing.BoundedSemaphore(llm_slots) if llm_slots else None
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(llm_semaphore, initializer, initargs,
+                                       tracing.is_tracing(), tracing.is_profiling())) as pool:
+        futures = {pool.submit(_run_one, func, archive_path, args): archive_path
+                   for archive_path, args in tasks}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+                tracing.merge(result.pop('trace'))
+                yield result
+            except Exception as e:
+                logger.error(f"Процесс-обработчик завершился с ошибкой для {futures[future]}: {e}")
+                yield {'path': futures[future], 'result': None, 'error': str(e),
+                       'elapsed': 0.0, 'stages': {}}
+
+
+def run_batch(archive_paths: List[str], analyze: Callable, workers: Optional[int] = None,
+              llm_slots: Optional[int] = None, on_result: Optional[Callable] = None,
+              initializer: Optional[Callable] = None, initargs: tuple = ()) -> Dict[str, Any]:
+    """
+    Обрабатывает архивы пулом процессов.
+    analyze(archive_path, stats=...) возвращает предложенное имя или None и дописывает
+    время этапов в stats. on_result вызывается в основном процессе
+    для каждого готового результата (например, для переименования).
+    """
+    results = []
+    start = time.perf_counter()
+
+    tasks = [(archive_path, ()) for archive_path in archive_paths]
+    for result in iter_pool(analyze, tasks, workers, llm_slots, initializer, initargs):
+        results.append(result)
+        if on_result:
+            on_result(result)
+
+    return summarize_batch(results, time.perf_counter() - start)
+
+
+def merge_stage_results(first: Dict[str, Any], second: Dict[str, Any]) -> Dict[str, Any]:
+    """Объединяет результаты двух этапов обработки одного архива"""
+    stages = dict(first['stages'])
+    for stage, seconds in second['stages'].items():
+        stages[stage] = stages.get(stage, 0.0) + seconds
+    return {
+        'path': first['path'],
+        'result': second['result'],
+        'error': second['error'] or first['error'],
+        'elapsed': first['elapsed'] + second['elapsed'],
+        'stages': stages
+    }
+
+
+def summarize_batch(results: List[Dict[str, Any]], wall_time: float) -> Dict[str, Any]:
+    """Сводная статистика пакетной обработки"""
+    stages = {}
+    for result in results:
+        for stage, seconds in result['stages'].items():
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    total = len(results)
+    return {
+        'total': total,
+        'named': sum(1 for r in results if r['result']),
+        'failed': sum(1 for r in results if r['error']),
+        'wall_time': wall_time,
+        'archives_per_sec': total / wall_time if wall_time > 0 else 0.0,
+        'stages': {
+            stage: {'total': seconds, 'per_archive': seconds / total}
+            for stage, seconds in sorted(stages.items())
+        }
+    }
+
+
+def format_summary(summary: Dict[str, Any]) -> str:
+    """Форматирует сводку пакетной обработки для вывода в консоль"""
+    lines = [
+        f"Обработано архивов: {summary['total']} "
+        f"(имя предложено: {summary['named']}, ошибок: {summary['failed']})",
+        f"Общее время: {summary['wall_time']:.2f} с, "
+        f"производительность: {summary['archives_per_sec']:.2f} архивов/с",
+    ]
+    if summary['stages']:
+        lines.append("Время по этапам (суммарно по всем процессам / в среднем на архив):")
+        for stage, timing in summary['stages'].items():
+            lines.append(f"  {stage}: {timing['total']:.2f} с / {timing['per_archive']:.3f} с")
+    return "\n".join(lines)
@@ -0,0 +1,642 @@
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import base64
+import random
+import shutil
+import struct
+import logging
+import zipfile
+import platform
+import argparse
+import importlib.util
+import difflib
+import tempfile
+import statistics
+import subprocess
+import multiprocessing
+from typing import Dict, Any, List, Optional
+from config import OCR_WORKERS
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Наборы параметров извлечения текста, которые замеряются для каждого файла
+PARAMETER_SETS = [
+    {'type': 'first_chars', 'amount': 500},
+    {'type': 'first_chars', 'amount': 5000},
+    {'type': 'first_pages', 'amount': 3},
+]
+
+# Варианты подготовки изображений к OCR (ocr_preprocess): скорость против качества распознавания
+PREPROCESS_VARIANTS = {
+    'off': {'enabled': False},
+    'default': {},
+    'no_crop': {'crop_margins': False},
+    'binarize': {'binarize': True},
+}
+
+# Расширения изображений для набора образцов OCR
+SAMPLE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tiff', '.tif', '.bmp')
+
+_WORDS = ("архив книга глава страница история автор издание том часть текст "
+          "library archive chapter volume edition history author page science data").split()
+
+
+# ---------------------------------------------------------------------------
+# Генерация синтетического корпуса
+# ---------------------------------------------------------------------------
+
+def _sentence(rng: random.Random, words: int = 12, ascii_only: bool = False) -> str:
+    vocabulary = [w for w in _WORDS if w.isascii()] if ascii_only else _WORDS
+    text = ' '.join(rng.choice(vocabulary) for _ in range(words))
+    return text.capitalize() + '.'
+
+
+def _paragraphs(rng: random.Random, count: int, ascii_only: bool = False) -> List[str]:
+    return [' '.join(_sentence(rng, ascii_only=ascii_only) for _ in range(5)) for _ in range(count)]
+
+
+def _scan_rows(width: int, height: int, rng: random.Random) -> List[bytes]:
+    """Строки пикселей в оттенках серого: светлый фон с темными полосами, похожими на строки текста"""
+    text_rows = [bytes(255 if rng.random() < 0.4 else 25 for _ in range(width)) for _ in range(8)]
+    blank = b'\xff' * width
+    return [text_rows[(y // 12) % 8] if (y // 12) % 3 == 2 else blank for y in range(height)]
+
+
+def _png_bytes(width: int, height: int, rng: random.Random) -> bytes:
+    """PNG в оттенках серого, имитирующий отсканированную страницу"""
+    rows = [b'\x00' + row for row in _scan_rows(width, height, rng)]
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+            + chunk(b'IDAT', zlib.compress(b''.join(rows), 6)) + chunk(b'IEND', b''))
+
+
+def _pdf_bytes(pages: List[Dict[str, Any]], title: str, author: str) -> bytes:
+    """
+    Минимальный PDF. Страница - {'text': [строки]} (текстовый слой)
+    или {'image': (ширина, высота, байты в оттенках серого)} (скан без текста)
+    """
+    objects = []
+
+    def add(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    def stream(dictionary: str, data: bytes) -> bytes:
+        return f"<< {dictionary} /Length {len(data)} >>\nstream\n".encode() + data + b"\nendstream"
+
+    catalog = add(b'')
+    pages_obj = add(b'')
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    info = add(f"<< /Title ({title}) /Author ({author}) /Producer (benchmark.py) >>".encode('latin-1'))
+
+    kids = []
+    for page in pages:
+        if 'text' in page:
+            lines = [line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') for line in page['text']]
+            content = "BT /F1 11 Tf 14 TL 50 770 Td " + " ".join(f"({line}) Tj T*" for line in lines) + " ET"
+            content_obj = add(stream('', content.encode('latin-1')))
+            resources = f"<< /Font << /F1 {font} 0 R >> >>"
+        else:
+            width, height, pixels = page['image']
+            image_obj = add(stream(f"/Type /XObject /Subtype /Image /Width {width} /Height {height} "
+                                   f"/ColorSpace /DeviceGray /BitsPerComponent 8 /Filter /FlateDecode",
+                                   zlib.compress(pixels, 6)))
+            content_obj = add(stream('', b"q 612 0 0 792 0 0 cm /Im1 Do Q"))
+            resources = f"<< /XObject << /Im1 {image_obj} 0 R >> >>"
+        kids.append(add(f"<< /Type /Page /Parent {pages_obj} 0 R /MediaBox [0 0 612 792] "
+                        f"/Contents {content_obj} 0 R /Resources {resources} >>".encode()))
+
+    objects[catalog - 1] = f"<< /Type /Catalog /Pages {pages_obj} 0 R >>".encode()
+    objects[pages_obj - 1] = (f"<< /Type /Pages /Kids [{' '.join(f'{k} 0 R' for k in kids)}] "
+                              f"/Count {len(kids)} >>").encode()
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += b''.join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    out += (f"trailer\n<< /Size {len(objects) + 1} /Root {catalog} 0 R /Info {info} 0 R >>\n"
+            f"startxref\n{xref}\n%%EOF\n").encode()
+    return bytes(out)
+
+
+def _scan_pixels(width: int, height: int, rng: random.Random) -> bytes:
+    return b''.join(_scan_rows(width, height, rng))
+
+
+def _write_epub(path: str, rng: random.Random, chapters: int) -> None:
+    """EPUB с длинным spine; порядок манифеста намеренно не совпадает с порядком чтения"""
+    chapter_ids = [f"ch{i:04d}" for i in range(chapters)]
+    manifest_order = chapter_ids[:]
+    rng.shuffle(manifest_order)
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as epub:
+        epub.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip')
+        epub.writestr('META-INF/container.xml', """<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>""")
+        items = "\n".join(f'    <item id="{cid}" href="text/{cid}.xhtml" media-type="application/xhtml+xml"/>'
+                          for cid in manifest_order)
+        spine = "\n".join(f'    <itemref idref="{cid}"/>' for cid in chapter_ids)
+        epub.writestr('OEBPS/content.opf', f"""<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:title>Синтетическая книга EPUB</dc:title>
+    <dc:creator>Иван Тестов</dc:creator>
+    <dc:language>ru</dc:language>
+    <dc:date>2020</dc:date>
+    <dc:identifier id="id">bench-epub</dc:identifier>
+  </metadata>
+  <manifest>
+{items}
+  </manifest>
+  <spine>
+{spine}
+  </spine>
+</package>""")
+        for number, cid in enumerate(chapter_ids, 1):
+            body = "\n".join(f"<p>{p}</p>" for p in _paragraphs(rng, 20))
+            epub.writestr(f'OEBPS/text/{cid}.xhtml', f"""<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Глава {number}</title></head>
+<body><h1>Глава {number}</h1>
+{body}
+</body></html>""")
+
+
+def _write_fb2(path: str, rng: random.Random, paragraphs: int, cover_bytes: int) -> None:
+    """FB2 на несколько мегабайт с обложкой в base64 в конце файла"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("""<?xml version="1.0" encoding="utf-8"?>
+<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0" xmlns:l="http://www.w3.org/1999/xlink">
+<description><title-info>
+<genre>sf</genre>
+<author><first-name>Петр</first-name><last-name>Синтетический</last-name></author>
+<book-title>Синтетическая книга FB2</book-title>
+<annotation><p>Аннотация синтетической книги для замеров скорости.</p></annotation>
+<date>2019</date><lang>ru</lang>
+</title-info></description>
+<body><title><p>Синтетическая книга FB2</p></title>
+""")
+        for section in range(0, paragraphs, 50):
+            f.write(f"<section><title><p>Глава {section // 50 + 1}</p></title>\n")
+            for p in _paragraphs(rng, min(50, paragraphs - section)):
+                f.write(f"<p>{p}</p>\n")
+            f.write("</section>\n")
+        f.write("</body>\n")
+        cover = base64.b64encode(rng.randbytes(cover_bytes)).decode()
+        f.write(f'<binary id="cover.jpg" content-type="image/jpeg">{cover}</binary>\n</FictionBook>\n')
+
+
+def _write_docx(path: str, rng: random.Random, paragraphs: int, table_rows: int) -> None:
+    """DOCX с большим числом абзацев и таблицей"""
+    def run(text):
+        return f'<w:p><w:r><w:t xml:space="preserve">{text}</w:t></w:r></w:p>'
+
+    body = [run(p) for p in _paragraphs(rng, paragraphs)]
+    rows = []
+    for row in range(table_rows):
+        cells = "".join(f"<w:tc>{run(f'{row}:{col} ' + rng.choice(_WORDS))}</w:tc>" for col in range(4))
+        rows.append(f"<w:tr>{cells}</w:tr>")
+    body.append(f"<w:tbl>{''.join(rows)}</w:tbl>")
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr('[Content_Types].xml', """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+<Override PartName="/docProps/core.xml" ContentType="application/vnd.openxmlformats-package.core-properties+xml"/>
+</Types>""")
+        docx.writestr('_rels/.rels', """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/package/2006/relationships/metadata/core-properties" Target="docProps/core.xml"/>
+</Relationships>""")
+        docx.writestr('docProps/core.xml', """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<cp:coreProperties xmlns:cp="http://schemas.openxmlformats.org/package/2006/metadata/core-properties" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:title>Синтетический документ DOCX</dc:title><dc:creator>Анна Замерова</dc:creator>
+</cp:coreProperties>""")
+        docx.writestr('word/document.xml', f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>
+{''.join(body)}
+</w:body></w:document>""")
+
+
+def generate_corpus(out_dir: str, scale: int = 1, seed: int = 0) -> Dict[str, List[str]]:
+    """
+    Создает детерминированный корпус для замеров: документы всех поддерживаемых форматов
+    и архивы с ними. Возвращает {'documents': [...], 'archives': [...], 'scans': [...]}
+    """
+    rng = random.Random(seed)
+    docs_dir = os.path.join(out_dir, 'documents')
+    archives_dir = os.path.join(out_dir, 'archives')
+    os.makedirs(docs_dir, exist_ok=True)
+    os.makedirs(archives_dir, exist_ok=True)
+
+    def doc(name):
+        return os.path.join(docs_dir, name)
+
+    text_pages = [{'text': [_sentence(rng, ascii_only=True) for _ in range(45)]} for _ in range(60 * scale)]
+    with open(doc('text_layer.pdf'), 'wb') as f:
+        f.write(_pdf_bytes(text_pages, 'Synthetic Text PDF', 'Benchmark Author'))
+
+    scan_pages = [{'image': (850, 1100, _scan_pixels(850, 1100, rng))} for _ in range(8 * scale)]
+    with open(doc('scanned.pdf'), 'wb') as f:
+        f.write(_pdf_bytes(scan_pages, 'Synthetic Scanned PDF', 'Benchmark Author'))
+
+    _write_epub(doc('large_spine.epub'), rng, chapters=150 * scale)
+    _write_fb2(doc('large.fb2'), rng, paragraphs=4000 * scale, cover_bytes=1024 * 1024)
+    _write_docx(doc('big_table.docx'), rng, paragraphs=300 * scale, table_rows=2000 * scale)
+
+    with open(doc('plain.txt'), 'w', encoding='utf-8') as f:
+        f.write("\n".join(_paragraphs(rng, 3000 * scale)))
+
+    scans = []
+    for page in range(1, 11 * scale):
+        scans.append(doc(f'page_{page:04d}.png'))
+        with open(scans[-1], 'wb') as f:
+            f.write(_png_bytes(1275, 1650, rng))
+
+    documents = sorted(os.path.join(docs_dir, name) for name in os.listdir(docs_dir)
+                       if not name.startswith('page_'))
+    documents.append(scans[0])
+
+    archive_specs = {
+        'text_pdf.zip': [doc('text_layer.pdf'), doc('plain.txt')],
+        'scanned_pdf.zip': [doc('scanned.pdf')],
+        'epub.zip': [doc('large_spine.epub')],
+        'fb2.zip': [doc('large.fb2')],
+        'docx.zip': [doc('big_table.docx')],
+        'scans.zip': scans,
+    }
+    archives = []
+    for name, members in archive_specs.items():
+        archives.append(os.path.join(archives_dir, name))
+        with zipfile.ZipFile(archives[-1], 'w', zipfile.ZIP_DEFLATED) as archive:
+            for member in members:
+                archive.write(member, os.path.join('book', os.path.basename(member)))
+
+    # RAR создается, только если установлен консольный rar
+    if shutil.which('rar'):
+        rar_path = os.path.join(archives_dir, 'text_pdf.rar')
+        subprocess.run(['rar', 'a', '-ep', '-idq', rar_path, doc('text_layer.pdf'), doc('plain.txt')], check=False)
+        if os.path.exists(rar_path):
+            archives.append(rar_path)
+
+    return {'documents': documents, 'archives': archives, 'scans': scans}
+
+
+def load_ocr_samples(directory: str) -> List[str]:
+    """
+    Изображения набора образцов OCR. Эталонный текст образца - файл <имя изображения>.gt.txt
+    рядом с ним; без эталона качество сравнивается с распознаванием без подготовки
+    """
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.lower().endswith(SAMPLE_EXTENSIONS))
+
+
+def _text_similarity(text: str, reference: str) -> float:
+    """Сходство распознанного текста с эталоном (0..1) без учета переносов и лишних пробелов"""
+    return difflib.SequenceMatcher(None, ' '.join(text.split()), ' '.join(reference.split()), autojunk=False).ratio()
+
+
+def _sample_references(samples: List[str]) -> List[str]:
+    """Эталонные тексты образцов: .gt.txt или распознавание без подготовки изображения"""
+    from formats.ocr_utils import perform_ocr_image, open_image_for_ocr, preprocessing_options
+    raw = preprocessing_options(enabled=False)
+    references = []
+    for sample in samples:
+        truth = sample + '.gt.txt'
+        if os.path.exists(truth):
+            with open(truth, encoding='utf-8') as f:
+                references.append(f.read())
+        else:
+            with open_image_for_ocr(sample, raw) as img:
+                references.append(perform_ocr_image(img, backend=None, preprocess=raw))
+    return references
+
+
+# ---------------------------------------------------------------------------
+# Замеры
+# ---------------------------------------------------------------------------
+
+class StubTransport:
+    """
+    Транспорт LLM без сети: на описание архива просит текст основного документа,
+    на текст отвечает переименованием
+    """
+
+    def generate(self, prompt: str):
+        if 'Текст:' in prompt or 'Начало текста' in prompt:
+            extension = re.search(r'Расширение архива: "?([^"\n]*)', prompt)
+            new_name = f"Синтетическая книга{extension.group(1) if extension else ''}"
+            return json.dumps({'decision': 'rename', 'new_name': new_name}, ensure_ascii=False), {}
+        target = re.search(r'Основной документ внутри: "([^"(]*)', prompt)
+        return json.dumps({
+            'decision': 'need_more_data',
+            'action': 'extract_text',
+            'target': target.group(1).strip() if target else '',
+            'parameters': {'type': 'first_chars', 'amount': 1000}
+        }), {}
+
+    async def agenerate(self, prompt: str):
+        return self.generate(prompt)
+
+
+def _peak_rss_kb() -> Dict[str, Optional[int]]:
+    """Пиковый объем памяти процесса и его дочерних процессов (tesseract, pdftoppm), КБ"""
+    if resource is None:
+        try:
+            import psutil
+            return {'self': psutil.Process().memory_info().peak_wset // 1024, 'children': None}
+        except Exception:
+            return {'self': None, 'children': None}
+    # В macOS ru_maxrss в байтах, в Linux - в килобайтах
+    divider = 1024 if sys.platform == 'darwin' else 1
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // divider,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // divider
+    }
+
+
+def _cpu_time() -> float:
+    """Процессорное время процесса и завершившихся дочерних процессов"""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _measure_case(case: Dict[str, Any]) -> Dict[str, Any]:
+    """Выполняет один замер (в отдельном процессе, чтобы пиковая память относилась только к нему)"""
+    logging.disable(logging.CRITICAL)
+    import result_cache
+    result_cache.set_cache_enabled(False)
+    from formats.ocr_utils import configure_ocr_engine, OCR_BACKENDS
+    configure_ocr_engine(workers=case['ocr_workers'], backend=(case.get('parameters') or {}).get('ocr_backend'))
+
+    if case['operation'] in ('analyze', 'analyze_one_shot'):
+        import llm_client
+        llm_client.set_llm_client(llm_client.LLMClient(StubTransport()))
+        import main
+        logging.disable(logging.CRITICAL)
+
+        def run():
+            return main.propose_archive_name(case['path'], one_shot=case['operation'] == 'analyze_one_shot')
+        handler_name = 'pipeline'
+    elif case['operation'] == 'pdf_backend':
+        from formats import pdf_handler
+        pdf_handler.PDF_BACKEND = case['parameters']['backend']
+        parameters = {k: v for k, v in case['parameters'].items() if k != 'backend'}
+
+        def run():
+            return pdf_handler.PDFHandler.extract_text(case['path'], parameters)
+        handler_name = pdf_handler.PDF_BACKENDS[case['parameters']['backend']].__name__
+    elif case['operation'] == 'ocr_preprocess':
+        from formats.ocr_utils import perform_ocr_image, open_image_for_ocr, preprocessing_options
+        options = preprocessing_options(**PREPROCESS_VARIANTS[case['parameters']['preprocess']])
+        references = _sample_references(case['samples'])
+
+        def run():
+            texts = []
+            for sample in case['samples']:
+                with open_image_for_ocr(sample, options) as img:
+                    texts.append(perform_ocr_image(img, preprocess=options))
+            return texts
+        handler_name = 'preprocess_image'
+    elif case['operation'] == 'ocr_adaptive':
+        from formats import get_handler_for_file, pdf_handler, djvu_handler
+        pdf_handler.OCR_ADAPTIVE = djvu_handler.OCR_ADAPTIVE = case['parameters']['adaptive']
+        handler = get_handler_for_file(case['path'])
+        parameters = {k: v for k, v in case['parameters'].items() if k != 'adaptive'}
+
+        def run():
+            return handler.extract_text(case['path'], parameters)
+        handler_name = handler.__name__
+    elif case['operation'] == 'ocr_backend':
+        from formats import get_handler_for_file
+        handler = get_handler_for_file(case['path'])
+        parameters = {k: v for k, v in case['parameters'].items() if k != 'ocr_backend'}
+
+        def run():
+            return handler.extract_text(case['path'], parameters)
+        handler_name = OCR_BACKENDS[case['parameters']['ocr_backend']].__name__
+    else:
+        from formats import get_handler_for_file, extract_text_data, get_file_metadata
+        handler = get_handler_for_file(case['path'])
+        handler_name = handler.__name__
+
+        if case['operation'] == 'metadata':
+            def run():
+                return get_file_metadata(case['path'])
+        else:
+            def run():
+                return extract_text_data(case['path'], case['parameters'])
+
+    walls = []
+    cpus = []
+    output = None
+    error = None
+    from formats import release_documents
+    for _ in range(case['repeat']):
+        # Каждый повтор начинается с закрытого документа, как при первом обращении
+        release_documents()
+        wall_start = time.perf_counter()
+        cpu_start = _cpu_time()
+        try:
+            output = run()
+        except Exception as e:
+            error = str(e)
+            break
+        walls.append(time.perf_counter() - wall_start)
+        cpus.append(_cpu_time() - cpu_start)
+
+    quality = None
+    if case['operation'] == 'ocr_preprocess' and output is not None:
+        quality = statistics.mean(_text_similarity(text, reference) for text, reference in zip(output, references))
+        output = ''.join(output)
+
+    rss = _peak_rss_kb()
+    return {
+        'operation': case['operation'],
+        'handler': handler_name,
+        'file': os.path.basename(case['path']),
+        'parameters': case.get('parameters'),
+        'wall': statistics.median(walls) if walls else None,
+        'wall_min': min(walls) if walls else None,
+        'cpu': statistics.median(cpus) if cpus else None,
+        'peak_rss_kb': rss['self'],
+        'children_peak_rss_kb': rss['children'],
+        'output_size': len(output) if isinstance(output, (str, dict)) else None,
+        'quality': quality,
+        'error': error
+    }
+
+
+def build_cases(corpus: Dict[str, List[str]], repeat: int, ocr_workers: Optional[int],
+                ocr_samples: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Список замеров: текст по каждому набору параметров и метаданные для документов, полный анализ для архивов,
+    варианты подготовки изображений на наборе образцов OCR (ocr_samples или сканы корпуса)
+    """
+    cases = []
+    common = {'repeat': repeat, 'ocr_workers': ocr_workers}
+    for path in corpus['documents']:
+        for parameters in PARAMETER_SETS:
+            cases.append(dict(common, operation='extract_text', path=path, parameters=parameters))
+        cases.append(dict(common, operation='metadata', path=path))
+        if path.lower().endswith('.pdf'):
+            # Сравнение установленных PDF бэкендов (порядок PDF_BACKENDS - по этим замерам)
+            from formats.pdf_handler import PDF_BACKENDS
+            for name, backend in PDF_BACKENDS.items():
+                if importlib.util.find_spec(backend.module):
+                    cases.append(dict(common, operation='pdf_backend', path=path,
+                                      parameters={'backend': name, 'type': 'first_chars', 'amount': 5000}))
+        if os.path.basename(path) == 'scanned.pdf':
+            # Адаптивное OCR (разрешение по уверенности, отбрасывание мусора) против фиксированного PDF_OCR_DPI
+            for adaptive in (False, True):
+                cases.append(dict(common, operation='ocr_adaptive', path=path,
+                                  parameters={'adaptive': adaptive, 'type': 'first_chars', 'amount': 1000}))
+        if os.path.basename(path) in ('scanned.pdf', 'page_0001.png'):
+            # Постоянная цена страницы у установленных бэкендов OCR (загрузка моделей, запуск процесса)
+            from formats.ocr_utils import OCR_BACKENDS
+            for name, backend in OCR_BACKENDS.items():
+                if backend.available():
+                    cases.append(dict(common, operation='ocr_backend', path=path,
+                                      parameters={'ocr_backend': name, 'type': 'first_pages', 'amount': 3}))
+    for path in corpus['archives']:
+        cases.append(dict(common, operation='analyze', path=path))
+        cases.append(dict(common, operation='analyze_one_shot', path=path))
+
+    samples = load_ocr_samples(ocr_samples) if ocr_samples else corpus.get('scans', [])
+    if samples:
+        for name in PREPROCESS_VARIANTS:
+            cases.append(dict(common, operation='ocr_preprocess', path=os.path.dirname(samples[0]),
+                              samples=samples, parameters={'preprocess': name}))
+    return cases
+
+
+def run_benchmark(corpus: Dict[str, List[str]], repeat: int = 3, ocr_workers: Optional[int] = None,
+                  only: Optional[str] = None, ocr_samples: Optional[str] = None) -> Dict[str, Any]:
+    """Выполняет все замеры, каждый в новом процессе"""
+    cases = build_cases(corpus, repeat, ocr_workers, ocr_samples)
+    if only:
+        cases = [c for c in cases if re.search(only, f"{c['operation']} {os.path.basename(c['path'])}")]
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for number, case in enumerate(cases, 1):
+        with context.Pool(processes=1) as pool:
+            try:
+                result = pool.apply(_measure_case, (case,))
+            except Exception as e:
+                result = {'operation': case['operation'], 'handler': None, 'file': os.path.basename(case['path']),
+                          'parameters': case.get('parameters'), 'wall': None, 'wall_min': None, 'cpu': None,
+                          'peak_rss_kb': None, 'children_peak_rss_kb': None, 'output_size': None,
+                          'quality': None, 'error': f"{type(e).__name__}: {e}"}
+        results.append(result)
+        wall = f"{result['wall']:.3f} с" if result['wall'] is not None else result['error']
+        if result.get('quality') is not None:
+            wall += f", качество {result['quality']:.3f}"
+        print(f"[{number}/{len(cases)}] {result['operation']} {result['file']} "
+              f"{json.dumps(result['parameters']) if result['parameters'] else ''}: {wall}", file=sys.stderr)
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        commit = ''
+
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'repeat': repeat
+        },
+        'results': results
+    }
+
+
+def compare_reports(baseline: Dict[str, Any], current: Dict[str, Any]) -> str:
+    """Сравнивает два отчета по медианному времени"""
+    def key(result):
+        return (result['operation'], result['file'], json.dumps(result['parameters'], sort_keys=True))
+
+    old = {key(r): r for r in baseline['results']}
+    lines = [f"{'замер':<60} {'было, с':>10} {'стало, с':>10} {'изменение':>10}"]
+    for result in current['results']:
+        before = old.get(key(result))
+        if not before or before['wall'] is None or result['wall'] is None:
+            continue
+        change = (result['wall'] - before['wall']) / before['wall'] * 100 if before['wall'] else 0.0
+        name = f"{result['operation']} {result['file']} {json.dumps(result['parameters']) if result['parameters'] else ''}"
+        line = f"{name[:60]:<60} {before['wall']:>10.3f} {result['wall']:>10.3f} {change:>+9.1f}%"
+        if result.get('quality') is not None and before.get('quality') is not None:
+            line += f"  качество {before['quality']:.3f} -> {result['quality']:.3f}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры скорости обработчиков форматов на синтетическом корпусе")
+    parser.add_argument("--corpus", help="Каталог корпуса (файлы корпуса создаются заново при каждом запуске "
+                                         "и сохраняются; по умолчанию - временный каталог)")
+    parser.add_argument("--scale", type=int, default=1, help="Множитель размера корпуса")
+    parser.add_argument("--seed", type=int, default=0, help="Зерно генератора корпуса")
+    parser.add_argument("--repeat", type=int, default=3, help="Повторов каждого замера")
+    parser.add_argument("--ocr-workers", type=int, default=OCR_WORKERS,
+                        help="Процессов OCR (по умолчанию - OCR_WORKERS из config.py; None - по числу ядер)")
+    parser.add_argument("--ocr-samples", metavar="DIR",
+                        help="Каталог образцов для ocr_preprocess: изображения и эталоны <имя>.gt.txt "
+                             "(по умолчанию - сканы корпуса, эталон - OCR без подготовки)")
+    parser.add_argument("--only", help="Регулярное выражение для отбора замеров (по операции и имени файла)")
+    parser.add_argument("--output", help="Файл для JSON отчета (по умолчанию - stdout)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="Сравнить два JSON отчета")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0], encoding='utf-8') as f:
+            baseline = json.load(f)
+        with open(args.compare[1], encoding='utf-8') as f:
+            current = json.load(f)
+        print(compare_reports(baseline, current))
+        return
+
+    corpus_dir = args.corpus or tempfile.mkdtemp(prefix='bench_corpus_')
+    try:
+        print(f"Генерация корпуса в {corpus_dir}...", file=sys.stderr)
+        corpus = generate_corpus(corpus_dir, scale=args.scale, seed=args.seed)
+        report = run_benchmark(corpus, repeat=args.repeat, ocr_workers=args.ocr_workers, only=args.only,
+                               ocr_samples=args.ocr_samples)
+        report['meta'].update({'scale': args.scale, 'seed': args.seed})
+    finally:
+        if not args.corpus:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    data = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(data)
+    else:
+        print(data)
+
+if __name__ == "__main__":
+    main()
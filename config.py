@@ -1,3 +1,85 @@
-﻿# Конфигурационные параметры
-GEMINI_API_KEY = "XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX"  # Заменить на ваш ключ API
-MAX_FILE_SIZE = 1024 * 1024  # 1MB max для мета-файлов
+﻿# Конфигурационные параметры
+import os
+
+GEMINI_API_KEY = "XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX"  # Заменить на ваш ключ API
+MAX_FILE_SIZE = 1024 * 1024  # 1MB max для мета-файлов
+
+# Пакетная обработка
+BATCH_WORKERS = None  # число процессов для распаковки/OCR (None - по числу ядер)
+LLM_MAX_CONCURRENCY = 4  # максимум одновременных запросов к LLM
+LLM_BATCH_SIZE = 1  # архивов в одном запросе к LLM (1 - отдельный запрос на архив)
+
+# Однопроходный анализ: метаданные и начало текста основного документа сразу в первом запросе
+ONE_SHOT_ANALYSIS = False
+PREFETCH_TEXT_CHARS = 1500
+PREFETCH_CANDIDATES = 3  # сколько файлов по рангу пробовать, если основной документ не дал текста
+
+# Имя по метаданным основного документа (без обращения к LLM)
+METADATA_NAMING = True
+NAME_TEMPLATES = ['{author} - {title} ({year})', '{author} - {title}']  # первый шаблон, для которого известны все поля
+METADATA_MIN_QUALITY = 0.9  # название 0.6, автор 0.3, год 0.1: по умолчанию нужны название и автор
+
+# Кэш результатов (извлеченный текст, метаданные, решения LLM)
+CACHE_ENABLED = True
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'ai-file-renamer', 'cache.sqlite3')
+CACHE_MAX_BYTES = 512 * 1024 * 1024  # при превышении удаляются давно не использованные записи
+
+# Индекс библиотеки для инкрементального режима (--incremental, --watch)
+INDEX_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'ai-file-renamer', 'library.sqlite3')
+WATCH_SETTLE_SECONDS = 5  # новый архив обрабатывается, когда его размер не меняется столько секунд
+WATCH_POLL_INTERVAL = 30  # период опроса каталога, если watchdog не установлен
+
+# OCR
+OCR_WORKERS = None  # процессов для OCR страниц (None - по числу ядер, 1 - без пула)
+OCR_PAGE_TIMEOUT = 120  # ограничение времени распознавания одной страницы, с
+OCR_BACKEND = 'auto'  # 'tesserocr', 'tesseract' (утилита через stdin), 'pytesseract' или 'auto' - первый доступный
+# Языки OCR: 'auto' - минимальный набор для документа (по текстовому слою, именам файлов и метаданным,
+# пробному распознаванию одной страницы в низком разрешении), иначе строка для tesseract, например 'rus+eng'
+OCR_LANGUAGES = 'auto'
+OCR_DEFAULT_LANGUAGES = 'rus+eng'  # если язык документа определить не удалось
+OCR_EXTRA_LANGUAGES = ''  # всегда добавляются к выбранному набору, например 'deu+fra'
+OCR_PROBE_DPI = 100  # разрешение пробного распознавания для определения языка
+# Адаптивное OCR страниц PDF и DJVU по уверенности tesseract в словах: страница распознается
+# с первым разрешением из OCR_DPI_STEPS и повторно со следующим, только если уверенность низкая
+OCR_ADAPTIVE = True
+OCR_DPI_STEPS = [150, 300]
+OCR_MIN_CONFIDENCE = 75  # средняя уверенность (0-100), при которой страница не распознается повторно
+OCR_JUNK_CONFIDENCE = 45  # текст страниц с меньшей уверенностью после всех попыток отбрасывается
+OCR_PICTURE_MAX_WORDS = 8  # меньше слов и нет уверенных - иллюстрация, повторно не распознается
+
+# Подготовка изображений к OCR (выполняется в процессах OCR)
+OCR_PREPROCESS = True  # оттенки серого, уменьшение до OCR_TARGET_DPI, обрезка полей
+OCR_TARGET_DPI = 300  # изображения с большим разрешением уменьшаются до него
+OCR_MAX_DIMENSION = 3000  # ограничение стороны изображения без сведений о DPI, пикс.
+OCR_CROP_MARGINS = True  # обрезать пустые поля; пустые страницы не распознаются
+OCR_MARGIN_THRESHOLD = 160  # пиксели темнее этого значения (0-255) считаются содержимым
+OCR_BINARIZE = False  # черно-белое изображение по порогу Оцу (быстрее, но качество зависит от сканов - см. benchmark.py)
+
+# Определение типа файлов по содержимому
+SNIFF_MAX_MEMBERS = 500  # в архивах с большим числом файлов изображения по содержимому не проверяются
+RAR_SNIFF_MAX_MEMBERS = 20  # файлов RAR без расширения или с незнакомым, проверяемых по содержимому (каждое чтение - запуск unrar)
+
+# Вложенные архивы (раскрываются в памяти, без распаковки на диск)
+NESTED_ARCHIVE_DEPTH = 2  # сколько уровней вложенности раскрывать (0 - не раскрывать)
+NESTED_ARCHIVE_MAX_BYTES = 128 * 1024 * 1024  # общий объем вложенных архивов, читаемых в память
+NESTED_ARCHIVE_MAX_MEMBERS = 5000  # сколько всего файлов вложенных архивов добавлять в список
+
+# PDF
+PDF_BACKEND = 'auto'  # 'auto' (самый быстрый из установленных), 'pypdfium2', 'pypdf2' или 'pdfminer'
+PDF_MAX_PAGES = 50  # сколько страниц просматривать при извлечении первых символов
+PDF_OCR_DPI = 200  # разрешение растеризации страниц без текстового слоя для OCR
+PDF_TEXT_MIN_CHARS = 20  # страница с меньшим числом символов считается не имеющей текстового слоя
+
+# DJVU
+DJVU_MAX_PAGES = 30  # сколько страниц просматривать при извлечении первых символов
+DJVU_OCR_DPI = 150  # разрешение растеризации страниц без текстового слоя для OCR
+DJVU_TEXT_MIN_CHARS = 20  # страница с меньшим числом символов считается не имеющей текстового слоя
+
+# Запросы к LLM
+LLM_MAX_RETRIES = 5  # повторов при 429/5xx
+LLM_RETRY_BASE_DELAY = 1.0  # базовая задержка перед повтором, с (растет экспоненциально)
+LLM_RETRY_MAX_DELAY = 30.0  # максимальная задержка перед повтором, с
+
+# Описание содержимого архива в промпте
+MANIFEST_TOKEN_BUDGET = 1500  # примерный лимит токенов на описание одного архива
+MANIFEST_BATCH_TOKEN_BUDGET = 600  # то же в пакетных запросах (--llm-batch)
@@ -1,111 +1,233 @@
-import os
-import logging
-import fnmatch
-from typing import Dict, Any
-
-logger = logging.getLogger(__name__)
-
-def identify_main_document(files_list: list) -> str:
-    """
-    Определяет основной документ в списке файлов
-    """
-    document_files = []
-    document_extensions = ['.pdf', '.docx', '.txt', '.fb2', '.djvu', '.epub', '.zip']
-    
-    for file_info in files_list:
-        if file_info['type'] == 'file':
-            ext = os.path.splitext(file_info['name'])[1].lower()
-            if ext in document_extensions:
-                document_files.append(file_info)
-    
-    if not document_files:
-        return ""
-    
-    # Сортируем по размеру (предполагаем, что больший файл - основной)
-    document_files.sort(key=lambda x: x['size'] or 0, reverse=True)
-    
-    return document_files[0]['name']
-
-
-def extract_text_data(file_path: str, parameters: Dict[str, Any]) -> str:
-    """
-    Основная функция для извлечения текста из файла
-    Использует модульную систему обработчиков
-    """
-    try:
-        from formats import extract_text_data as format_extract_text
-        return format_extract_text(file_path, parameters)
-    except ImportError as e:
-        logger.error(f"Ошибка импорта модуля formats: {e}")
-        return _fallback_extract_text(file_path, parameters)
-    except Exception as e:
-        logger.error(f"Ошибка в модульной системе: {e}")
-        return _fallback_extract_text(file_path, parameters)
-
-
-def _fallback_extract_text(file_path: str, parameters: Dict[str, Any]) -> str:
-    """
-    Простая реализация на случай проблем с модулями
-    """
-    action_type = parameters.get('type', 'first_chars')
-    amount = parameters.get('amount', 500)
-    
-    file_ext = os.path.splitext(file_path)[1].lower()
-
-    try:
-        if file_ext == '.txt':
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                return f.read(amount)
-        elif file_ext == '.pdf':
-            try:
-                import PyPDF2
-                text = ""
-                with open(file_path, 'rb') as file:
-                    reader = PyPDF2.PdfReader(file)
-                    for page in reader.pages:
-                        page_text = page.extract_text()
-                        if page_text:
-                            text += page_text + "\n"
-                        if len(text) >= amount:
-                            break
-                return text[:amount]
-            except:
-                return "Не удалось прочитать PDF"
-        elif file_ext == '.docx':
-            try:
-                import docx
-                doc = docx.Document(file_path)
-                text = "\n".join([p.text for p in doc.paragraphs])
-                return text[:amount]
-            except:
-                return "Не удалось прочитать DOCX"
-        elif file_ext == '.epub':
-            try:
-                import zipfile
-                text_parts = []
-                with zipfile.ZipFile(file_path, 'r') as epub_zip:
-                    for file_name in epub_zip.namelist():
-                        if file_name.endswith(('.xhtml', '.html', '.xml', '.txt')):
-                            try:
-                                with epub_zip.open(file_name) as f:
-                                    content = f.read().decode('utf-8', errors='ignore')
-                                    text_parts.append(content[:200])
-                                    if len(' '.join(text_parts)) >= amount:
-                                        break
-                            except:
-                                continue
-                return ' '.join(text_parts)[:amount]
-            except:
-                return "Не удалось прочитать EPUB"
-        elif file_ext == '.djvu':
-            try:
-                from formats.djvu_handler import DJVUHandler
-                return DJVUHandler.extract_text(file_path, parameters)
-            except:
-                return "Ошибка: не установлен модуль djvu. Установите его для работы с djvu файлами..."
-        else:
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                return f.read(amount)
-    except Exception as e:
-        return f"Ошибка при fallback обработке: {str(e)}"
-
+import os
+import re
+import math
+import logging
+import fnmatch
+from typing import Dict, Any
+from formats.sniff import effective_type
+
+logger = logging.getLogger(__name__)
+
+# Вес типа файла: форматы с текстом выше сканов, вложенных архивов и изображений
+TYPE_WEIGHTS = {
+    '.epub': 6.0, '.fb2': 6.0, '.docx': 5.5, '.doc': 5.0, '.pdf': 5.0, '.djvu': 4.5,
+    '.txt': 2.5, '.zip': 1.0, '.rar': 1.0,
+    '.jpg': 0.5, '.jpeg': 0.5, '.png': 0.5, '.tif': 0.5, '.tiff': 0.5, '.gif': 0.3, '.bmp': 0.3, '.webp': 0.3,
+}
+
+# Типы, текст которых всегда доступен без OCR
+TEXT_TYPES = ['.epub', '.fb2', '.docx', '.doc', '.txt']
+
+# Изображения: текст только через OCR
+IMAGE_TYPES = ['.jpg', '.jpeg', '.png', '.tif', '.tiff', '.gif', '.bmp', '.webp']
+
+# Вложенные архивы: содержимое можно узнать только распаковав их
+ARCHIVE_TYPES = ['.zip', '.rar']
+
+# Слова в имени, которые указывают на второстепенный файл
+SECONDARY_NAME_TOKENS = {
+    'cover', 'covers', 'обложка', 'readme', 'sample', 'preview', 'demo', 'example',
+    'license', 'licence', 'thumb', 'thumbnail', 'back', 'diz', 'nfo', 'info', 'превью', 'пример'
+}
+
+SIZE_WEIGHT = 2.0  # вклад относительного размера (логарифмическая шкала)
+DEPTH_PENALTY = 0.3  # штраф за каждый уровень вложенности каталогов
+NAME_PENALTY = 3.0  # штраф за второстепенное имя (cover, readme, sample)
+TEXT_LAYER_BONUS = 2.0  # бонус за известный текстовый слой (и такой же штраф за его отсутствие)
+DUPLICATE_BONUS = 1.0  # бонус, если тот же документ лежит в архиве в нескольких форматах
+FIRST_PAGES_BONUS = 1.0  # бонус первым страницам нумерованной последовательности (титул)
+
+_SEQUENCE_RE = re.compile(r'^(.*?)(\d+)(\D*)$')
+
+
+def _name_tokens(stem: str) -> set:
+    return {token for token in re.split(r'[\W_]+', stem.lower()) if token}
+
+
+def document_features(files_list: list) -> Dict[int, Dict[str, Any]]:
+    """
+    Признаки файлов-кандидатов, вычисляемые без чтения содержимого:
+    тип, размер, глубина, слова в имени, наличие текстового слоя,
+    дублирование в разных форматах и положение в нумерованной последовательности.
+    Возвращает {id(file_info): признаки}
+    """
+    candidates = []
+    for file_info in files_list:
+        if file_info['type'] != 'file':
+            continue
+        # Тип по содержимому, если он определен (файл .zip может оказаться EPUB, а файл без расширения - PDF)
+        file_type = effective_type(file_info['name'], file_info.get('kind'))
+        if file_type in TYPE_WEIGHTS:
+            candidates.append((file_info, file_type))
+
+    stems = {}
+    sequences = {}
+    for file_info, file_type in candidates:
+        path = (file_info.get('member') or file_info['name']).replace('\\', '/')
+        directory, name = os.path.split(path)
+        stem = os.path.splitext(name)[0].lower()
+        stems.setdefault((directory, stem), set()).add(file_type)
+        match = _SEQUENCE_RE.match(stem)
+        if match:
+            sequences.setdefault((directory, match.group(1), match.group(3), file_type), []).append(
+                (int(match.group(2)), id(file_info)))
+
+    sequence_positions = {}
+    for members in sequences.values():
+        if len(members) >= 3:
+            for position, (_, key) in enumerate(sorted(members)):
+                sequence_positions[key] = position
+
+    max_size = max((f.get('size') or 0 for f, _ in candidates), default=0)
+
+    features = {}
+    for file_info, file_type in candidates:
+        path = (file_info.get('member') or file_info['name']).replace('\\', '/')
+        directory, name = os.path.split(path)
+        stem = os.path.splitext(name)[0].lower()
+        size = file_info.get('size') or 0
+
+        if file_type in TEXT_TYPES:
+            text_layer = True
+        elif file_type in IMAGE_TYPES:
+            text_layer = False
+        else:
+            # PDF/DJVU: неизвестно, пока файл не проверен (см. file_info['text_layer'])
+            text_layer = file_info.get('text_layer')
+
+        features[id(file_info)] = {
+            'type': file_type,
+            'size_ratio': math.log(size + 1) / math.log(max_size + 1) if max_size else 0.0,
+            'depth': path.count('/'),
+            'secondary_name': bool(_name_tokens(stem) & SECONDARY_NAME_TOKENS),
+            'text_layer': text_layer,
+            'duplicated': len(stems[(directory, stem)]) > 1,
+            'sequence_position': sequence_positions.get(id(file_info)),
+        }
+    return features
+
+
+def score_document(features: Dict[str, Any]) -> float:
+    """Оценка вероятности того, что файл - основной документ архива"""
+    score = TYPE_WEIGHTS[features['type']]
+    position = features['sequence_position']
+    if features['type'] in IMAGE_TYPES:
+        # Размер сканов ничего не говорит о содержании, а титул обычно среди первых страниц
+        if position is not None and position < 3:
+            score += FIRST_PAGES_BONUS * (3 - position) / 3
+    elif features['type'] not in ARCHIVE_TYPES:
+        score += SIZE_WEIGHT * features['size_ratio']
+    score -= DEPTH_PENALTY * features['depth']
+    if features['secondary_name']:
+        score -= NAME_PENALTY
+    if features['text_layer'] is True:
+        score += TEXT_LAYER_BONUS
+    elif features['text_layer'] is False and features['type'] not in IMAGE_TYPES:
+        score -= TEXT_LAYER_BONUS
+    if features['duplicated']:
+        score += DUPLICATE_BONUS
+    return score
+
+
+def rank_documents(files_list: list) -> list:
+    """
+    Файлы-кандидаты в основной документ, от наиболее вероятного к наименее.
+    Файлы с текстом идут раньше сканов, поэтому OCR выполняется, только если текстовых документов нет
+    """
+    features = document_features(files_list)
+    ranked = [f for f in files_list if id(f) in features]
+    # При равной оценке - больший файл, затем по имени (детерминированный порядок)
+    ranked.sort(key=lambda f: (-score_document(features[id(f)]), -(f.get('size') or 0), f['name']))
+    return ranked
+
+
+def identify_main_document(files_list: list) -> str:
+    """
+    Определяет основной документ в списке файлов
+    """
+    ranked = rank_documents(files_list)
+    return ranked[0]['name'] if ranked else ""
+
+
+def extract_text_data(file_path: str, parameters: Dict[str, Any]) -> str:
+    """
+    Основная функция для извлечения текста из файла
+    Использует модульную систему обработчиков
+    """
+    try:
+        from formats import extract_text_data as format_extract_text
+        return format_extract_text(file_path, parameters)
+    except ImportError as e:
+        logger.error(f"Ошибка импорта модуля formats: {e}")
+        return _fallback_extract_text(file_path, parameters)
+    except Exception as e:
+        logger.error(f"Ошибка в модульной системе: {e}")
+        return _fallback_extract_text(file_path, parameters)
+
+
+def _fallback_extract_text(file_path: str, parameters: Dict[str, Any]) -> str:
+    """
+    Простая реализация на случай проблем с модулями
+    """
+    action_type = parameters.get('type', 'first_chars')
+    amount = parameters.get('amount', 500)
+    
+    file_ext = os.path.splitext(file_path)[1].lower()
+
+    try:
+        if file_ext == '.txt':
+            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                return f.read(amount)
+        elif file_ext == '.pdf':
+            try:
+                import PyPDF2
+                text = ""
+                with open(file_path, 'rb') as file:
+                    reader = PyPDF2.PdfReader(file)
+                    for page in reader.pages:
+                        page_text = page.extract_text()
+                        if page_text:
+                            text += page_text + "\n"
+                        if len(text) >= amount:
+                            break
+                return text[:amount]
+            except:
+                return "Не удалось прочитать PDF"
+        elif file_ext == '.docx':
+            try:
+                import docx
+                doc = docx.Document(file_path)
+                text = "\n".join([p.text for p in doc.paragraphs])
+                return text[:amount]
+            except:
+                return "Не удалось прочитать DOCX"
+        elif file_ext == '.epub':
+            try:
+                import zipfile
+                text_parts = []
+                with zipfile.ZipFile(file_path, 'r') as epub_zip:
+                    for file_name in epub_zip.namelist():
+                        if file_name.endswith(('.xhtml', '.html', '.xml', '.txt')):
+                            try:
+                                with epub_zip.open(file_name) as f:
+                                    content = f.read().decode('utf-8', errors='ignore')
+                                    text_parts.append(content[:200])
+                                    if len(' '.join(text_parts)) >= amount:
+                                        break
+                            except:
+                                continue
+                return ' '.join(text_parts)[:amount]
+            except:
+                return "Не удалось прочитать EPUB"
+        elif file_ext == '.djvu':
+            try:
+                from formats.djvu_handler import DJVUHandler
+                return DJVUHandler.extract_text(file_path, parameters)
+            except:
+                return "Ошибка: не установлен модуль djvu. Установите его для работы с djvu файлами..."
+        else:
+            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                return f.read(amount)
+    except Exception as e:
+        return f"Ошибка при fallback обработке: {str(e)}"
+
@@ -1,58 +1,100 @@
-from typing import Dict
-import logging
-
-HANDLERS = []
-
-def _register_handlers():
-    """Ленивая регистрация обработчиков"""
-    from .txt_handler import TXTHandler
-    from .pdf_handler import PDFHandler
-    from .docx_handler import DOCXHandler
-    from .fb2_handler import FB2Handler
-    from .zip_handler import ZIPHandler
-    from .epub_handler import EPUBHandler
-    from .image_handler import IMAGEHandler  # Добавляем новый обработчик
-
-    global HANDLERS
-    HANDLERS = [
-        TXTHandler,
-        PDFHandler,
-        DOCXHandler,
-        FB2Handler,
-        ZIPHandler,
-        EPUBHandler,
-        IMAGEHandler  # Добавляем в список обработчиков
-    ]
-
-
-def get_handler_for_file(file_path: str):
-    """
-    Возвращает подходящий обработчик для файла
-    """
-    if not HANDLERS:
-        _register_handlers()
-
-    for handler in HANDLERS:
-        if handler.can_handle(file_path):
-            return handler
-
-    from .base_handler import BaseFormatHandler
-    return BaseFormatHandler
-
-
-def extract_text_data(file_path: str, parameters: dict) -> str:
-    """
-    Основная функция для извлечения текста из файла
-    """
-    handler = get_handler_for_file(file_path)
-    return handler.extract_text(file_path, parameters)
-
-
-def get_file_metadata(file_path: str) -> Dict[str, str]:
-    """
-    Извлекает метаданные из файла (если поддерживается)
-    """
-    handler = get_handler_for_file(file_path)
-    if hasattr(handler, 'get_metadata'):
-        return handler.get_metadata(file_path)
-    return {}
+import os
+from typing import Dict
+import logging
+
+from tracing import span
+from .registry import registry
+
+
+def register_handler(extensions, handler, signatures=()):
+    """
+    Регистрирует обработчик для расширений (и сигнатур (смещение, байты)).
+    handler - класс или строка 'модуль:Класс' (модуль импортируется при первом подходящем файле).
+    Сторонние пакеты могут вместо этого объявить точку входа в группе ai_file_renamer.formats
+    """
+    registry.register(extensions, handler, signatures)
+
+
+def get_handler_for_file(file_path: str):
+    """
+    Возвращает подходящий обработчик для файла
+    """
+    handler = registry.find(file_path)
+    if handler is not None:
+        return handler
+
+    from .base_handler import BaseFormatHandler
+    return BaseFormatHandler
+
+
+def release_documents() -> None:
+    """
+    Закрывает документы, которые обработчики держат открытыми между вызовами
+    (например, перед удалением временного каталога с извлеченными файлами)
+    """
+    from .base_handler import DocumentCache
+    DocumentCache.release_all()
+
+
+def _get_cache():
+    """Кэш результатов, если он доступен"""
+    try:
+        from result_cache import get_cache
+        return get_cache()
+    except ImportError:
+        return None
+
+
+def extract_text_data(file_path: str, parameters: dict) -> str:
+    """
+    Основная функция для извлечения текста из файла
+    """
+    with span('handler.text', file=os.path.basename(file_path), bytes=os.path.getsize(file_path)) as current:
+        handler = get_handler_for_file(file_path)
+        current.set(handler=handler.__name__)
+        cache = _get_cache()
+        if cache is None:
+            text = handler.extract_text(file_path, parameters)
+            current.set(chars=len(text))
+            return text
+
+        from result_cache import file_hash, parameters_key
+        key = f"{file_hash(file_path)}:{handler.__name__}:{parameters_key(parameters)}"
+        cached = cache.get(cache.TEXT, key)
+        if cached is not None:
+            logging.debug(f"Текст {file_path} взят из кэша")
+            current.set(chars=len(cached), cached=True)
+            return cached
+
+        text = handler.extract_text(file_path, parameters)
+        current.set(chars=len(text), cached=False)
+        # Сообщения об ошибках не кэшируем: причина может быть устранена (например, установлен tesseract)
+        if not text.startswith("Ошибка"):
+            cache.put(cache.TEXT, key, text)
+        return text
+
+
+def get_file_metadata(file_path: str) -> Dict[str, str]:
+    """
+    Извлекает метаданные из файла (если поддерживается)
+    """
+    with span('handler.metadata', file=os.path.basename(file_path)) as current:
+        handler = get_handler_for_file(file_path)
+        current.set(handler=handler.__name__)
+        if not hasattr(handler, 'get_metadata'):
+            return {}
+
+        cache = _get_cache()
+        if cache is None:
+            return handler.get_metadata(file_path)
+
+        from result_cache import file_hash
+        key = f"{file_hash(file_path)}:{handler.__name__}"
+        cached = cache.get(cache.METADATA, key)
+        current.set(cached=cached is not None)
+        if cached is not None:
+            return cached
+
+        metadata = handler.get_metadata(file_path)
+        cache.put(cache.METADATA, key, metadata)
+        return metadata
@@ -1,26 +1,83 @@
-import os
-import logging
-from abc import ABC, abstractmethod
-from typing import Dict, Any
-
-logger = logging.getLogger(__name__)
-
-class BaseFormatHandler(ABC):
-    """Базовый класс для обработчиков различных форматов файлов"""
-    
-    @staticmethod
-    @abstractmethod
-    def can_handle(file_path: str) -> bool:
-        """Проверяет, может ли обработчик работать с данным файлом"""
-        pass
-    
-    @staticmethod
-    @abstractmethod
-    def extract_text(file_path: str, parameters: Dict[str, Any]) -> str:
-        """Извлекает текст из файла согласно параметрам"""
-        pass
-    
-    @staticmethod
-    def get_file_extension(file_path: str) -> str:
-        """Возвращает расширение файла в нижнем регистре"""
-        return os.path.splitext(file_path)[1].lower()
+import os
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Any, Callable, List
+
+logger = logging.getLogger(__name__)
+
+class BaseFormatHandler(ABC):
+    """Базовый класс для обработчиков различных форматов файлов"""
+    
+    @staticmethod
+    @abstractmethod
+    def can_handle(file_path: str) -> bool:
+        """Проверяет, может ли обработчик работать с данным файлом"""
+        pass
+    
+    @staticmethod
+    @abstractmethod
+    def extract_text(file_path: str, parameters: Dict[str, Any]) -> str:
+        """Извлекает текст из файла согласно параметрам"""
+        pass
+    
+    @staticmethod
+    def get_file_extension(file_path: str) -> str:
+        """Возвращает расширение файла в нижнем регистре"""
+        return os.path.splitext(file_path)[1].lower()
+
+
+class DocumentCache:
+    """
+    Открытые документы текущего процесса по пути, размеру и mtime.
+    Текст и метаданные запрашиваются отдельными вызовами (иногда параллельно),
+    а документ открывается и разбирается один раз. Вытесненные документы закрываются
+    """
+
+    instances: List['DocumentCache'] = []
+
+    def __init__(self, opener: Callable[[str], Any], size: int = 4):
+        self.opener = opener
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        DocumentCache.instances.append(self)
+
+    def open(self, file_path: str) -> Any:
+        stat = os.stat(file_path)
+        key = (os.getpid(), os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+
+        with self._lock:
+            document = self._items.get(key)
+            if document is not None:
+                self._items.move_to_end(key)
+                return document
+
+        document = self.opener(file_path)
+        with self._lock:
+            if key in self._items:
+                document.close()
+                return self._items[key]
+            self._items[key] = document
+            while len(self._items) > self.size:
+                _, evicted = self._items.popitem(last=False)
+                evicted.close()
+        return document
+
+    def clear(self) -> None:
+        """Закрывает все документы кэша"""
+        with self._lock:
+            documents = list(self._items.values())
+            self._items.clear()
+        for document in documents:
+            try:
+                document.close()
+            except Exception as e:
+                logger.debug(f"Ошибка при закрытии документа: {e}")
+
+    @classmethod
+    def release_all(cls) -> None:
+        """Закрывает документы всех кэшей (перед удалением временного каталога архива)"""
+        for cache in cls.instances:
+            cache.clear()
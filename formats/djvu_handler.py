@@ -1,56 +1,149 @@
-﻿import os
-import logging
-import subprocess
-import tempfile
-from typing import Dict, Any
-from .base_handler import BaseFormatHandler
-
-logger = logging.getLogger(__name__)
-
-class DJVUHandler(BaseFormatHandler):
-    """Обработчик для DJVU файлов"""
-    
-    @staticmethod
-    def can_handle(file_path: str) -> bool:
-        return BaseFormatHandler.get_file_extension(file_path) == '.djvu'
-    
-    @staticmethod
-    def extract_text(file_path: str, parameters: Dict[str, Any]) -> str:
-        action_type = parameters.get('type', 'first_chars')
-        amount = parameters.get('amount', 500)
-
-        try:
-            # Пробуем использовать модуль djvu, если установлен
-            import djvu  # Если нет, переходим к OCR
-            # Здесь можно добавить прямое извлечение текста через djvu
-            return "DJVU модуль найден, текст извлечен."
-        except ImportError:
-            logger.warning("Модуль djvu не найден, используем OCR через pytesseract")
-            try:
-                from PIL import Image
-                from .ocr_utils import perform_ocr_images
-
-                with tempfile.TemporaryDirectory() as tmpdir:
-                    page_path = os.path.join(tmpdir, "page.png")
-                    # Конвертируем первый слой DJVU в PNG через ddjvu
-                    cmd = ['ddjvu', '-format=pnm', '-page=1', file_path, page_path]
-                    subprocess.run(cmd, check=True)
-                    img = Image.open(page_path)
-                    ocr_text = perform_ocr_images([img], lang='rus+eng', max_chars=amount if action_type == 'first_chars' else None)
-                    return ocr_text
-            except FileNotFoundError:
-                return "Ошибка: ddjvu не найден. Установите djvu tools."
-            except Exception as e:
-                logger.error(f"Ошибка при OCR DJVU {file_path}: {e}")
-                return f"Ошибка при OCR DJVU: {str(e)}"
-    
-    @staticmethod
-    def get_metadata(file_path: str) -> Dict[str, str]:
-        """Извлекает метаданные из DJVU (если поддерживается)"""
-        try:
-            import djvu
-            # Здесь можно добавить извлечение метаданных через djvu
-            return {}
-        except ImportError:
-            return {}
-
+﻿import re
+import logging
+import subprocess
+from typing import Dict, Any, Optional, List
+from tracing import span
+from .base_handler import BaseFormatHandler
+from config import DJVU_MAX_PAGES, DJVU_OCR_DPI, DJVU_TEXT_MIN_CHARS, OCR_PROBE_DPI, OCR_ADAPTIVE
+
+logger = logging.getLogger(__name__)
+
+# Ограничение времени вызова утилит DjVuLibre (djvused, djvutxt), с
+DJVU_TOOL_TIMEOUT = 60
+
+class DJVUHandler(BaseFormatHandler):
+    """Обработчик для DJVU файлов: текстовый слой через djvutxt, OCR только для страниц без него"""
+
+    @staticmethod
+    def can_handle(file_path: str) -> bool:
+        return BaseFormatHandler.get_file_extension(file_path) == '.djvu'
+
+    @staticmethod
+    def _run_tool(args: List[str]) -> str:
+        """Запускает утилиту DjVuLibre и возвращает stdout"""
+        with span(f'djvu.{args[0]}') as current:
+            result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    check=True, timeout=DJVU_TOOL_TIMEOUT)
+            current.set(bytes=len(result.stdout))
+        return result.stdout.decode('utf-8', errors='ignore')
+
+    @staticmethod
+    def get_page_count(file_path: str) -> Optional[int]:
+        """Число страниц (djvused -e n) или None, если определить не удалось"""
+        try:
+            return int(DJVUHandler._run_tool(['djvused', '-e', 'n', file_path]).strip())
+        except (OSError, ValueError, subprocess.SubprocessError) as e:
+            logger.debug(f"Не удалось определить число страниц DJVU {file_path}: {e}")
+            return None
+
+    @staticmethod
+    def get_page_text(file_path: str, page: int) -> Optional[str]:
+        """Текстовый слой страницы; None, если djvutxt недоступен"""
+        try:
+            return DJVUHandler._run_tool(['djvutxt', f'--page={page}', file_path]).strip()
+        except FileNotFoundError:
+            return None
+        except subprocess.SubprocessError as e:
+            logger.debug(f"Нет текстового слоя на странице {page} DJVU {file_path}: {e}")
+            return ''
+
+    @staticmethod
+    def extract_text(file_path: str, parameters: Dict[str, Any]) -> str:
+        action_type = parameters.get('type', 'first_chars')
+        amount = parameters.get('amount', 500)
+
+        if action_type == 'first_chars':
+            max_chars = amount
+            last_page = DJVU_MAX_PAGES
+        else:
+            max_chars = None
+            last_page = amount
+
+        page_count = DJVUHandler.get_page_count(file_path)
+        if page_count is not None:
+            last_page = min(last_page, page_count)
+
+        # Сначала текстовый слой: большинству DJVU OCR не нужен
+        pages_text = {}
+        missing_pages = []
+        total_chars = 0
+        for page in range(1, last_page + 1):
+            text = DJVUHandler.get_page_text(file_path, page)
+            if text is None:
+                logger.warning("djvutxt не найден, используем OCR")
+                missing_pages.extend(range(page, last_page + 1))
+                break
+            if len(text) >= DJVU_TEXT_MIN_CHARS:
+                pages_text[page] = text
+                total_chars += len(text)
+                if max_chars and total_chars >= max_chars:
+                    break
+            else:
+                missing_pages.append(page)
+
+        # OCR только страниц без текстового слоя и только пока не набран лимит
+        ocr_error = None
+        if missing_pages and not (max_chars and total_chars >= max_chars):
+            try:
+                from .ocr_utils import get_ocr_engine, iter_djvu_pages, choose_ocr_languages, probe_ocr_text
+
+                def render(page, dpi):
+                    return next(iter_djvu_pages(file_path, [page], dpi=dpi))
+
+                metadata = DJVUHandler.get_metadata(file_path)
+                lang = choose_ocr_languages(
+                    file_path,
+                    hints=[metadata.get(key, '') for key in ('title', 'author', 'subject')],
+                    text_sample="".join(pages_text.values()),
+                    probe=lambda: probe_ocr_text(render(missing_pages[0], OCR_PROBE_DPI))
+                )
+                if OCR_ADAPTIVE:
+                    ocr_pages = get_ocr_engine().iter_recognize_adaptive(render, missing_pages, lang=lang)
+                else:
+                    images = iter_djvu_pages(file_path, missing_pages, dpi=DJVU_OCR_DPI)
+                    ocr_pages = get_ocr_engine().iter_recognize(images, lang=lang)
+                try:
+                    for page, text in zip(missing_pages, ocr_pages):
+                        if text.startswith("Ошибка"):
+                            ocr_error = text
+                        elif text.strip():
+                            pages_text[page] = text.strip()
+                            total_chars += len(text)
+                            if max_chars and total_chars >= max_chars:
+                                break
+                finally:
+                    ocr_pages.close()
+            except FileNotFoundError:
+                if not pages_text:
+                    return "Ошибка: ddjvu не найден. Установите djvu tools."
+            except Exception as e:
+                logger.error(f"Ошибка при OCR DJVU {file_path}: {e}")
+                if not pages_text:
+                    return f"Ошибка при OCR DJVU: {str(e)}"
+
+        if not pages_text and ocr_error:
+            return ocr_error
+
+        full_text = "\n".join(pages_text[page] for page in sorted(pages_text))
+        if max_chars:
+            return full_text[:max_chars]
+        return full_text
+
+    @staticmethod
+    def get_metadata(file_path: str) -> Dict[str, str]:
+        """Извлекает метаданные DJVU (djvused print-meta) и число страниц"""
+        metadata = {}
+        try:
+            output = DJVUHandler._run_tool(['djvused', '-e', 'print-meta', file_path])
+            for line in output.splitlines():
+                match = re.match(r'^(\w+)\s+"(.*)"$', line.strip())
+                if match:
+                    metadata[match.group(1).lower()] = match.group(2).replace('\\"', '"')
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.debug(f"Не удалось прочитать метаданные DJVU {file_path}: {e}")
+            return {}
+
+        page_count = DJVUHandler.get_page_count(file_path)
+        if page_count:
+            metadata['pages'] = str(page_count)
+        return {k: v for k, v in metadata.items() if v}
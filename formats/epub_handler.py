@@ -1,262 +1,365 @@
-import os
-import logging
-import zipfile
-import xml.etree.ElementTree as ET
-from typing import Dict, Any
-from .base_handler import BaseFormatHandler
-
-logger = logging.getLogger(__name__)
-
-class EPUBHandler(BaseFormatHandler):
-    """Обработчик для EPUB файлов"""
-    
-    # Определяем пространства имен
-    CONTAINER_NS = {'ct': 'urn:oasis:names:tc:opendocument:xmlns:container'}
-    OPF_NS = {'opf': 'http://www.idpf.org/2007/opf'}
-    DC_NS = {'dc': 'http://purl.org/dc/elements/1.1/'}
-    
-    @staticmethod
-    def can_handle(file_path: str) -> bool:
-        return BaseFormatHandler.get_file_extension(file_path).lower() == '.epub'
-    
-    @staticmethod
-    def extract_text(file_path: str, parameters: Dict[str, Any]) -> str:
-        action_type = parameters.get('type', 'first_chars')
-        amount = parameters.get('amount', 1000)
-        
-        try:
-            text_content = EPUBHandler._extract_epub_text(file_path, amount)
-            
-            if text_content and len(text_content.strip()) > 100:
-                if action_type == 'first_chars':
-                    return text_content[:amount]
-                else:
-                    return text_content
-            
-            return EPUBHandler._extract_epub_fallback(file_path, amount)
-                
-        except Exception as e:
-            logger.error(f"Ошибка при обработке EPUB {file_path}: {e}")
-            return f"Ошибка при обработке EPUB: {str(e)}"
-    
-    @staticmethod
-    def _extract_epub_text(epub_path: str, max_chars: int = 5000) -> str:
-        """Извлекает текст из EPUB файла"""
-        text_parts = []
-        total_chars = 0
-        
-        try:
-            with zipfile.ZipFile(epub_path, 'r') as epub_zip:
-                file_list = epub_zip.namelist()
-                
-                # Ищем container.xml
-                container_path = next((f for f in file_list if f.endswith('container.xml')), None)
-                
-                if not container_path:
-                    return EPUBHandler._extract_epub_fallback(epub_path, max_chars)
-                
-                # Читаем container.xml
-                with epub_zip.open(container_path) as container_file:
-                    container_tree = ET.parse(container_file)
-                    rootfile = container_tree.find('.//ct:rootfile', EPUBHandler.CONTAINER_NS)
-                    
-                    if rootfile is None:
-                        return EPUBHandler._extract_epub_fallback(epub_path, max_chars)
-                    
-                    opf_path = rootfile.get('full-path', '')
-                    
-                    if not opf_path:
-                        return EPUBHandler._extract_epub_fallback(epub_path, max_chars)
-                    
-                    # Читаем OPF файл
-                    with epub_zip.open(opf_path) as opf_file:
-                        opf_tree = ET.parse(opf_file)
-                        manifest = opf_tree.find('.//opf:manifest', EPUBHandler.OPF_NS)
-                        
-                        if not manifest:
-                            return EPUBHandler._extract_epub_fallback(epub_path, max_chars)
-                        
-                        # Обрабатываем content файлы
-                        for item in manifest.findall('opf:item', EPUBHandler.OPF_NS):
-                            media_type = item.get('media-type', '')
-                            href = item.get('href', '')
-                            
-                            if media_type in ['application/xhtml+xml', 'text/html']:
-                                # Корректно формируем путь
-                                content_dir = os.path.dirname(opf_path)
-                                content_path = os.path.normpath(os.path.join(content_dir, href)) if content_dir else href
-                                
-                                if content_path not in file_list:
-                                    continue
-                                
-                                try:
-                                    with epub_zip.open(content_path) as content_file:
-                                        try:
-                                            # Пробуем парсить как XML
-                                            content_tree = ET.parse(content_file)
-                                            content_root = content_tree.getroot()
-                                            
-                                            # Рекурсивно извлекаем текст
-                                            def extract_text_from_element(elem):
-                                                nonlocal total_chars
-                                                if total_chars >= max_chars:
-                                                    return
-                                                
-                                                if elem.text and elem.text.strip():
-                                                    text = elem.text.strip()
-                                                    text_parts.append(text)
-                                                    total_chars += len(text)
-                                                
-                                                for child in elem:
-                                                    extract_text_from_element(child)
-                                                    
-                                                if elem.tail and elem.tail.strip():
-                                                    text = elem.tail.strip()
-                                                    text_parts.append(text)
-                                                    total_chars += len(text)
-                                            
-                                            extract_text_from_element(content_root)
-                                            
-                                        except ET.ParseError:
-                                            # Fallback: читаем как текст
-                                            content_file.seek(0)
-                                            text_content = content_file.read().decode('utf-8', errors='ignore')
-                                            # Упрощенное удаление тегов
-                                            import re
-                                            clean_text = re.sub('<[^<]+?>', ' ', text_content)
-                                            clean_text = re.sub('\s+', ' ', clean_text).strip()
-                                            if clean_text:
-                                                text_parts.append(clean_text)
-                                                total_chars += len(clean_text)
-                                                
-                                except Exception as e:
-                                    logger.debug(f"Не удалось прочитать файл {content_path}: {e}")
-                                    continue
-                                
-                                if total_chars >= max_chars:
-                                    break
-            
-            return " ".join(text_parts)[:max_chars]
-            
-        except Exception as e:
-            logger.error(f"Ошибка при извлечении текста из EPUB: {e}")
-            return EPUBHandler._extract_epub_fallback(epub_path, max_chars)
-    
-    @staticmethod
-    def _extract_epub_fallback(epub_path: str, max_chars: int = 5000) -> str:
-        """Простой fallback метод извлечения текста из EPUB"""
-        try:
-            with zipfile.ZipFile(epub_path, 'r') as epub_zip:
-                text_parts = []
-                total_chars = 0
-                
-                for file_name in epub_zip.namelist():
-                    if file_name.endswith(('.xhtml', '.html', '.xml', '.txt', '.htm')):
-                        try:
-                            with epub_zip.open(file_name) as file:
-                                content = file.read().decode('utf-8', errors='ignore')
-                                import re
-                                clean_text = re.sub('<[^<]+?>', ' ', content)
-                                clean_text = re.sub('\s+', ' ', clean_text).strip()
-                                
-                                if clean_text and len(clean_text) > 50:
-                                    text_parts.append(clean_text)
-                                    total_chars += len(clean_text)
-                                    
-                                if total_chars >= max_chars:
-                                    break
-                                    
-                        except Exception as e:
-                            logger.debug(f"Не удалось обработать файл {file_name}: {e}")
-                            continue
-                
-                result = ' '.join(text_parts)
-                return result[:max_chars] if result else "Не удалось извлечь текст из EPUB"
-                
-        except Exception as e:
-            return f"Ошибка при fallback обработке EPUB: {str(e)}"
-    
-    @staticmethod
-    def get_metadata(file_path: str) -> Dict[str, str]:
-        """Извлекает метаданные из EPUB"""
-        try:
-            metadata = {}
-            
-            with zipfile.ZipFile(file_path, 'r') as epub_zip:
-                # Ищем OPF файл
-                opf_path = next((f for f in epub_zip.namelist() if f.endswith('.opf')), None)
-                
-                if not opf_path:
-                    return {}
-                
-                with epub_zip.open(opf_path) as opf_file:
-                    opf_tree = ET.parse(opf_file)
-                    metadata_elem = opf_tree.find('.//opf:metadata', EPUBHandler.OPF_NS)
-                    
-                    if not metadata_elem:
-                        return {}
-                    
-                    # Объединяем пространства имен для поиска
-                    ns = {**EPUBHandler.OPF_NS, **EPUBHandler.DC_NS}
-                    
-                    def get_meta_value(tag):
-                        element = metadata_elem.find(f'.//dc:{tag}', ns)
-                        if element is not None and element.text:
-                            return element.text.strip()
-                        return ''
-                    
-                    metadata = {
-                        'title': get_meta_value('title'),
-                        'author': get_meta_value('creator'),
-                        'publisher': get_meta_value('publisher'),
-                        'date': get_meta_value('date'),
-                        'language': get_meta_value('language'),
-                        'identifier': get_meta_value('identifier'),
-                        'description': get_meta_value('description'),
-                        'subject': get_meta_value('subject')
-                    }
-            
-            return {k: v for k, v in metadata.items() if v}
-            
-        except Exception as e:
-            logger.error(f"Ошибка при извлечении метаданных EPUB: {e}")
-            return {}
-    
-    @staticmethod
-    def get_content_structure(file_path: str) -> Dict[str, Any]:
-        """Возвращает структуру содержимого EPUB"""
-        try:
-            structure = {
-                'chapters': [],
-                'toc': [],
-                'files': []
-            }
-            
-            with zipfile.ZipFile(file_path, 'r') as epub_zip:
-                structure['files'] = epub_zip.namelist()
-                
-                opf_path = next((f for f in epub_zip.namelist() if f.endswith('.opf')), None)
-                
-                if opf_path:
-                    with epub_zip.open(opf_path) as opf_file:
-                        opf_tree = ET.parse(opf_file)
-                        manifest = opf_tree.find('.//opf:manifest', EPUBHandler.OPF_NS)
-                        
-                        if manifest:
-                            for item in manifest.findall('opf:item', EPUBHandler.OPF_NS):
-                                media_type = item.get('media-type', '')
-                                href = item.get('href', '')
-                                id_attr = item.get('id', '')
-                                
-                                if media_type in ['application/xhtml+xml', 'text/html']:
-                                    structure['chapters'].append({
-                                        'id': id_attr,
-                                        'file': href,
-                                        'media_type': media_type
-                                    })
-            
-            return structure
-            
-        except Exception as e:
-            logger.error(f"Ошибка при получении структуры EPUB: {e}")
-            return {'error': str(e)}
+import re
+import codecs
+import logging
+import zipfile
+import posixpath
+import threading
+import xml.etree.ElementTree as ET
+from html.parser import HTMLParser
+from urllib.parse import unquote
+from typing import Dict, Any, List, Optional, Iterator
+from .base_handler import BaseFormatHandler, DocumentCache
+
+logger = logging.getLogger(__name__)
+
+# Сколько открытых EPUB держать в памяти (текст и метаданные запрашиваются отдельными вызовами)
+READER_CACHE_SIZE = 4
+
+# Размер блока при потоковом чтении XHTML
+READ_CHUNK_SIZE = 64 * 1024
+
+CONTENT_MEDIA_TYPES = ['application/xhtml+xml', 'text/html']
+
+
+class _TextCollector(HTMLParser):
+    """
+    Потоковый сборщик текста XHTML: принимает документ блоками через feed()
+    и собирает абзацы, пока не наберется max_chars символов
+    """
+
+    SKIP_TAGS = {'head', 'script', 'style', 'title'}
+    BLOCK_TAGS = {'p', 'div', 'br', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+                  'blockquote', 'pre', 'section', 'dd', 'dt'}
+
+    def __init__(self, paragraphs: List[str], max_chars: int, total_chars: int = 0):
+        super().__init__(convert_charrefs=True)
+        self.paragraphs = paragraphs
+        self.max_chars = max_chars
+        self.total_chars = total_chars
+        self.skip_depth = 0
+        self.current = []
+
+    @property
+    def done(self) -> bool:
+        return self.total_chars >= self.max_chars
+
+    def _flush(self):
+        text = ' '.join(' '.join(self.current).split())
+        self.current = []
+        if text:
+            self.paragraphs.append(text)
+            self.total_chars += len(text) + 1
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self._flush()
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS:
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in self.BLOCK_TAGS:
+            self._flush()
+
+    def handle_data(self, data):
+        if not self.skip_depth and not self.done:
+            self.current.append(data)
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+class EPUBReader:
+    """
+    Разобранный EPUB: ZIP открывается один раз, container.xml и OPF разбираются
+    при открытии. Текст, метаданные и структура строятся из общего состояния,
+    главы читаются лениво в порядке spine
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        self.zip = zipfile.ZipFile(file_path, 'r')
+        try:
+            self.names = self.zip.namelist()
+            self._name_set = set(self.names)
+            self.opf_path = self._find_opf()
+            self.manifest: Dict[str, Dict[str, str]] = {}
+            self.spine: List[str] = []
+            self.toc_id = ''
+            self._metadata_elem = None
+            if self.opf_path:
+                self._parse_opf()
+        except Exception:
+            self.zip.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self) -> None:
+        self.zip.close()
+
+    def _find_opf(self) -> Optional[str]:
+        """Путь к OPF по container.xml (или первый .opf, если container.xml некорректен)"""
+        if 'META-INF/container.xml' in self._name_set:
+            try:
+                with self.zip.open('META-INF/container.xml') as container_file:
+                    rootfile = ET.parse(container_file).find('.//ct:rootfile', EPUBHandler.CONTAINER_NS)
+                if rootfile is not None and rootfile.get('full-path') in self._name_set:
+                    return rootfile.get('full-path')
+            except ET.ParseError as e:
+                logger.debug(f"Некорректный container.xml в {self.file_path}: {e}")
+        return next((name for name in self.names if name.lower().endswith('.opf')), None)
+
+    def resolve(self, href: str) -> str:
+        """Путь внутри ZIP для ссылки из OPF (относительно каталога OPF)"""
+        href = unquote(href.split('#', 1)[0])
+        base = posixpath.dirname(self.opf_path or '')
+        return posixpath.normpath(posixpath.join(base, href)) if base else posixpath.normpath(href)
+
+    def _parse_opf(self) -> None:
+        with self.zip.open(self.opf_path) as opf_file:
+            root = ET.parse(opf_file).getroot()
+
+        ns = EPUBHandler.OPF_NS
+        self._metadata_elem = root.find('opf:metadata', ns)
+
+        manifest = root.find('opf:manifest', ns)
+        if manifest is not None:
+            for item in manifest.findall('opf:item', ns):
+                self.manifest[item.get('id', '')] = {
+                    'href': item.get('href', ''),
+                    'media_type': item.get('media-type', ''),
+                    'properties': item.get('properties', '')
+                }
+
+        spine = root.find('opf:spine', ns)
+        if spine is not None:
+            self.toc_id = spine.get('toc', '')
+            itemrefs = spine.findall('opf:itemref', ns)
+            # Основной поток чтения, затем вспомогательные (linear="no") документы
+            linear = [i for i in itemrefs if i.get('linear', 'yes') != 'no']
+            auxiliary = [i for i in itemrefs if i.get('linear', 'yes') == 'no']
+            self.spine = [i.get('idref', '') for i in linear + auxiliary if i.get('idref') in self.manifest]
+
+        if not self.spine:
+            # Без spine читаем документы в порядке манифеста
+            self.spine = [item_id for item_id, item in self.manifest.items()
+                          if item['media_type'] in CONTENT_MEDIA_TYPES]
+
+    def iter_documents(self) -> Iterator[str]:
+        """Пути документов в порядке чтения"""
+        for item_id in self.spine:
+            item = self.manifest[item_id]
+            if item['media_type'] not in CONTENT_MEDIA_TYPES:
+                continue
+            path = self.resolve(item['href'])
+            if path in self._name_set:
+                yield path
+
+    def extract_text(self, max_chars: int) -> str:
+        """Текст глав в порядке spine; чтение прекращается, как только набрано max_chars символов"""
+        paragraphs = []
+        total_chars = 0
+
+        for path in self.iter_documents():
+            collector = _TextCollector(paragraphs, max_chars, total_chars)
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+            try:
+                with self._lock, self.zip.open(path) as content_file:
+                    for chunk in iter(lambda: content_file.read(READ_CHUNK_SIZE), b''):
+                        collector.feed(decoder.decode(chunk))
+                        if collector.done:
+                            break
+                    collector.feed(decoder.decode(b'', final=True))
+                    collector.close()
+            except Exception as e:
+                logger.debug(f"Не удалось прочитать файл {path}: {e}")
+            total_chars = collector.total_chars
+            if total_chars >= max_chars:
+                break
+
+        return "\n".join(paragraphs)[:max_chars]
+
+    def get_metadata(self) -> Dict[str, str]:
+        """Метаданные Dublin Core из OPF"""
+        if self._metadata_elem is None:
+            return {}
+
+        ns = {**EPUBHandler.OPF_NS, **EPUBHandler.DC_NS}
+
+        def get_meta_values(tag):
+            return [e.text.strip() for e in self._metadata_elem.findall(f'dc:{tag}', ns)
+                    if e.text and e.text.strip()]
+
+        def get_meta_value(tag):
+            values = get_meta_values(tag)
+            return values[0] if values else ''
+
+        metadata = {
+            'title': get_meta_value('title'),
+            'author': ', '.join(get_meta_values('creator')),
+            'publisher': get_meta_value('publisher'),
+            'date': get_meta_value('date'),
+            'language': get_meta_value('language'),
+            'identifier': get_meta_value('identifier'),
+            'description': ' '.join(re.sub('<[^<]+?>', ' ', get_meta_value('description')).split()),
+            'subject': ', '.join(get_meta_values('subject'))
+        }
+
+        # Серия: calibre:series (EPUB 2) или belongs-to-collection (EPUB 3)
+        for meta in self._metadata_elem.findall('opf:meta', ns):
+            if meta.get('name') == 'calibre:series' and meta.get('content'):
+                metadata['series'] = meta.get('content').strip()
+            elif meta.get('property') == 'belongs-to-collection' and meta.text:
+                metadata['series'] = meta.text.strip()
+
+        return {k: v for k, v in metadata.items() if v}
+
+    def _read_toc(self) -> List[Dict[str, str]]:
+        """Оглавление из NCX (EPUB 2)"""
+        ncx = self.manifest.get(self.toc_id)
+        if not ncx:
+            ncx = next((item for item in self.manifest.values()
+                        if item['media_type'] == 'application/x-dtbncx+xml'), None)
+        if not ncx or self.resolve(ncx['href']) not in self._name_set:
+            return []
+
+        toc = []
+        with self._lock, self.zip.open(self.resolve(ncx['href'])) as ncx_file:
+            for nav_point in ET.parse(ncx_file).getroot().iter(f"{{{EPUBHandler.NCX_NS}}}navPoint"):
+                label = nav_point.find(f"{{{EPUBHandler.NCX_NS}}}navLabel")
+                content = nav_point.find(f"{{{EPUBHandler.NCX_NS}}}content")
+                toc.append({
+                    'title': ' '.join(''.join(label.itertext()).split()) if label is not None else '',
+                    'file': content.get('src', '') if content is not None else ''
+                })
+        return toc
+
+    def get_content_structure(self) -> Dict[str, Any]:
+        """Главы в порядке чтения, оглавление и список файлов"""
+        chapters = []
+        for item_id in self.spine:
+            item = self.manifest[item_id]
+            if item['media_type'] in CONTENT_MEDIA_TYPES:
+                chapters.append({'id': item_id, 'file': item['href'], 'media_type': item['media_type']})
+
+        try:
+            toc = self._read_toc()
+        except Exception as e:
+            logger.debug(f"Не удалось прочитать оглавление {self.file_path}: {e}")
+            toc = []
+
+        return {'chapters': chapters, 'toc': toc, 'files': list(self.names)}
+
+
+_readers = DocumentCache(EPUBReader, READER_CACHE_SIZE)
+
+
+def open_epub(file_path: str) -> EPUBReader:
+    """Разобранный EPUB из кэша процесса, чтобы текст, метаданные и структура не разбирали OPF повторно"""
+    return _readers.open(file_path)
+
+
+class EPUBHandler(BaseFormatHandler):
+    """Обработчик для EPUB файлов"""
+
+    # Определяем пространства имен
+    CONTAINER_NS = {'ct': 'urn:oasis:names:tc:opendocument:xmlns:container'}
+    OPF_NS = {'opf': 'http://www.idpf.org/2007/opf'}
+    DC_NS = {'dc': 'http://purl.org/dc/elements/1.1/'}
+    NCX_NS = 'http://www.daisy.org/z3986/2005/ncx/'
+
+    @staticmethod
+    def can_handle(file_path: str) -> bool:
+        return BaseFormatHandler.get_file_extension(file_path).lower() == '.epub'
+
+    @staticmethod
+    def extract_text(file_path: str, parameters: Dict[str, Any]) -> str:
+        amount = parameters.get('amount', 1000)
+
+        try:
+            text_content = EPUBHandler._extract_epub_text(file_path, amount)
+
+            if text_content and len(text_content.strip()) > 100:
+                return text_content
+
+            return EPUBHandler._extract_epub_fallback(file_path, amount)
+
+        except Exception as e:
+            logger.error(f"Ошибка при обработке EPUB {file_path}: {e}")
+            return f"Ошибка при обработке EPUB: {str(e)}"
+
+    @staticmethod
+    def _extract_epub_text(epub_path: str, max_chars: int = 5000) -> str:
+        """Извлекает текст из EPUB файла в порядке чтения (spine)"""
+        try:
+            reader = open_epub(epub_path)
+            if not reader.opf_path:
+                return EPUBHandler._extract_epub_fallback(epub_path, max_chars)
+            return reader.extract_text(max_chars)
+
+        except Exception as e:
+            logger.error(f"Ошибка при извлечении текста из EPUB: {e}")
+            return EPUBHandler._extract_epub_fallback(epub_path, max_chars)
+
+    @staticmethod
+    def _extract_epub_fallback(epub_path: str, max_chars: int = 5000) -> str:
+        """Простой fallback метод извлечения текста из EPUB"""
+        try:
+            with zipfile.ZipFile(epub_path, 'r') as epub_zip:
+                text_parts = []
+                total_chars = 0
+
+                for file_name in epub_zip.namelist():
+                    if file_name.endswith(('.xhtml', '.html', '.xml', '.txt', '.htm')):
+                        try:
+                            with epub_zip.open(file_name) as file:
+                                content = file.read().decode('utf-8', errors='ignore')
+                                clean_text = re.sub('<[^<]+?>', ' ', content)
+                                clean_text = re.sub(r'\s+', ' ', clean_text).strip()
+
+                                if clean_text and len(clean_text) > 50:
+                                    text_parts.append(clean_text)
+                                    total_chars += len(clean_text)
+
+                                if total_chars >= max_chars:
+                                    break
+
+                        except Exception as e:
+                            logger.debug(f"Не удалось обработать файл {file_name}: {e}")
+                            continue
+
+                result = ' '.join(text_parts)
+                return result[:max_chars] if result else "Не удалось извлечь текст из EPUB"
+
+        except Exception as e:
+            return f"Ошибка при fallback обработке EPUB: {str(e)}"
+
+    @staticmethod
+    def get_metadata(file_path: str) -> Dict[str, str]:
+        """Извлекает метаданные из EPUB"""
+        try:
+            return open_epub(file_path).get_metadata()
+        except Exception as e:
+            logger.error(f"Ошибка при извлечении метаданных EPUB: {e}")
+            return {}
+
+    @staticmethod
+    def get_content_structure(file_path: str) -> Dict[str, Any]:
+        """Возвращает структуру содержимого EPUB"""
+        try:
+            return open_epub(file_path).get_content_structure()
+        except Exception as e:
+            logger.error(f"Ошибка при получении структуры EPUB: {e}")
+            return {'error': str(e)}
@@ -1,51 +1,151 @@
-import xml.etree.ElementTree as ET
-from .base_handler import BaseFormatHandler
-from typing import Dict, Any
-
-class FB2Handler(BaseFormatHandler):
-    """Обработчик для FB2 файлов"""
-    
-    @staticmethod
-    def can_handle(file_path: str) -> bool:
-        return BaseFormatHandler.get_file_extension(file_path) == '.fb2'
-    
-    @staticmethod
-    def extract_text(file_path: str, parameters: Dict[str, Any]) -> str:
-        action_type = parameters.get('type', 'first_chars')
-        amount = parameters.get('amount', 500)
-        
-        try:
-            tree = ET.parse(file_path)
-            root = tree.getroot()
-            
-            # namespace для FB2
-            ns = {'fb': 'http://www.gribuser.ru/xml/fictionbook/2.0'}
-            
-            # Извлекаем заголовок
-            title = root.find('.//fb:book-title', ns)
-            title_text = title.text if title is not None else "Без названия"
-            
-            # Извлекаем основной текст
-            body = root.find('.//fb:body', ns)
-            text_content = []
-            if body is not None:
-                for elem in body.iter():
-                    if elem.text and elem.tag.endswith('}p'):  # параграфы
-                        text_content.append(elem.text)
-            
-            full_text = f"{title_text}\n\n" + "\n".join(text_content)
-            
-            if action_type == 'first_chars':
-                return full_text[:amount]
-            else:
-                return full_text
-                
-        except ET.ParseError:
-            # Если XML parsing fails, пробуем прочитать как plain text
-            try:
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    return f.read(amount)
-            except Exception as e:
-                return f"Ошибка при обработке FB2 файла: {str(e)}"
-        except Exception as e:
-            return f"Ошибка при обработке FB2 файла: {str(e)}"
+import logging
+import xml.etree.ElementTree as ET
+from .base_handler import BaseFormatHandler
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class FB2Handler(BaseFormatHandler):
+    """Обработчик для FB2 файлов"""
+
+    @staticmethod
+    def can_handle(file_path: str) -> bool:
+        return BaseFormatHandler.get_file_extension(file_path) == '.fb2'
+
+    @staticmethod
+    def _iterparse(file_path: str) -> Iterator[Tuple[str, str, ET.Element, List[str]]]:
+        """
+        Потоковый разбор FB2: выдает (событие, тег без namespace, элемент, путь из тегов).
+        Разобранные элементы очищаются, содержимое <binary> (обложки в base64) не накапливается
+        """
+        path = []
+        for event, elem in ET.iterparse(file_path, events=('start', 'end')):
+            tag = elem.tag.rsplit('}', 1)[-1]
+            if event == 'start':
+                path.append(tag)
+                yield event, tag, elem, path
+            else:
+                yield event, tag, elem, path
+                path.pop()
+                if tag == 'binary' or (tag in ('p', 'v', 'section') and 'body' in path):
+                    elem.clear()
+
+    @staticmethod
+    def _element_text(elem: ET.Element) -> str:
+        """Текст элемента вместе с вложенной разметкой (<emphasis>, <strong> и т.п.)"""
+        return ''.join(elem.itertext()).strip()
+
+    @staticmethod
+    def extract_text(file_path: str, parameters: Dict[str, Any]) -> str:
+        action_type = parameters.get('type', 'first_chars')
+        amount = parameters.get('amount', 500)
+        # Для first_pages (страниц в FB2 нет) возвращается весь текст основного тела
+        limit = amount if action_type == 'first_chars' else None
+
+        title_text = None
+        text_content = []
+        total_chars = 0
+        in_body = False
+
+        try:
+            for event, tag, elem, path in FB2Handler._iterparse(file_path):
+                if event == 'start':
+                    if tag == 'body':
+                        in_body = True
+                    continue
+
+                if tag == 'book-title' and title_text is None and 'title-info' in path:
+                    title_text = FB2Handler._element_text(elem)
+                elif tag == 'p' and in_body:
+                    paragraph = FB2Handler._element_text(elem)
+                    if paragraph:
+                        text_content.append(paragraph)
+                        total_chars += len(paragraph) + 1
+                        if limit and total_chars >= limit:
+                            break
+                elif tag == 'body':
+                    # Следующие <body> - примечания и комментарии
+                    break
+
+        except ET.ParseError as e:
+            if not text_content:
+                # Если XML parsing fails, пробуем прочитать как plain text
+                try:
+                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                        return f.read(amount)
+                except Exception as e:
+                    return f"Ошибка при обработке FB2 файла: {str(e)}"
+            # Поврежденный конец файла не мешает использовать уже прочитанный текст
+            logger.warning(f"FB2 {file_path} поврежден, используем прочитанную часть: {e}")
+        except Exception as e:
+            return f"Ошибка при обработке FB2 файла: {str(e)}"
+
+        full_text = f"{title_text or 'Без названия'}\n\n" + "\n".join(text_content)
+
+        if limit:
+            return full_text[:limit]
+        return full_text
+
+    @staticmethod
+    def get_metadata(file_path: str) -> Dict[str, str]:
+        """Извлекает метаданные из <description> (разбор прекращается до начала текста книги)"""
+        metadata = {}
+        authors = []
+        genres = []
+        author_parts: Optional[Dict[str, str]] = None
+
+        try:
+            for event, tag, elem, path in FB2Handler._iterparse(file_path):
+                if event == 'start':
+                    if tag == 'body':
+                        break
+                    if tag == 'author' and path[-2:-1] == ['title-info']:
+                        author_parts = {}
+                    elif tag == 'sequence' and 'title-info' in path and 'series' not in metadata:
+                        name = elem.get('name', '').strip()
+                        if name:
+                            number = elem.get('number', '').strip()
+                            metadata['series'] = f"{name} #{number}" if number else name
+                    continue
+
+                if 'title-info' in path:
+                    parent = path[-2] if len(path) > 1 else ''
+                    if author_parts is not None and parent == 'author':
+                        author_parts[tag] = FB2Handler._element_text(elem)
+                    elif tag == 'author' and author_parts is not None:
+                        name = ' '.join(author_parts.get(part, '') for part in
+                                        ('first-name', 'middle-name', 'last-name')).split()
+                        author = ' '.join(name) or author_parts.get('nickname', '')
+                        if author:
+                            authors.append(author)
+                        author_parts = None
+                    elif tag == 'book-title':
+                        metadata['title'] = FB2Handler._element_text(elem)
+                    elif tag == 'annotation':
+                        metadata['description'] = ' '.join(FB2Handler._element_text(elem).split())
+                    elif tag == 'genre':
+                        genres.append(FB2Handler._element_text(elem))
+                    elif tag == 'date' and parent == 'title-info':
+                        metadata['date'] = elem.get('value') or FB2Handler._element_text(elem)
+                    elif tag == 'lang' and parent == 'title-info':
+                        metadata['language'] = FB2Handler._element_text(elem)
+                elif 'publish-info' in path:
+                    if tag == 'publisher':
+                        metadata['publisher'] = FB2Handler._element_text(elem)
+                    elif tag == 'year':
+                        metadata['year'] = FB2Handler._element_text(elem)
+
+                if tag == 'description':
+                    break
+
+        except ET.ParseError as e:
+            logger.warning(f"Ошибка разбора метаданных FB2 {file_path}: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка при извлечении метаданных FB2: {e}")
+            return {}
+
+        if authors:
+            metadata['author'] = ', '.join(authors)
+        if genres:
+            metadata['subject'] = ', '.join(g for g in genres if g)
+        return {k: v for k, v in metadata.items() if v}
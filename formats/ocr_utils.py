@@ -1,39 +1,817 @@
-import logging
-from typing import Optional
-
-try:
-    import pytesseract
-    from PIL import Image
-except ImportError:
-    pytesseract = None
-    Image = None
-
-logger = logging.getLogger(__name__)
-
-def perform_ocr_image(img: 'Image.Image', lang: str = 'rus+eng') -> str:
-    """Выполняет OCR для одного изображения"""
-    if not pytesseract or not Image:
-        return "Ошибка: pytesseract и pillow должны быть установлены для OCR."
-    try:
-        return pytesseract.image_to_string(img, lang=lang)
-    except Exception as e:
-        logger.error(f"Ошибка при OCR изображения: {e}")
-        return f"Ошибка при OCR изображения: {str(e)}"
-
-def perform_ocr_images(images: list, lang: str = 'rus+eng', max_chars: Optional[int] = None) -> str:
-    """OCR для списка изображений с ограничением символов"""
-    text_parts = []
-    total_chars = 0
-
-    for img in images:
-        page_text = perform_ocr_image(img, lang)
-        if page_text:
-            text_parts.append(page_text)
-            total_chars += len(page_text)
-            if max_chars and total_chars >= max_chars:
-                break
-
-    full_text = "\n".join(text_parts)
-    if max_chars:
-        return full_text[:max_chars]
-    return full_text
+import io
+import os
+import re
+import atexit
+import shutil
+import threading
+import subprocess
+import logging
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Optional, Iterable, Iterator, Dict, Any, Callable, List, Sequence, Tuple
+from tracing import span
+from config import OCR_WORKERS, OCR_PAGE_TIMEOUT, OCR_BACKEND, OCR_PREPROCESS, OCR_TARGET_DPI, \
+    OCR_MAX_DIMENSION, OCR_CROP_MARGINS, OCR_MARGIN_THRESHOLD, OCR_BINARIZE, OCR_LANGUAGES, \
+    OCR_DEFAULT_LANGUAGES, OCR_EXTRA_LANGUAGES, OCR_PROBE_DPI, OCR_DPI_STEPS, OCR_MIN_CONFIDENCE, \
+    OCR_JUNK_CONFIDENCE, OCR_PICTURE_MAX_WORDS
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+# Поля вокруг найденного содержимого после обрезки (tesseract хуже распознает текст у самого края), пикс.
+CROP_PADDING = 10
+
+# Строка или столбец считаются содержимым, если в них не меньше этой доли темных пикселей
+# (отдельные точки - шум) и не больше MAX_CONTENT_SHARE (сплошная темная кромка скана)
+MIN_CONTENT_SHARE = 0.002
+MAX_CONTENT_SHARE = 0.95
+
+
+def preprocessing_options(**overrides) -> Dict[str, Any]:
+    """Параметры подготовки изображений (из config.py с заменой отдельных значений)"""
+    options = {
+        'enabled': OCR_PREPROCESS,
+        'target_dpi': OCR_TARGET_DPI,
+        'max_dimension': OCR_MAX_DIMENSION,
+        'crop_margins': OCR_CROP_MARGINS,
+        'margin_threshold': OCR_MARGIN_THRESHOLD,
+        'binarize': OCR_BINARIZE,
+    }
+    options.update(overrides)
+    return options
+
+
+def _target_scale(size: tuple, dpi: Optional[tuple], options: Dict[str, Any]) -> float:
+    """
+    Коэффициент уменьшения: до target_dpi (если DPI известен) и не больше max_dimension
+    по длинной стороне (снимки камер помечены 72 или 96 dpi при огромном размере)
+    """
+    scale = min(1.0, options['max_dimension'] / max(size))
+    if dpi and dpi[0]:
+        scale = min(scale, options['target_dpi'] / float(dpi[0]))
+    return scale
+
+
+def _content_box(gray: 'Image.Image', threshold: int) -> Optional[tuple]:
+    """Границы содержимого страницы (left, top, right, bottom); None для пустой страницы"""
+    if numpy is None:
+        return gray.point(lambda value: 255 if value < threshold else 0).getbbox()
+
+    dark = numpy.asarray(gray) < threshold
+    height, width = dark.shape
+    row_counts = dark.sum(axis=1)
+    col_counts = dark.sum(axis=0)
+    rows = numpy.flatnonzero((row_counts >= max(1, width * MIN_CONTENT_SHARE)) &
+                             (row_counts <= width * MAX_CONTENT_SHARE))
+    cols = numpy.flatnonzero((col_counts >= max(1, height * MIN_CONTENT_SHARE)) &
+                             (col_counts <= height * MAX_CONTENT_SHARE))
+    if not rows.size or not cols.size:
+        return None
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+def _otsu_threshold(gray: 'Image.Image') -> int:
+    """Порог бинаризации по методу Оцу (по гистограмме, без обхода пикселей)"""
+    histogram = gray.histogram()
+    total = sum(histogram)
+    weighted_total = sum(value * count for value, count in enumerate(histogram))
+    background = weighted_background = 0
+    best_threshold, best_variance = 127, -1.0
+    for value, count in enumerate(histogram):
+        background += count
+        if background == 0:
+            continue
+        foreground = total - background
+        if foreground == 0:
+            break
+        weighted_background += value * count
+        mean_background = weighted_background / background
+        mean_foreground = (weighted_total - weighted_background) / foreground
+        variance = background * foreground * (mean_background - mean_foreground) ** 2
+        if variance > best_variance:
+            best_threshold, best_variance = value, variance
+    return best_threshold
+
+
+def preprocess_image(img: 'Image.Image', options: Optional[Dict[str, Any]] = None) -> Optional['Image.Image']:
+    """
+    Готовит изображение к OCR: оттенки серого, уменьшение до target_dpi (DPI берется
+    из img.info['dpi']), обрезка пустых полей и, если включено, бинаризация.
+    Возвращает None для пустой страницы (распознавать нечего)
+    """
+    options = options or preprocessing_options()
+    if not options['enabled']:
+        return img
+
+    dpi = img.info.get('dpi')
+    gray = img if img.mode == 'L' else img.convert('L')
+
+    scale = _target_scale(gray.size, dpi, options)
+    if scale < 0.95:
+        size = (max(1, round(gray.width * scale)), max(1, round(gray.height * scale)))
+        gray = gray.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+        dpi = (dpi[0] * scale, dpi[1] * scale) if dpi else None
+
+    if options['crop_margins']:
+        box = _content_box(gray, options['margin_threshold'])
+        if box is None:
+            return None
+        left, top, right, bottom = box
+        gray = gray.crop((max(0, left - CROP_PADDING), max(0, top - CROP_PADDING),
+                          min(gray.width, right + CROP_PADDING), min(gray.height, bottom + CROP_PADDING)))
+
+    if options['binarize']:
+        threshold = _otsu_threshold(gray)
+        gray = gray.point(lambda value: 255 if value > threshold else 0, mode='1')
+
+    if dpi:
+        gray.info['dpi'] = dpi
+    return gray
+
+
+def open_image_for_ocr(file_path: str, options: Optional[Dict[str, Any]] = None) -> 'Image.Image':
+    """
+    Открывает изображение для OCR. JPEG декодируется в режиме draft: сразу в оттенках
+    серого и с уменьшением в 2/4/8 раз, если разрешение больше нужного
+    """
+    options = options or preprocessing_options()
+    img = Image.open(file_path)
+    if img.format == 'JPEG' and options['enabled']:
+        dpi = img.info.get('dpi')
+        scale = _target_scale(img.size, dpi, options)
+        width = img.width
+        img.draft('L', (max(1, int(img.width * scale)), max(1, int(img.height * scale))))
+        if dpi and img.width != width:
+            factor = img.width / width
+            img.info['dpi'] = (dpi[0] * factor, dpi[1] * factor)
+    return img
+
+
+class TesserocrBackend:
+    """
+    tesserocr (C API tesseract): движок с загруженными языковыми моделями создается
+    один раз на процесс и язык и распознает изображения прямо из памяти
+    """
+
+    name = 'tesserocr'
+    module = 'tesserocr'
+
+    def __init__(self):
+        self._apis = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def available() -> bool:
+        return tesserocr is not None
+
+    def _run(self, img: 'Image.Image', lang: str, timeout: Optional[float]):
+        """Распознает изображение движком для lang (вызывается под self._lock)"""
+        api = self._apis.get(lang)
+        if api is None:
+            api = self._apis[lang] = tesserocr.PyTessBaseAPI(lang=lang)
+        api.SetImage(img)
+        if not api.Recognize(int(timeout * 1000) if timeout else 0):
+            raise RuntimeError(f"распознавание не уложилось в {timeout} с")
+        return api
+
+    def recognize(self, img: 'Image.Image', lang: str, timeout: Optional[float] = None) -> str:
+        with self._lock:
+            return self._run(img, lang, timeout).GetUTF8Text()
+
+    def recognize_data(self, img: 'Image.Image', lang: str,
+                       timeout: Optional[float] = None) -> Tuple[str, List[Tuple[str, float]]]:
+        with self._lock:
+            api = self._run(img, lang, timeout)
+            return api.GetUTF8Text(), api.MapWordConfidences()
+
+    def close(self) -> None:
+        with self._lock:
+            for api in self._apis.values():
+                api.End()
+            self._apis = {}
+
+
+class TesseractCLIBackend:
+    """
+    Утилита tesseract: изображение передается через stdin, текст читается из stdout,
+    без временных файлов (языковые модели загружаются при каждом вызове)
+    """
+
+    name = 'tesseract'
+    module = None
+
+    @staticmethod
+    def command() -> str:
+        # Путь, заданный для pytesseract (обычно под Windows), подходит и здесь
+        return pytesseract.pytesseract.tesseract_cmd if pytesseract is not None else 'tesseract'
+
+    @staticmethod
+    def available() -> bool:
+        return shutil.which(TesseractCLIBackend.command()) is not None
+
+    def _run(self, img: 'Image.Image', lang: str, timeout: Optional[float], *configs: str) -> str:
+        # PNM не сжимается, поэтому кодируется быстрее PNG
+        if img.mode not in ('1', 'L', 'RGB'):
+            img = img.convert('RGB')
+        buffer = io.BytesIO()
+        img.save(buffer, format='PPM')
+        result = subprocess.run(
+            [self.command(), 'stdin', 'stdout', '-l', lang, *configs],
+            input=buffer.getvalue(), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            check=True, timeout=timeout or None
+        )
+        return result.stdout.decode('utf-8', errors='ignore')
+
+    def recognize(self, img: 'Image.Image', lang: str, timeout: Optional[float] = None) -> str:
+        return self._run(img, lang, timeout)
+
+    def recognize_data(self, img: 'Image.Image', lang: str,
+                       timeout: Optional[float] = None) -> Tuple[str, List[Tuple[str, float]]]:
+        return parse_tsv(self._run(img, lang, timeout, 'tsv'))
+
+    def close(self) -> None:
+        pass
+
+
+class PytesseractBackend:
+    """pytesseract: отдельный процесс tesseract и временные файлы на каждое изображение"""
+
+    name = 'pytesseract'
+    module = 'pytesseract'
+
+    @staticmethod
+    def available() -> bool:
+        return pytesseract is not None
+
+    def recognize(self, img: 'Image.Image', lang: str, timeout: Optional[float] = None) -> str:
+        return pytesseract.image_to_string(img, lang=lang, timeout=timeout or 0)
+
+    def recognize_data(self, img: 'Image.Image', lang: str,
+                       timeout: Optional[float] = None) -> Tuple[str, List[Tuple[str, float]]]:
+        return parse_tsv(pytesseract.image_to_data(img, lang=lang, timeout=timeout or 0))
+
+    def close(self) -> None:
+        pass
+
+
+def parse_tsv(tsv: str) -> Tuple[str, List[Tuple[str, float]]]:
+    """
+    Разбирает вывод tesseract в формате TSV (image_to_data): текст, собранный по строкам
+    и абзацам, и список (слово, уверенность 0-100)
+    """
+    words = []
+    lines = []
+    current_line = current_paragraph = None
+    for row in tsv.splitlines()[1:]:
+        columns = row.split('\t')
+        if len(columns) < 12 or columns[0] != '5' or not columns[11].strip():
+            continue
+        try:
+            confidence = float(columns[10])
+        except ValueError:
+            continue
+        if confidence < 0:
+            continue
+        paragraph = tuple(columns[1:4])
+        line = paragraph + (columns[4],)
+        if line != current_line:
+            if current_paragraph is not None and paragraph != current_paragraph:
+                lines.append('')
+            lines.append(columns[11])
+            current_line, current_paragraph = line, paragraph
+        else:
+            lines[-1] += ' ' + columns[11]
+        words.append((columns[11], confidence))
+    return '\n'.join(lines), words
+
+
+# Бэкенды OCR в порядке предпочтения для OCR_BACKEND = 'auto'
+OCR_BACKENDS = {
+    TesserocrBackend.name: TesserocrBackend,
+    TesseractCLIBackend.name: TesseractCLIBackend,
+    PytesseractBackend.name: PytesseractBackend,
+}
+
+# Бэкенды текущего процесса: (pid, имя) -> экземпляр (None - бэкенд недоступен)
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_ocr_backend(name: Optional[str] = None):
+    """
+    Бэкенд OCR текущего процесса (создается один раз и переиспользуется для всех страниц).
+    'auto' - первый доступный из OCR_BACKENDS; None, если доступных нет
+    """
+    name = name or OCR_BACKEND
+    key = (os.getpid(), name)
+    with _backends_lock:
+        if key in _backends:
+            return _backends[key]
+
+        backend = None
+        candidates = list(OCR_BACKENDS) if name == 'auto' else [name]
+        for candidate in candidates:
+            backend_class = OCR_BACKENDS.get(candidate)
+            if backend_class is None:
+                logger.error(f"Неизвестный бэкенд OCR: {candidate}")
+            elif backend_class.available():
+                backend = backend_class()
+                logger.debug(f"Бэкенд OCR: {backend.name}")
+                break
+        _backends[key] = backend
+        return backend
+
+
+def perform_ocr_image(img: 'Image.Image', lang: str = OCR_DEFAULT_LANGUAGES, timeout: Optional[float] = None,
+                      backend: Optional[str] = None, preprocess: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Выполняет OCR для одного изображения (timeout - ограничение времени распознавания, с).
+    preprocess - параметры подготовки изображения (по умолчанию из config.py)
+    """
+    ocr_backend = get_ocr_backend(backend) if Image is not None else None
+    if ocr_backend is None:
+        return "Ошибка: для OCR нужны pillow и tesseract (tesserocr, утилита tesseract или pytesseract)."
+    try:
+        img = preprocess_image(img, preprocess)
+        if img is None:
+            return ""
+        return ocr_backend.recognize(img, lang, timeout)
+    except Exception as e:
+        logger.error(f"Ошибка при OCR изображения: {e}")
+        return f"Ошибка при OCR изображения: {str(e)}"
+
+def _page_result(text: str, words: List[Tuple[str, float]], dpi: Optional[int] = None) -> Dict[str, Any]:
+    """Итог распознавания страницы: средняя уверенность взвешена по длине слов"""
+    letters = sum(len(word) for word, _ in words)
+    confidence = sum(len(word) * conf for word, conf in words) / letters if letters else 0.0
+    return {
+        'text': text,
+        'confidence': confidence,
+        'words': len(words),
+        'confident_words': sum(1 for _, conf in words if conf >= OCR_MIN_CONFIDENCE),
+        'dpi': dpi,
+    }
+
+
+def perform_ocr_page(img: 'Image.Image', lang: str = OCR_DEFAULT_LANGUAGES, timeout: Optional[float] = None,
+                     backend: Optional[str] = None, preprocess: Optional[Dict[str, Any]] = None,
+                     dpi: Optional[int] = None) -> Dict[str, Any]:
+    """
+    OCR одного изображения с уверенностью по словам: {'text', 'confidence', 'words',
+    'confident_words', 'dpi'}; 'blank' - пустая страница, 'error' - текст ошибки
+    """
+    ocr_backend = get_ocr_backend(backend) if Image is not None else None
+    if ocr_backend is None:
+        return {'error': "Ошибка: для OCR нужны pillow и tesseract (tesserocr, утилита tesseract или pytesseract)."}
+    try:
+        img = preprocess_image(img, preprocess)
+        if img is None:
+            return dict(_page_result('', [], dpi), blank=True)
+        text, words = ocr_backend.recognize_data(img, lang, timeout)
+        return _page_result(text, words, dpi)
+    except Exception as e:
+        logger.error(f"Ошибка при OCR изображения: {e}")
+        return {'error': f"Ошибка при OCR изображения: {str(e)}"}
+
+
+class OCREngine:
+    """
+    OCR страниц в пуле процессов. Страницы отправляются в пул скользящим окном
+    (не более двух на процесс), результаты собираются в порядке страниц,
+    а после набора max_chars оставшиеся задачи отменяются
+    """
+
+    def __init__(self, workers: Optional[int] = None, page_timeout: Optional[float] = None,
+                 backend: Optional[str] = None, preprocess: Optional[Dict[str, Any]] = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.page_timeout = page_timeout
+        self.backend = backend or OCR_BACKEND
+        # Параметры передаются в процессы OCR явно: при запуске через spawn config.py там не переопределен
+        self.preprocess = preprocess or preprocessing_options()
+        self._pool = None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            atexit.register(self.shutdown)
+        return self._pool
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _submit(self, func: Callable, *args) -> Future:
+        """
+        Отправляет задачу в пул. Если пул сломан (процесс OCR аварийно завершился),
+        он пересоздается при следующей отправке, а эта задача выполняется в текущем процессе
+        """
+        try:
+            return self._get_pool().submit(func, *args)
+        except Exception as e:
+            logger.error(f"Пул OCR недоступен ({e}), страница распознается в текущем процессе")
+            self.shutdown()
+            future = Future()
+            future.set_result(func(*args))
+            return future
+
+    def recognize(self, images: Iterable, lang: str = OCR_DEFAULT_LANGUAGES, max_chars: Optional[int] = None) -> str:
+        """OCR последовательности изображений с ограничением символов"""
+        return self._collect(self.iter_recognize(images, lang), max_chars)
+
+    def iter_recognize(self, images: Iterable, lang: str = OCR_DEFAULT_LANGUAGES) -> Iterator[str]:
+        """
+        Текст страниц в исходном порядке (по одной строке на изображение).
+        Изображения запрашиваются лениво; закрытие генератора отменяет ожидающие задачи
+        """
+        if self.workers <= 1 or (isinstance(images, (list, tuple)) and len(images) <= 1):
+            return self._recognize_serial(images, lang)
+        return self._recognize_parallel(images, lang)
+
+    def _recognize_serial(self, images: Iterable, lang: str) -> Iterator[str]:
+        for page, img in enumerate(images, 1):
+            with span('ocr.page', page=page, lang=lang) as current:
+                text = perform_ocr_image(img, lang, self.page_timeout, self.backend, self.preprocess)
+                current.set(chars=len(text))
+            yield text
+
+    def _recognize_parallel(self, images: Iterable, lang: str) -> Iterator[str]:
+        """
+        Генератор текста страниц в исходном порядке, ровно один результат на изображение
+        (пропущенная по таймауту страница - '', сбой процесса - текст ошибки);
+        при закрытии отменяет ожидающие задачи
+        """
+        window = self.workers * 2
+        # Запас к таймауту tesseract на передачу изображения в процесс
+        result_timeout = self.page_timeout + 30 if self.page_timeout else None
+        pending = deque()
+        images = iter(images)
+        exhausted = False
+        page = 0
+
+        try:
+            while True:
+                while not exhausted and len(pending) < window:
+                    try:
+                        img = next(images)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending.append(self._submit(perform_ocr_image, img, lang, self.page_timeout,
+                                                self.backend, self.preprocess))
+
+                if not pending:
+                    break
+
+                future = pending.popleft()
+                page += 1
+                # Время ожидания результата: сам OCR идет в пуле параллельно с другими страницами
+                with span('ocr.page', page=page, lang=lang, parallel=True) as current:
+                    try:
+                        text = future.result(timeout=result_timeout)
+                    except FutureTimeoutError:
+                        future.cancel()
+                        logger.warning(f"OCR страницы не уложился в {self.page_timeout} с, страница пропущена")
+                        text = ''
+                    except Exception as e:
+                        logger.error(f"Ошибка в процессе OCR: {e}")
+                        text = f"Ошибка в процессе OCR: {e}"
+                    current.set(chars=len(text))
+                # Вызывающий код сопоставляет результаты со страницами по порядку
+                yield text
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def iter_recognize_adaptive(self, render: Callable[[Any, int], 'Image.Image'], pages: Sequence,
+                                lang: str = OCR_DEFAULT_LANGUAGES,
+                                dpi_steps: Sequence[int] = OCR_DPI_STEPS) -> Iterator[str]:
+        """
+        Адаптивное OCR: текст страниц pages в исходном порядке. render(страница, dpi) растеризует
+        страницу. Сначала все страницы распознаются с dpi_steps[0] (в пуле, скользящим окном),
+        страница с низкой уверенностью повторно растеризуется со следующим разрешением.
+        Пустые страницы и иллюстрации (мало слов, ни одного уверенного) не распознаются повторно,
+        а текст страниц, оставшихся неуверенными, отбрасывается: вместо него возвращается ''.
+        Поэтому вызывающий код считает лимит символов только по надежному тексту
+        """
+        parallel = self.workers > 1 and len(pages) > 1
+        window = self.workers * 2 if parallel else 1
+        result_timeout = self.page_timeout + 30 if self.page_timeout else None
+        pending = deque()
+        remaining = iter(pages)
+        exhausted = False
+
+        def submit(page, dpi: int) -> Future:
+            img = render(page, dpi)
+            if parallel:
+                return self._submit(perform_ocr_page, img, lang, self.page_timeout, self.backend, self.preprocess, dpi)
+            future = Future()
+            future.set_result(perform_ocr_page(img, lang, self.page_timeout, self.backend, self.preprocess, dpi))
+            return future
+
+        try:
+            while True:
+                while not exhausted and len(pending) < window:
+                    try:
+                        page = next(remaining)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending.append((page, submit(page, dpi_steps[0])))
+
+                if not pending:
+                    break
+
+                page, future = pending.popleft()
+                with span('ocr.page', page=page, lang=lang, adaptive=True) as current:
+                    try:
+                        result = future.result(timeout=result_timeout)
+                    except FutureTimeoutError:
+                        future.cancel()
+                        logger.warning(f"OCR страницы не уложился в {self.page_timeout} с, страница пропущена")
+                        result = {}
+                    except Exception as e:
+                        logger.error(f"Ошибка в процессе OCR: {e}")
+                        result = {}
+
+                    for dpi in dpi_steps[1:]:
+                        if not result or not self._needs_escalation(result):
+                            break
+                        logger.debug(f"OCR страницы {page}: уверенность {result['confidence']:.0f} "
+                                     f"при {result['dpi']} dpi, повтор с {dpi} dpi")
+                        # Неудачный повтор не отменяет уже полученный текст
+                        try:
+                            retry = submit(page, dpi).result(timeout=result_timeout)
+                        except Exception as e:
+                            logger.warning(f"Повторное OCR страницы {page} с {dpi} dpi не удалось: {e}")
+                            break
+                        if 'error' in retry:
+                            logger.warning(f"Повторное OCR страницы {page} с {dpi} dpi не удалось: {retry['error']}")
+                            break
+                        if retry['confidence'] >= result['confidence']:
+                            result = retry
+
+                    # Пропущенная страница дает '': вызывающий код сопоставляет результаты со страницами по порядку
+                    text = self._accepted_text(result) if result else ''
+                    current.set(chars=len(text), dpi=result.get('dpi'),
+                                confidence=round(result.get('confidence', 0.0), 1))
+                yield text
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    @staticmethod
+    def _needs_escalation(result: Dict[str, Any]) -> bool:
+        """Стоит ли распознать страницу с большим разрешением"""
+        if 'error' in result or result.get('blank') or not result['words']:
+            return False
+        if result['confidence'] >= OCR_MIN_CONFIDENCE:
+            return False
+        # Иллюстрация: несколько случайных "слов" без единого уверенного
+        return not (result['words'] < OCR_PICTURE_MAX_WORDS and not result['confident_words'])
+
+    @staticmethod
+    def _accepted_text(result: Dict[str, Any]) -> str:
+        """Текст страницы, если ему можно доверять; ошибки возвращаются как есть"""
+        if 'error' in result:
+            return result['error']
+        if result['confidence'] < OCR_JUNK_CONFIDENCE:
+            if result['words']:
+                logger.debug(f"OCR: текст страницы отброшен (уверенность {result['confidence']:.0f}, "
+                             f"слов {result['words']})")
+            return ''
+        return result['text']
+
+    @staticmethod
+    def _collect(pages: Iterator[str], max_chars: Optional[int]) -> str:
+        text_parts = []
+        total_chars = 0
+
+        for page_text in pages:
+            if page_text:
+                text_parts.append(page_text)
+                total_chars += len(page_text)
+                if max_chars and total_chars >= max_chars:
+                    break
+        if hasattr(pages, 'close'):
+            pages.close()
+
+        full_text = "\n".join(text_parts)
+        if max_chars:
+            return full_text[:max_chars]
+        return full_text
+
+_engine: Optional[OCREngine] = None
+
+def configure_ocr_engine(workers: Optional[int] = None, page_timeout: Optional[float] = OCR_PAGE_TIMEOUT,
+                        backend: Optional[str] = None, preprocess: Optional[Dict[str, Any]] = None) -> OCREngine:
+    """Пересоздает OCR-движок текущего процесса с новыми параметрами"""
+    global _engine
+    if _engine is not None:
+        _engine.shutdown()
+    _engine = OCREngine(workers, page_timeout, backend, preprocess)
+    return _engine
+
+def get_ocr_engine() -> OCREngine:
+    """OCR-движок текущего процесса (параметры из config.py)"""
+    if _engine is None:
+        return configure_ocr_engine(OCR_WORKERS, OCR_PAGE_TIMEOUT)
+    return _engine
+
+def perform_ocr_images(images: Iterable, lang: str = OCR_DEFAULT_LANGUAGES, max_chars: Optional[int] = None) -> str:
+    """
+    OCR для списка изображений с ограничением символов.
+    images может быть генератором: страницы запрашиваются только пока не набран max_chars
+    """
+    return get_ocr_engine().recognize(images, lang, max_chars)
+
+
+# Языки tesseract и буквы их алфавитов (набор выбирается из них)
+SCRIPT_LANGUAGES = {
+    'rus': re.compile(r'[а-яё]', re.IGNORECASE),
+    'eng': re.compile(r'[a-z]', re.IGNORECASE),
+}
+
+# Язык входит в набор, если на его алфавит приходится не меньше этой доли букв
+LANGUAGE_MIN_SHARE = 0.05
+
+# Сколько букв нужно, чтобы делать вывод: по тексту (слой или пробное OCR) и по именам и метаданным
+TEXT_MIN_LETTERS = 50
+NAME_MIN_LETTERS = 4
+
+# Сколько выбранных наборов языков помнить (по пути, размеру и mtime документа)
+LANGUAGE_CACHE_SIZE = 256
+
+_language_cache = OrderedDict()
+_language_hints: Dict[str, str] = {}
+_language_lock = threading.Lock()
+
+
+def set_language_hint(directory: str, hint: Optional[str]) -> None:
+    """
+    Подсказка для файлов каталога directory (например, имя архива для каталога распаковки).
+    hint=None удаляет подсказку
+    """
+    with _language_lock:
+        if hint is None:
+            _language_hints.pop(os.path.abspath(directory), None)
+        else:
+            _language_hints[os.path.abspath(directory)] = hint
+
+
+def _name_hints(file_path: str) -> List[str]:
+    """Имя файла (путь внутри архива, если он распакован в каталог с подсказкой) и подсказки каталогов"""
+    file_path = os.path.abspath(file_path)
+    with _language_lock:
+        hints = {directory: hint for directory, hint in _language_hints.items()
+                 if file_path.startswith(directory + os.sep)}
+    if not hints:
+        return [os.path.splitext(os.path.basename(file_path))[0]]
+    directory = max(hints, key=len)
+    return [os.path.splitext(os.path.relpath(file_path, directory))[0]] + list(hints.values())
+
+
+def detect_languages(text: str, min_letters: int = TEXT_MIN_LETTERS) -> Optional[str]:
+    """Набор языков по алфавитам букв текста ('rus', 'eng', 'rus+eng'); None, если букв мало"""
+    counts = {lang: len(pattern.findall(text)) for lang, pattern in SCRIPT_LANGUAGES.items()}
+    total = sum(counts.values())
+    if total < min_letters:
+        return None
+    return '+'.join(lang for lang, count in counts.items() if count >= total * LANGUAGE_MIN_SHARE)
+
+
+def _with_extra_languages(languages: str) -> str:
+    """Добавляет OCR_EXTRA_LANGUAGES к выбранному набору"""
+    selected = languages.split('+')
+    selected += [lang for lang in OCR_EXTRA_LANGUAGES.split('+') if lang and lang not in selected]
+    return '+'.join(selected)
+
+
+def choose_ocr_languages(file_path: str, hints: Iterable[str] = (), text_sample: str = '',
+                         probe: Optional[Callable[[], str]] = None) -> str:
+    """
+    Минимальный набор языков tesseract для документа; выбор запоминается для остальных страниц
+    и повторных обращений. Признаки проверяются от дешевых к дорогим: текстовый слой других страниц
+    (text_sample), кириллица в именах файла и архива и в метаданных (hints), пробное распознавание
+    одной страницы (probe). Латиница в именах не решает (это может быть транслит), поэтому для
+    английских сканов нужен текстовый слой или probe. OCR_LANGUAGES, отличный от 'auto', отключает выбор
+    """
+    if OCR_LANGUAGES != 'auto':
+        return OCR_LANGUAGES
+
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _language_lock:
+        if key in _language_cache:
+            _language_cache.move_to_end(key)
+            return _language_cache[key]
+
+    source = 'text'
+    languages = detect_languages(text_sample)
+    if languages is None:
+        source = 'names'
+        languages = detect_languages(' '.join(_name_hints(file_path) + [h for h in hints if h]), NAME_MIN_LETTERS)
+        if languages is not None and 'rus' not in languages:
+            languages = None
+    if languages is None and probe is not None:
+        source = 'probe'
+        with span('ocr.language_probe') as current:
+            try:
+                sample = probe()
+            except Exception as e:
+                logger.debug(f"Пробное распознавание {file_path} не удалось: {e}")
+                sample = ''
+            languages = detect_languages(sample)
+            current.set(chars=len(sample), lang=languages)
+    if languages is None:
+        source = 'default'
+        languages = OCR_DEFAULT_LANGUAGES
+
+    languages = _with_extra_languages(languages)
+    logger.debug(f"Языки OCR для {os.path.basename(file_path)}: {languages} ({source})")
+    with _language_lock:
+        _language_cache[key] = languages
+        while len(_language_cache) > LANGUAGE_CACHE_SIZE:
+            _language_cache.popitem(last=False)
+    return languages
+
+
+def probe_ocr_text(img: 'Image.Image') -> str:
+    """Быстрое распознавание страницы в низком разрешении (OCR_PROBE_DPI) для определения языка"""
+    options = preprocessing_options(enabled=True, target_dpi=OCR_PROBE_DPI,
+                                    max_dimension=OCR_MAX_DIMENSION * OCR_PROBE_DPI // OCR_TARGET_DPI)
+    text = perform_ocr_image(img, OCR_DEFAULT_LANGUAGES, OCR_PAGE_TIMEOUT, preprocess=options)
+    return '' if text.startswith("Ошибка") else text
+
+def iter_pdf_pages(file_path: str, first_page: int = 1, last_page: Optional[int] = None,
+                   dpi: int = 200, pages: Optional[Iterable[int]] = None) -> Iterator['Image.Image']:
+    """
+    Лениво растеризует страницы PDF по одной (через first_page/last_page pdf2image),
+    чтобы в памяти находилась только текущая страница.
+    pages - номера нужных страниц (с единицы); без него страницы читаются
+    от first_page до last_page, а если last_page не задан - до конца документа
+    """
+    from pdf2image import convert_from_path
+
+    if pages is not None:
+        for page in pages:
+            with span('pdf.render', page=page, dpi=dpi):
+                images = convert_from_path(file_path, dpi=dpi, first_page=page, last_page=page,
+                                           grayscale=OCR_PREPROCESS)
+            if images:
+                images[0].info['dpi'] = (dpi, dpi)
+                yield images[0]
+        return
+
+    if last_page is None:
+        try:
+            from pdf2image import pdfinfo_from_path
+            last_page = int(pdfinfo_from_path(file_path)['Pages'])
+        except Exception as e:
+            logger.debug(f"Не удалось определить число страниц PDF {file_path}: {e}")
+
+    page = first_page
+    while last_page is None or page <= last_page:
+        with span('pdf.render', page=page, dpi=dpi):
+            images = convert_from_path(file_path, dpi=dpi, first_page=page, last_page=page,
+                                       grayscale=OCR_PREPROCESS)
+        if not images:
+            break
+        images[0].info['dpi'] = (dpi, dpi)
+        yield images[0]
+        page += 1
+
+def iter_djvu_pages(file_path: str, pages: Iterable[int], dpi: int = 150) -> Iterator['Image.Image']:
+    """
+    Лениво растеризует указанные страницы DJVU через ddjvu в оттенках серого.
+    Изображение читается из stdout ddjvu в память, без временных файлов
+    """
+    for page in pages:
+        with span('djvu.render', page=page, dpi=dpi) as current:
+            result = subprocess.run(
+                ['ddjvu', '-format=pgm', f'-page={page}', f'-scale={dpi}', file_path],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, timeout=OCR_PAGE_TIMEOUT
+            )
+            current.set(bytes=len(result.stdout))
+        img = Image.open(io.BytesIO(result.stdout))
+        img.info['dpi'] = (dpi, dpi)
+        yield img
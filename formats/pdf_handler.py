@@ -1,91 +1,333 @@
-import os
-import logging
-from typing import Dict, Any
-from .base_handler import BaseFormatHandler
-
-logger = logging.getLogger(__name__)
-
-class PDFHandler(BaseFormatHandler):
-    """Обработчик для PDF файлов"""
-    
-    @staticmethod
-    def can_handle(file_path: str) -> bool:
-        return BaseFormatHandler.get_file_extension(file_path) == '.pdf'
-    
-    @staticmethod
-    def extract_text(file_path: str, parameters: Dict[str, Any]) -> str:
-        action_type = parameters.get('type', 'first_chars')
-        amount = parameters.get('amount', 500)
-        
-        try:
-            import PyPDF2
-            text = ""
-            
-            with open(file_path, 'rb') as file:
-                reader = PyPDF2.PdfReader(file)
-                
-                if action_type == 'first_chars':
-                    # Извлекаем текст пока не наберем нужное количество символов
-                    for page in reader.pages:
-                        page_text = page.extract_text()
-                        if page_text:
-                            text += page_text + "\n"
-                        if len(text) >= amount:
-                            break
-                    if text.strip():
-                        return text[:amount]
-                
-                elif action_type == 'first_pages':
-                    num_pages = min(amount, len(reader.pages))
-                    for i in range(num_pages):
-                        page_text = reader.pages[i].extract_text()
-                        if page_text:
-                            text += f"--- Страница {i+1} ---\n{page_text}\n\n"
-                    if text.strip():
-                        return text
-
-            # Если PDF не содержит текста, пробуем OCR
-            logger.warning(f"PDF {file_path} не содержит текста, выполняем OCR...")
-            try:
-                from pdf2image import convert_from_path
-                from .ocr_utils import perform_ocr_images
-                images = convert_from_path(file_path)
-                ocr_text = perform_ocr_images(images, lang='rus+eng', max_chars=amount if action_type == 'first_chars' else None)
-                return ocr_text
-            except Exception as e:
-                logger.error(f"Ошибка при OCR PDF {file_path}: {e}")
-                return f"Ошибка при OCR PDF: {str(e)}"
-            
-        except ImportError:
-            return "Ошибка: PyPDF2 не установлен. Установите: pip install PyPDF2"
-        except Exception as e:
-            logger.error(f"Ошибка при обработке PDF {file_path}: {e}")
-            return f"Ошибка при обработке PDF: {str(e)}"
-    
-    @staticmethod
-    def get_metadata(file_path: str) -> Dict[str, str]:
-        """Извлекает метаданные из PDF"""
-        try:
-            import PyPDF2
-            metadata = {}
-            
-            with open(file_path, 'rb') as file:
-                reader = PyPDF2.PdfReader(file)
-                pdf_metadata = reader.metadata
-                
-                if pdf_metadata:
-                    metadata = {
-                        'title': getattr(pdf_metadata, 'title', ''),
-                        'author': getattr(pdf_metadata, 'author', ''),
-                        'subject': getattr(pdf_metadata, 'subject', ''),
-                        'creator': getattr(pdf_metadata, 'creator', ''),
-                        'producer': getattr(pdf_metadata, 'producer', ''),
-                        'creation_date': getattr(pdf_metadata, 'creation_date', ''),
-                        'modification_date': getattr(pdf_metadata, 'modification_date', '')
-                    }
-            
-            return {k: v for k, v in metadata.items() if v}
-            
-        except Exception as e:
-            logger.error(f"Ошибка при извлечении метаданных PDF: {e}")
-            return {}
+import io
+import logging
+import threading
+from typing import Dict, Any, Optional, Iterable, Iterator
+from tracing import span
+from .base_handler import BaseFormatHandler, DocumentCache
+from config import PDF_BACKEND, PDF_MAX_PAGES, PDF_TEXT_MIN_CHARS, PDF_OCR_DPI, OCR_PREPROCESS, OCR_PROBE_DPI, \
+    OCR_ADAPTIVE
+
+logger = logging.getLogger(__name__)
+
+
+class PyPDF2Backend:
+    """Текстовый слой и метаданные через PyPDF2"""
+
+    name = 'pypdf2'
+    module = 'PyPDF2'
+
+    def __init__(self, file_path: str):
+        import PyPDF2
+        self.reader = PyPDF2.PdfReader(file_path)
+
+    def page_count(self) -> int:
+        return len(self.reader.pages)
+
+    def page_text(self, index: int) -> str:
+        return self.reader.pages[index].extract_text() or ''
+
+    def metadata(self) -> Dict[str, Any]:
+        pdf_metadata = self.reader.metadata
+        if not pdf_metadata:
+            return {}
+        return {
+            'title': getattr(pdf_metadata, 'title', ''),
+            'author': getattr(pdf_metadata, 'author', ''),
+            'subject': getattr(pdf_metadata, 'subject', ''),
+            'creator': getattr(pdf_metadata, 'creator', ''),
+            'producer': getattr(pdf_metadata, 'producer', ''),
+            'creation_date': getattr(pdf_metadata, 'creation_date', ''),
+            'modification_date': getattr(pdf_metadata, 'modification_date', '')
+        }
+
+    def close(self) -> None:
+        pass
+
+
+class PdfiumBackend:
+    """Текстовый слой, метаданные и растеризация страниц через pypdfium2 (без poppler)"""
+
+    name = 'pypdfium2'
+    module = 'pypdfium2'
+
+    # Ключи Info словаря PDF -> ключи метаданных
+    METADATA_KEYS = {
+        'Title': 'title', 'Author': 'author', 'Subject': 'subject', 'Creator': 'creator',
+        'Producer': 'producer', 'CreationDate': 'creation_date', 'ModDate': 'modification_date'
+    }
+
+    def __init__(self, file_path: str):
+        import pypdfium2
+        self.pdf = pypdfium2.PdfDocument(file_path)
+
+    def page_count(self) -> int:
+        return len(self.pdf)
+
+    def page_text(self, index: int) -> str:
+        page = self.pdf[index]
+        try:
+            text_page = page.get_textpage()
+            try:
+                return text_page.get_text_range().replace("\r\n", "\n")
+            finally:
+                text_page.close()
+        finally:
+            page.close()
+
+    def metadata(self) -> Dict[str, Any]:
+        info = self.pdf.get_metadata_dict(skip_empty=True)
+        return {self.METADATA_KEYS[k]: v for k, v in info.items() if k in self.METADATA_KEYS}
+
+    def render_page(self, index: int, dpi: int) -> 'Image.Image':
+        page = self.pdf[index]
+        try:
+            # OCR все равно работает с оттенками серого: так рендер и передача в процесс OCR дешевле
+            image = page.render(scale=dpi / 72, grayscale=OCR_PREPROCESS).to_pil()
+            image.info['dpi'] = (dpi, dpi)
+            return image
+        finally:
+            page.close()
+
+    def close(self) -> None:
+        self.pdf.close()
+
+
+class PdfMinerBackend:
+    """Текстовый слой и метаданные через pdfminer.six (медленнее, но точнее для сложной верстки)"""
+
+    name = 'pdfminer'
+    module = 'pdfminer'
+
+    def __init__(self, file_path: str):
+        from pdfminer.pdfparser import PDFParser
+        from pdfminer.pdfdocument import PDFDocument
+        from pdfminer.pdfpage import PDFPage
+
+        self.file = open(file_path, 'rb')
+        try:
+            self.document = PDFDocument(PDFParser(self.file))
+            self.pages = list(PDFPage.create_pages(self.document))
+        except Exception:
+            self.file.close()
+            raise
+
+    def page_count(self) -> int:
+        return len(self.pages)
+
+    def page_text(self, index: int) -> str:
+        from pdfminer.converter import TextConverter
+        from pdfminer.layout import LAParams
+        from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+
+        output = io.StringIO()
+        resources = PDFResourceManager()
+        device = TextConverter(resources, output, laparams=LAParams())
+        try:
+            PDFPageInterpreter(resources, device).process_page(self.pages[index])
+        finally:
+            device.close()
+        return output.getvalue()
+
+    def metadata(self) -> Dict[str, Any]:
+        from pdfminer.pdftypes import resolve1
+        from pdfminer.utils import decode_text
+
+        info = resolve1(self.document.info[0]) if self.document.info else {}
+        metadata = {}
+        for key, name in PdfiumBackend.METADATA_KEYS.items():
+            value = resolve1(info.get(key))
+            if isinstance(value, bytes):
+                value = decode_text(value)
+            if value:
+                metadata[name] = value
+        return metadata
+
+    def close(self) -> None:
+        self.file.close()
+
+
+# Бэкенды в порядке скорости извлечения текста по замерам benchmark.py (pdf_backend)
+PDF_BACKENDS = {
+    PdfiumBackend.name: PdfiumBackend,
+    PyPDF2Backend.name: PyPDF2Backend,
+    PdfMinerBackend.name: PdfMinerBackend,
+}
+
+
+class PDFDocument:
+    """
+    PDF, открытый один раз для текста и метаданных. Бэкенд выбирается автоматически
+    (первый установленный из PDF_BACKENDS) или задается PDF_BACKEND в config.py.
+    Текст страниц извлекается лениво и запоминается
+    """
+
+    def __init__(self, file_path: str, backend: Optional[str] = None):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        self._page_texts: Dict[int, str] = {}
+        self.backend = self._open_backend(file_path, backend or PDF_BACKEND)
+        self.num_pages = self.backend.page_count()
+
+    @staticmethod
+    def _open_backend(file_path: str, backend: str):
+        names = list(PDF_BACKENDS) if backend == 'auto' else [backend]
+        error = None
+        for name in names:
+            try:
+                return PDF_BACKENDS[name](file_path)
+            except ImportError:
+                logger.debug(f"PDF бэкенд {name} не установлен")
+            except Exception as e:
+                # Поврежденный файл может открыться другим бэкендом
+                logger.debug(f"PDF бэкенд {name} не смог открыть {file_path}: {e}")
+                error = e
+        if error is not None:
+            raise error
+        raise ImportError(f"не установлен ни один PDF бэкенд ({', '.join(names)})")
+
+    def close(self) -> None:
+        with self._lock:
+            self.backend.close()
+
+    def page_text(self, index: int) -> str:
+        """Текстовый слой страницы (индекс с нуля)"""
+        with self._lock:
+            if index not in self._page_texts:
+                try:
+                    with span('pdf.text', page=index + 1, backend=self.backend.name) as current:
+                        self._page_texts[index] = self.backend.page_text(index)
+                        current.set(chars=len(self._page_texts[index]))
+                except Exception as e:
+                    logger.debug(f"Не удалось извлечь текст страницы {index + 1} PDF {self.file_path}: {e}")
+                    self._page_texts[index] = ''
+            return self._page_texts[index]
+
+    def has_text_layer(self, index: int) -> bool:
+        """Есть ли на странице текст (иначе ее нужно распознавать)"""
+        return len(self.page_text(index).strip()) >= PDF_TEXT_MIN_CHARS
+
+    def metadata(self) -> Dict[str, Any]:
+        with self._lock:
+            return self.backend.metadata()
+
+    def iter_page_images(self, indexes: Iterable[int], dpi: int) -> Iterator['Image.Image']:
+        """Растеризует страницы для OCR: средствами бэкенда, если он умеет, иначе через pdf2image"""
+        if hasattr(self.backend, 'render_page'):
+            for index in indexes:
+                with self._lock, span('pdf.render', page=index + 1, dpi=dpi, backend=self.backend.name):
+                    image = self.backend.render_page(index, dpi)
+                yield image
+        else:
+            from .ocr_utils import iter_pdf_pages
+            yield from iter_pdf_pages(self.file_path, pages=[index + 1 for index in indexes], dpi=dpi)
+
+    def page_image(self, index: int, dpi: int) -> 'Image.Image':
+        """Растеризует одну страницу для OCR"""
+        for image in self.iter_page_images([index], dpi):
+            return image
+        raise ValueError(f"страница {index + 1} не растеризована")
+
+
+_documents = DocumentCache(PDFDocument)
+
+
+def open_pdf(file_path: str) -> PDFDocument:
+    """PDF из кэша процесса: метаданные и текст одного файла используют общий бэкенд"""
+    return _documents.open(file_path)
+
+
+class PDFHandler(BaseFormatHandler):
+    """Обработчик для PDF файлов"""
+
+    @staticmethod
+    def can_handle(file_path: str) -> bool:
+        return BaseFormatHandler.get_file_extension(file_path) == '.pdf'
+
+    @staticmethod
+    def extract_text(file_path: str, parameters: Dict[str, Any]) -> str:
+        action_type = parameters.get('type', 'first_chars')
+        amount = parameters.get('amount', 500)
+
+        try:
+            document = open_pdf(file_path)
+        except ImportError as e:
+            return f"Ошибка: {e}. Установите: pip install PyPDF2"
+        except Exception as e:
+            logger.error(f"Ошибка при обработке PDF {file_path}: {e}")
+            return f"Ошибка при обработке PDF: {str(e)}"
+
+        if action_type == 'first_pages':
+            max_chars = None
+            last_page = min(amount, document.num_pages)
+        else:
+            max_chars = amount
+            last_page = min(PDF_MAX_PAGES, document.num_pages)
+
+        # Сначала текстовый слой; страницы без него распознаются только если текста не хватило
+        pages_text = {}
+        missing_pages = []
+        total_chars = 0
+        for index in range(last_page):
+            if document.has_text_layer(index):
+                pages_text[index] = document.page_text(index)
+                total_chars += len(pages_text[index]) + 1
+                if max_chars and total_chars >= max_chars:
+                    break
+            else:
+                missing_pages.append(index)
+
+        ocr_error = None
+        if missing_pages and not (max_chars and total_chars >= max_chars):
+            logger.warning(f"PDF {file_path}: {len(missing_pages)} стр. без текстового слоя, выполняем OCR...")
+            try:
+                from .ocr_utils import get_ocr_engine, choose_ocr_languages, probe_ocr_text
+                metadata = document.metadata()
+                lang = choose_ocr_languages(
+                    file_path,
+                    hints=[str(metadata.get(key) or '') for key in ('title', 'author', 'subject')],
+                    text_sample="".join(pages_text.values()),
+                    probe=lambda: probe_ocr_text(document.page_image(missing_pages[0], OCR_PROBE_DPI))
+                )
+                if OCR_ADAPTIVE:
+                    # Разрешение подбирается по уверенности OCR; иллюстрации и мусор не засчитываются в лимит
+                    ocr_pages = get_ocr_engine().iter_recognize_adaptive(
+                        lambda page, dpi: document.page_image(page - 1, dpi),
+                        [index + 1 for index in missing_pages], lang=lang
+                    )
+                else:
+                    images = document.iter_page_images(missing_pages, dpi=PDF_OCR_DPI)
+                    ocr_pages = get_ocr_engine().iter_recognize(images, lang=lang)
+                try:
+                    for index, text in zip(missing_pages, ocr_pages):
+                        if text.startswith("Ошибка"):
+                            ocr_error = text
+                        elif text.strip():
+                            pages_text[index] = text
+                            total_chars += len(text) + 1
+                            if max_chars and total_chars >= max_chars:
+                                break
+                finally:
+                    ocr_pages.close()
+            except Exception as e:
+                logger.error(f"Ошибка при OCR PDF {file_path}: {e}")
+                ocr_error = f"Ошибка при OCR PDF: {str(e)}"
+
+        if not pages_text:
+            return ocr_error or ""
+
+        if max_chars:
+            return "\n".join(pages_text[index] for index in sorted(pages_text))[:max_chars]
+        return "".join(f"--- Страница {index + 1} ---\n{pages_text[index]}\n\n" for index in sorted(pages_text))
+
+    @staticmethod
+    def get_metadata(file_path: str) -> Dict[str, str]:
+        """Извлекает метаданные из PDF"""
+        try:
+            document = open_pdf(file_path)
+            metadata = document.metadata()
+            metadata['pages'] = str(document.num_pages)
+            return {k: v for k, v in metadata.items() if v}
+
+        except Exception as e:
+            logger.error(f"Ошибка при извлечении метаданных PDF: {e}")
+            return {}
@@ -0,0 +1,131 @@
+import logging
+import importlib
+import threading
+from importlib import metadata
+from typing import Dict, List, Optional, Tuple, Iterable, Union
+from .sniff import sniff_file, effective_type
+
+logger = logging.getLogger(__name__)
+
+# Группа точек входа для сторонних обработчиков:
+# имя точки входа - расширение ('.cbz'), значение - 'модуль:Класс'
+ENTRY_POINT_GROUP = 'ai_file_renamer.formats'
+
+# Встроенные обработчики по расширению. Модуль импортируется только при первом файле с таким расширением
+BUILTIN_HANDLERS = {
+    '.txt': '.txt_handler:TXTHandler',
+    '.pdf': '.pdf_handler:PDFHandler',
+    '.docx': '.docx_handler:DOCXHandler',
+    '.doc': '.docx_handler:DOCXHandler',
+    '.fb2': '.fb2_handler:FB2Handler',
+    '.zip': '.zip_handler:ZIPHandler',
+    '.rar': '.zip_handler:ZIPHandler',
+    '.epub': '.epub_handler:EPUBHandler',
+    '.djvu': '.djvu_handler:DJVUHandler',
+    '.png': '.image_handler:ImageHandler',
+    '.jpg': '.image_handler:ImageHandler',
+    '.jpeg': '.image_handler:ImageHandler',
+    '.tiff': '.image_handler:ImageHandler',
+    '.bmp': '.image_handler:ImageHandler',
+    '.gif': '.image_handler:ImageHandler',
+    '.webp': '.image_handler:ImageHandler',
+}
+
+# Сколько байт с начала файла читать для сверки сигнатур сторонних обработчиков
+MAGIC_READ_SIZE = 64
+
+HandlerSpec = Union[str, type]
+
+
+class HandlerRegistry:
+    """
+    Сопоставление расширений и сигнатур файлов обработчикам форматов.
+    Обработчики задаются строкой 'модуль:Класс' и импортируются при первом обращении,
+    поэтому тяжелые зависимости (PyPDF2, PIL и т.п.) загружаются, только если нужны.
+    Тип файла определяется по содержимому (formats.sniff), а расширение используется,
+    когда сигнатура не распознана или слишком общая
+    """
+
+    def __init__(self):
+        self._extensions: Dict[str, HandlerSpec] = dict(BUILTIN_HANDLERS)
+        self._signatures: List[Tuple[int, bytes, HandlerSpec]] = []
+        self._loaded: Dict[str, Optional[type]] = {}
+        self._lock = threading.Lock()
+        self._plugins_loaded = False
+
+    def register(self, extensions: Iterable[str], handler: HandlerSpec,
+                 signatures: Iterable[Tuple[int, bytes]] = ()) -> None:
+        """Регистрирует обработчик (класс или 'модуль:Класс') для расширений и сигнатур"""
+        with self._lock:
+            for ext in extensions:
+                self._extensions[ext.lower() if ext.startswith('.') else f'.{ext.lower()}'] = handler
+            for offset, magic in signatures:
+                self._signatures.insert(0, (offset, magic, handler))
+
+    def _load_plugins(self) -> None:
+        """Добавляет обработчики из точек входа установленных пакетов (один раз)"""
+        if self._plugins_loaded:
+            return
+        self._plugins_loaded = True
+        try:
+            entry_points = metadata.entry_points(group=ENTRY_POINT_GROUP)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать точки входа {ENTRY_POINT_GROUP}: {e}")
+            return
+        for entry_point in entry_points:
+            logger.debug(f"Обработчик {entry_point.value} зарегистрирован для {entry_point.name}")
+            self.register([entry_point.name], entry_point.value)
+
+    def load(self, spec: HandlerSpec) -> Optional[type]:
+        """Класс обработчика по спецификации; None, если модуль не импортируется"""
+        if isinstance(spec, type):
+            return spec
+
+        with self._lock:
+            if spec in self._loaded:
+                return self._loaded[spec]
+
+        module_name, _, class_name = spec.partition(':')
+        try:
+            module = importlib.import_module(module_name, __package__)
+            handler = getattr(module, class_name)
+        except (ImportError, AttributeError) as e:
+            logger.error(f"Не удалось загрузить обработчик {spec}: {e}")
+            handler = None
+
+        with self._lock:
+            self._loaded[spec] = handler
+        return handler
+
+    def _match_signature(self, file_path: str) -> Optional[HandlerSpec]:
+        """Сигнатуры, зарегистрированные сторонними обработчиками"""
+        if not self._signatures:
+            return None
+        try:
+            with open(file_path, 'rb') as f:
+                header = f.read(MAGIC_READ_SIZE)
+        except OSError:
+            return None
+        for offset, magic, spec in self._signatures:
+            if header[offset:offset + len(magic)] == magic:
+                return spec
+        return None
+
+    def find(self, file_path: str) -> Optional[type]:
+        """Обработчик по типу содержимого, а если тип не распознан - по расширению"""
+        self._load_plugins()
+        spec = self._match_signature(file_path)
+        if spec is None:
+            kind = sniff_file(file_path)
+            spec = self._extensions.get(effective_type(file_path, kind))
+            if spec is None and kind:
+                spec = self._extensions.get(kind)
+        return self.load(spec) if spec else None
+
+    def extensions(self) -> List[str]:
+        """Зарегистрированные расширения"""
+        self._load_plugins()
+        return sorted(self._extensions)
+
+
+registry = HandlerRegistry()
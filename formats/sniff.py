@@ -0,0 +1,129 @@
+import os
+import logging
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Сколько байт с начала файла читается для определения типа
+SNIFF_SIZE = 4096
+
+# Сигнатуры (смещение, байты) -> тип (каноническое расширение)
+SIGNATURES = [
+    (0, b'%PDF-', '.pdf'),
+    (0, b'AT&TFORM', '.djvu'),
+    (0, b'Rar!\x1a\x07', '.rar'),
+    (0, b"7z\xbc\xaf\x27\x1c", '.7z'),
+    (0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', '.doc'),
+    (0, b'\x89PNG\r\n\x1a\n', '.png'),
+    (0, b'\xff\xd8\xff', '.jpg'),
+    (0, b'GIF87a', '.gif'),
+    (0, b'GIF89a', '.gif'),
+    (0, b'II*\x00', '.tiff'),
+    (0, b'MM\x00*', '.tiff'),
+    (0, b'BM', '.bmp'),
+    (8, b'WEBP', '.webp'),
+]
+
+# Типы, определяемые по общим признакам: расширение файла для них точнее
+# (.cbz - тоже ZIP, .fb2 и .nfo - тоже текст, .xls, .ppt и .msi - тоже контейнер OLE, как .doc)
+GENERIC_TYPES = {'.zip', '.txt', '.doc'}
+
+# Размеры заголовка DIB (смещение 14) у известных версий BMP: сигнатура 'BM' из двух байт
+# слишком короткая (с нее начинается и обычный текст), поэтому заголовок проверяется целиком
+BMP_HEADER_SIZES = {12, 40, 52, 56, 64, 108, 124}
+
+# Типы уже проверенных файлов: (путь, размер, mtime) -> тип
+_memo: Dict[tuple, Optional[str]] = {}
+_memo_lock = threading.Lock()
+
+
+def _sniff_zip(header: bytes) -> str:
+    """Уточняет тип ZIP по первым записям: EPUB начинается с файла mimetype, DOCX содержит word/"""
+    if header[30:38] == b'mimetype' and b'application/epub+zip' in header[38:100]:
+        return '.epub'
+    if b'[Content_Types].xml' in header and b'word/' in header:
+        return '.docx'
+    return '.zip'
+
+
+def _sniff_text(header: bytes) -> Optional[str]:
+    """FB2 или обычный текст; None для двоичных данных"""
+    if b'\x00' in header:
+        return None
+    text = header.lstrip(b'\xef\xbb\xbf \t\r\n')
+    if text.startswith(b'<?xml') or text.startswith(b'<FictionBook'):
+        return '.fb2' if b'<FictionBook' in header else None
+    # Доля управляющих символов (кроме переводов строк и табуляции)
+    control = sum(1 for b in header if b < 32 and b not in (9, 10, 13))
+    return '.txt' if control <= len(header) // 100 else None
+
+
+def _is_bmp(header: bytes) -> bool:
+    """Заголовок BMP: нулевые зарезервированные байты и известный размер заголовка DIB"""
+    return (len(header) >= 18 and header[6:10] == b'\x00' * 4
+            and int.from_bytes(header[14:18], 'little') in BMP_HEADER_SIZES)
+
+
+def sniff_bytes(header: bytes) -> Optional[str]:
+    """Тип файла по первым байтам (расширение вида '.pdf') или None, если тип не распознан"""
+    if not header:
+        return None
+    if header.startswith(b'PK\x03\x04'):
+        return _sniff_zip(header)
+    for offset, magic, kind in SIGNATURES:
+        if header[offset:offset + len(magic)] == magic:
+            if kind == '.webp' and not header.startswith(b'RIFF'):
+                continue
+            if kind == '.bmp' and not _is_bmp(header):
+                continue
+            return kind
+    return _sniff_text(header)
+
+
+def _memo_key(file_path: str) -> tuple:
+    stat = os.stat(file_path)
+    return (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+
+
+def sniff_file(file_path: str) -> Optional[str]:
+    """Тип файла на диске; результат запоминается, файл читается один раз"""
+    try:
+        key = _memo_key(file_path)
+    except OSError:
+        return None
+    with _memo_lock:
+        if key in _memo:
+            return _memo[key]
+
+    try:
+        with open(file_path, 'rb') as f:
+            kind = sniff_bytes(f.read(SNIFF_SIZE))
+    except OSError as e:
+        logger.debug(f"Не удалось прочитать начало файла {file_path}: {e}")
+        return None
+
+    with _memo_lock:
+        _memo[key] = kind
+    return kind
+
+
+def remember_type(file_path: str, kind: Optional[str]) -> None:
+    """Запоминает уже определенный тип файла (например, при извлечении из архива)"""
+    try:
+        key = _memo_key(file_path)
+    except OSError:
+        return
+    with _memo_lock:
+        _memo[key] = kind
+
+
+def effective_type(name: str, kind: Optional[str]) -> str:
+    """
+    Тип для выбора обработчика: распознанная сигнатура важнее расширения,
+    а общие типы (ZIP, текст) используются, только если расширения нет
+    """
+    ext = os.path.splitext(name)[1].lower()
+    if kind and (kind not in GENERIC_TYPES or not ext):
+        return kind
+    return ext
@@ -0,0 +1,270 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+from batch import collect_archives, is_archive_name
+from result_cache import get_cache, file_hash
+from config import INDEX_PATH, WATCH_SETTLE_SECONDS, WATCH_POLL_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+
+def _content_hash(archive_path: str) -> str:
+    """Хэш архива: из кэша результатов (его уже посчитал обработчик) или заново"""
+    cache = get_cache()
+    return cache.archive_hash(archive_path) if cache else file_hash(archive_path)
+
+
+class LibraryIndex:
+    """
+    Индекс обработанных архивов (SQLite): путь, размер, mtime, хэш содержимого
+    и результат. Архив считается обработанным, пока его размер и mtime не изменились,
+    поэтому повторный запуск по библиотеке стоит одного stat на файл.
+    Переименования, выполненные программой, записываются в таблицу renames
+    """
+
+    # Состояния архива
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS archives (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                hash TEXT,
+                status TEXT NOT NULL,
+                new_name TEXT,
+                processed REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS archives_size ON archives (size)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS renames (
+                old_path TEXT NOT NULL,
+                new_path TEXT NOT NULL,
+                hash TEXT,
+                renamed REAL NOT NULL
+            )
+        """)
+        self._conn.commit()
+
+    def _moved_entry(self, archive_path: str, stat: os.stat_result) -> Optional[str]:
+        """
+        Путь записи, файл которой был перемещен в archive_path вне программы.
+        Хэш считается, только если есть обработанный архив того же размера, которого больше нет на месте
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, hash FROM archives WHERE size = ? AND status = ? AND hash IS NOT NULL",
+                (stat.st_size, self.DONE)
+            ).fetchall()
+        missing = [(path, content_hash) for path, content_hash in rows if not os.path.exists(path)]
+        if not missing:
+            return None
+        content_hash = _content_hash(archive_path)
+        return next((path for path, known_hash in missing if known_hash == content_hash), None)
+
+    def pending(self, archive_paths: List[str]) -> List[str]:
+        """Новые, измененные и необработанные (с ошибкой) архивы из списка"""
+        result = []
+        for archive_path in archive_paths:
+            full_path = os.path.abspath(archive_path)
+            try:
+                stat = os.stat(full_path)
+            except OSError:
+                continue
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT size, mtime_ns, status FROM archives WHERE path = ?", (full_path,)
+                ).fetchone()
+            if row is not None:
+                if row == (stat.st_size, stat.st_mtime_ns, self.DONE):
+                    continue
+            else:
+                old_path = self._moved_entry(full_path, stat)
+                if old_path:
+                    logger.info(f"Архив перемещен: {old_path} → {full_path}, повторно не обрабатывается")
+                    self._move(old_path, full_path, stat)
+                    continue
+            result.append(archive_path)
+        return result
+
+    def record(self, archive_path: str, new_name: Optional[str], error: Optional[str] = None) -> None:
+        """Запоминает результат обработки архива (до переименования)"""
+        full_path = os.path.abspath(archive_path)
+        try:
+            stat = os.stat(full_path)
+            content_hash = _content_hash(full_path)
+        except OSError as e:
+            logger.warning(f"Архив {archive_path} не добавлен в индекс: {e}")
+            return
+        status = self.FAILED if error or not new_name else self.DONE
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO archives (path, size, mtime_ns, hash, status, new_name, processed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (full_path, stat.st_size, stat.st_mtime_ns, content_hash, status, new_name, time.time())
+            )
+            self._conn.commit()
+
+    def record_rename(self, old_path: str, new_path: str) -> None:
+        """Переносит запись на новый путь после переименования и сохраняет его в истории"""
+        old_path, new_path = os.path.abspath(old_path), os.path.abspath(new_path)
+        try:
+            stat = os.stat(new_path)
+        except OSError:
+            return
+        self._move(old_path, new_path, stat)
+        with self._lock:
+            row = self._conn.execute("SELECT hash FROM archives WHERE path = ?", (new_path,)).fetchone()
+            self._conn.execute(
+                "INSERT INTO renames (old_path, new_path, hash, renamed) VALUES (?, ?, ?, ?)",
+                (old_path, new_path, row[0] if row else None, time.time())
+            )
+            self._conn.commit()
+
+    def _move(self, old_path: str, new_path: str, stat: os.stat_result) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM archives WHERE path = ? AND path != ?", (new_path, old_path))
+            self._conn.execute(
+                "UPDATE archives SET path = ?, size = ?, mtime_ns = ? WHERE path = ?",
+                (new_path, stat.st_size, stat.st_mtime_ns, old_path)
+            )
+            self._conn.commit()
+
+    def renames(self, limit: int = 100) -> List[Dict[str, str]]:
+        """Последние переименования, выполненные программой"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT old_path, new_path, renamed FROM renames ORDER BY renamed DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [{'old_path': old, 'new_path': new, 'renamed': renamed} for old, new, renamed in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_index: Optional[LibraryIndex] = None
+
+
+def get_index() -> Optional[LibraryIndex]:
+    """Индекс библиотеки основного процесса или None, если база недоступна"""
+    global _index
+    if _index is None:
+        try:
+            _index = LibraryIndex(INDEX_PATH)
+        except Exception as e:
+            logger.error(f"Ошибка открытия индекса библиотеки ({INDEX_PATH}): {e}")
+            return None
+    return _index
+
+
+class _ArrivalHandler(FileSystemEventHandler):
+    """Запоминает архивы, появившиеся в каталоге (создание или перемещение внутрь)"""
+
+    def __init__(self, arrivals: Dict[str, float], lock: threading.Lock, pattern: Optional[str]):
+        self.arrivals = arrivals
+        self.lock = lock
+        self.pattern = pattern
+
+    def _add(self, path: str) -> None:
+        if is_archive_name(os.path.basename(path), self.pattern):
+            with self.lock:
+                self.arrivals[path] = time.monotonic()
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._add(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self._add(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self._add(event.dest_path)
+
+
+def watch_directory(directory: str, process: Callable[[List[str]], None], index: LibraryIndex,
+                    pattern: Optional[str] = None) -> None:
+    """
+    Следит за каталогом и передает в process новые архивы, как только их размер
+    перестает меняться (WATCH_SETTLE_SECONDS). Использует inotify через watchdog,
+    а без него раз в WATCH_POLL_INTERVAL секунд проверяет каталог по индексу.
+    Работает до прерывания с клавиатуры
+    """
+    arrivals: Dict[str, float] = {}
+    lock = threading.Lock()
+    observer = None
+    if Observer is not None:
+        observer = Observer()
+        observer.schedule(_ArrivalHandler(arrivals, lock, pattern), directory, recursive=True)
+        observer.start()
+        logger.info(f"Слежение за каталогом {directory} (события файловой системы)")
+    else:
+        logger.info(f"Слежение за каталогом {directory} (опрос раз в {WATCH_POLL_INTERVAL} с, watchdog не установлен)")
+
+    last_poll = time.monotonic()
+    sizes: Dict[str, tuple] = {}
+    # Уже переданные в process архивы: неудачные не обрабатываются повторно, пока не изменятся
+    handled: Dict[str, tuple] = {}
+    try:
+        while True:
+            time.sleep(1)
+            now = time.monotonic()
+            if observer is None and now - last_poll >= WATCH_POLL_INTERVAL:
+                last_poll = now
+                with lock:
+                    for path in index.pending(collect_archives(directory, pattern)):
+                        if path not in handled:
+                            arrivals.setdefault(path, now)
+
+            ready = []
+            with lock:
+                for path, seen in list(arrivals.items()):
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        del arrivals[path]
+                        sizes.pop(path, None)
+                        continue
+                    # Архив еще копируется, пока меняются его размер или mtime
+                    key = (stat.st_size, stat.st_mtime_ns)
+                    if sizes.get(path) != key:
+                        sizes[path] = key
+                        arrivals[path] = now
+                    elif now - seen >= WATCH_SETTLE_SECONDS:
+                        del arrivals[path]
+                        del sizes[path]
+                        if handled.get(path) != key:
+                            handled[path] = key
+                            ready.append(path)
+
+            ready = index.pending(ready)
+            if ready:
+                logger.info(f"Новых архивов: {len(ready)}")
+                process(ready)
+    except KeyboardInterrupt:
+        logger.info("Слежение за каталогом остановлено")
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
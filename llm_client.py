@@ -1,106 +1,410 @@
-﻿import json
-import google.generativeai as genai
-from config import GEMINI_API_KEY
-import logging
-
-logger = logging.getLogger(__name__)
-
-# Настраиваем Gemini
-genai.configure(api_key=GEMINI_API_KEY)
-MODEL_NAME = 'gemini-2.5-flash'
-
-def send_to_llm(prompt: str) -> str:
-    """
-    Отправляет промпт в Gemini API и возвращает ответ
-    """
-    try:
-        logger.debug(f"Отправляем запрос к Gemini API (модель: {MODEL_NAME})...")
-        
-        model = genai.GenerativeModel(MODEL_NAME)
-        
-        # Формируем промпт с четкими инструкциями по JSON
-        system_prompt = """Ты должен отвечать ТОЛЬКО в формате JSON, без каких-либо дополнительных объяснений, комментариев или текста вне JSON. 
-Твой ответ должен быть валидным JSON объектом с одной из двух структур:
-
-1. Для переименования:
-{"decision": "rename", "new_name": "имя_файла.расширение"}
-
-2. Для запроса дополнительных данных:
-{"decision": "need_more_data", "action": "действие", "target": "конкретное_имя_файла.расширение", "parameters": {"type": "тип", "amount": количество}}
-
-ВАЖНО: В поле "target" всегда указывай конкретное существующее имя файла из структуры архива, а не общие имена like 'document.fb2'."""
-        
-        full_prompt = f"{system_prompt}\n\n{prompt}"
-        
-        logger.debug(f"Промпт: {full_prompt[:200]}...")
-        
-        response = model.generate_content(
-            full_prompt,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.1,
-                max_output_tokens=1000,
-            )
-        )
-        
-        # Проверяем, что ответ не пустой
-        if not response or not response.text:
-            raise ValueError("Пустой ответ от Gemini API")
-        
-        logger.debug(f"Получен ответ от Gemini: {response.text}")
-        
-        # Очищаем ответ от возможных markdown обратных кавычек
-        cleaned_response = response.text.strip()
-        if cleaned_response.startswith('```json'):
-            cleaned_response = cleaned_response[7:]
-        if cleaned_response.startswith('```'):
-            cleaned_response = cleaned_response[3:]
-        if cleaned_response.endswith('```'):
-            cleaned_response = cleaned_response[:-3]
-        
-        return cleaned_response
-        
-    except IndexError as e:
-        logger.error(f"Ошибка индекса в ответе Gemini: {e}")
-        return get_fallback_response(prompt)
-    except Exception as e:
-        logger.error(f"Ошибка при обращении к Gemini API: {e}")
-        return get_fallback_response(prompt)
-
-def get_fallback_response(prompt: str) -> str:
-    """
-    Возвращает fallback response на основе анализа промпта
-    """
-    try:
-        # Анализируем промпт чтобы понять контекст
-        if "pdf" in prompt.lower() or ".pdf" in prompt:
-            return json.dumps({
-                "decision": "need_more_data",
-                "action": "extract_text",
-                "target": "*.pdf",
-                "parameters": {"type": "first_chars", "amount": 1000}
-            })
-        elif "docx" in prompt.lower() or ".docx" in prompt:
-            return json.dumps({
-                "decision": "need_more_data", 
-                "action": "extract_text",
-                "target": "*.docx",
-                "parameters": {"type": "first_chars", "amount": 1000}
-            })
-        elif "txt" in prompt.lower() or ".txt" in prompt:
-            return json.dumps({
-                "decision": "need_more_data",
-                "action": "extract_text", 
-                "target": "*.txt",
-                "parameters": {"type": "first_chars", "amount": 1000}
-            })
-        else:
-            # Общий fallback
-            return json.dumps({
-                "decision": "need_more_data",
-                "action": "extract_text",
-                "target": "document.*", 
-                "parameters": {"type": "first_chars", "amount": 1000}
-            })
-    except:
-        # Ultimate fallback
-        return '{"decision": "need_more_data", "action": "extract_text", "target": "*.pdf", "parameters": {"type": "first_chars", "amount": 1000}}'
+﻿import json
+import time
+import random
+import asyncio
+import logging
+import threading
+import weakref
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, Optional, Tuple
+from tracing import span
+from config import (GEMINI_API_KEY, LLM_MAX_CONCURRENCY, LLM_MAX_RETRIES,
+                    LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY)
+
+try:
+    import google.generativeai as genai
+except ImportError:
+    genai = None
+
+logger = logging.getLogger(__name__)
+
+# Настраиваем Gemini
+if genai is not None:
+    genai.configure(api_key=GEMINI_API_KEY)
+MODEL_NAME = 'gemini-2.5-flash'
+
+# Формируем промпт с четкими инструкциями по JSON
+SYSTEM_PROMPT = """Ты должен отвечать ТОЛЬКО в формате JSON, без каких-либо дополнительных объяснений, комментариев или текста вне JSON. 
+Твой ответ должен быть валидным JSON объектом с одной из двух структур:
+
+1. Для переименования:
+{"decision": "rename", "new_name": "имя_файла.расширение"}
+
+2. Для запроса дополнительных данных:
+{"decision": "need_more_data", "action": "действие", "target": "конкретное_имя_файла.расширение", "parameters": {"type": "тип", "amount": количество}}
+
+ВАЖНО: В поле "target" всегда указывай конкретное существующее имя файла из структуры архива, а не общие имена like 'document.fb2'."""
+
+# Инструкции для пакетного режима: один запрос описывает несколько архивов
+BATCH_SYSTEM_PROMPT = """Ты должен отвечать ТОЛЬКО в формате JSON, без каких-либо дополнительных объяснений, комментариев или текста вне JSON.
+Твой ответ должен быть JSON массивом, по одному объекту на каждый архив из запроса. Каждый объект содержит поле "id" архива и одну из двух структур:
+
+1. Для переименования:
+{"id": "идентификатор", "decision": "rename", "new_name": "имя_файла.расширение"}
+
+2. Для запроса дополнительных данных:
+{"id": "идентификатор", "decision": "need_more_data", "action": "действие", "target": "конкретное_имя_файла.расширение", "parameters": {"type": "тип", "amount": количество}}
+
+ВАЖНО: В поле "target" всегда указывай конкретное существующее имя файла из структуры соответствующего архива."""
+
+# HTTP-коды, при которых запрос повторяется: превышение квоты и ошибки сервера
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Ограничение числа одновременных запросов (задается в пакетном режиме)
+_request_slots = None
+
+def set_request_slots(semaphore) -> None:
+    """
+    Задает семафор (в том числе межпроцессный), ограничивающий
+    число одновременных запросов к LLM
+    """
+    global _request_slots
+    _request_slots = semaphore
+
+def is_retryable_error(error: Exception) -> bool:
+    """Проверяет, имеет ли смысл повторить запрос после ошибки (429/5xx)"""
+    code = getattr(error, 'code', None)
+    if not isinstance(code, int):
+        code = getattr(error, 'status_code', None)
+    if isinstance(code, int):
+        return code in RETRYABLE_STATUS_CODES
+    # Ошибки сети без HTTP-кода тоже считаем временными
+    return isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError))
+
+def clean_response(text: str) -> str:
+    """Очищает ответ от возможных markdown обратных кавычек"""
+    cleaned_response = text.strip()
+    if cleaned_response.startswith('```json'):
+        cleaned_response = cleaned_response[7:]
+    if cleaned_response.startswith('```'):
+        cleaned_response = cleaned_response[3:]
+    if cleaned_response.endswith('```'):
+        cleaned_response = cleaned_response[:-3]
+    return cleaned_response
+
+class LLMStats:
+    """Счетчики запросов к LLM: число запросов и повторов, задержки, токены"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+
+    def record_request(self, latency: float, usage: Dict[str, int]) -> None:
+        with self._lock:
+            self.requests += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+            self.prompt_tokens += usage.get('prompt_tokens', 0)
+            self.output_tokens += usage.get('output_tokens', 0)
+
+    def record_retry(self) -> None:
+        with self._lock:
+            self.retries += 1
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'retries': self.retries,
+                'failures': self.failures,
+                'latency_total': self.latency_total,
+                'latency_avg': self.latency_total / self.requests if self.requests else 0.0,
+                'latency_max': self.latency_max,
+                'prompt_tokens': self.prompt_tokens,
+                'output_tokens': self.output_tokens
+            }
+
+class GeminiTransport:
+    """
+    Транспорт к Gemini API. Объект модели создается один раз и переиспользуется.
+    Транспорт возвращает пару (текст ответа, использование токенов); для тестов
+    его можно заменить любым объектом с методами generate/agenerate
+    """
+
+    def __init__(self, model_name: str = MODEL_NAME):
+        self.model_name = model_name
+        self._model = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            if genai is None:
+                raise ImportError("google-generativeai не установлен. Установите: pip install google-generativeai")
+            self._model = genai.GenerativeModel(self.model_name)
+        return self._model
+
+    @staticmethod
+    def _generation_config():
+        return genai.types.GenerationConfig(
+            temperature=0.1,
+            max_output_tokens=1000,
+        )
+
+    @staticmethod
+    def _parse(response) -> Tuple[str, Dict[str, int]]:
+        # Проверяем, что ответ не пустой
+        if not response or not response.text:
+            raise ValueError("Пустой ответ от Gemini API")
+        usage_metadata = getattr(response, 'usage_metadata', None)
+        usage = {
+            'prompt_tokens': getattr(usage_metadata, 'prompt_token_count', 0) or 0,
+            'output_tokens': getattr(usage_metadata, 'candidates_token_count', 0) or 0
+        }
+        return response.text, usage
+
+    def generate(self, prompt: str) -> Tuple[str, Dict[str, int]]:
+        response = self.model.generate_content(prompt, generation_config=self._generation_config())
+        return self._parse(response)
+
+    async def agenerate(self, prompt: str) -> Tuple[str, Dict[str, int]]:
+        response = await self.model.generate_content_async(prompt, generation_config=self._generation_config())
+        return self._parse(response)
+
+class LLMClient:
+    """
+    Клиент LLM с повторами при 429/5xx (экспоненциальная задержка со случайным
+    разбросом) и ограничением числа одновременных асинхронных запросов
+    """
+
+    def __init__(self, transport=None, max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 max_retries: int = LLM_MAX_RETRIES, base_delay: float = LLM_RETRY_BASE_DELAY,
+                 max_delay: float = LLM_RETRY_MAX_DELAY):
+        self.transport = transport or GeminiTransport()
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = LLMStats()
+        # asyncio.Semaphore привязан к циклу событий, поэтому храним по одному на цикл
+        self._async_slots = weakref.WeakKeyDictionary()
+
+    def _backoff_delay(self, attempt: int) -> float:
+        """Задержка перед повтором: full jitter в пределах base * 2^attempt"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _full_prompt(self, prompt: str, system_prompt: str) -> str:
+        full_prompt = f"{system_prompt}\n\n{prompt}"
+        logger.debug(f"Промпт: {full_prompt[:200]}...")
+        return full_prompt
+
+    def _should_retry(self, error: Exception, attempt: int) -> bool:
+        if attempt >= self.max_retries or not is_retryable_error(error):
+            self.stats.record_failure()
+            return False
+        self.stats.record_retry()
+        return True
+
+    def send(self, prompt: str, system_prompt: str = SYSTEM_PROMPT) -> str:
+        """Синхронный запрос; исключение пробрасывается, если повторы не помогли"""
+        full_prompt = self._full_prompt(prompt, system_prompt)
+        attempt = 0
+        while True:
+            try:
+                with _request_slots if _request_slots is not None else nullcontext():
+                    start = time.perf_counter()
+                    with span('llm.request', attempt=attempt, chars=len(full_prompt)) as current:
+                        text, usage = self.transport.generate(full_prompt)
+                        current.set(response_chars=len(text), **usage)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                delay = self._backoff_delay(attempt)
+                logger.warning(f"Ошибка LLM ({e}), повтор {attempt + 1}/{self.max_retries} через {delay:.1f} с")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.stats.record_request(time.perf_counter() - start, usage)
+            logger.debug(f"Получен ответ от LLM: {text}")
+            return clean_response(text)
+
+    def _get_async_slots(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_slots:
+            self._async_slots[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self._async_slots[loop]
+
+    async def asend(self, prompt: str, system_prompt: str = SYSTEM_PROMPT) -> str:
+        """Асинхронный запрос; не более max_concurrency запросов одновременно"""
+        full_prompt = self._full_prompt(prompt, system_prompt)
+        slots = self._get_async_slots()
+        attempt = 0
+        while True:
+            try:
+                async with slots:
+                    start = time.perf_counter()
+                    with span('llm.request', attempt=attempt, chars=len(full_prompt)) as current:
+                        text, usage = await self.transport.agenerate(full_prompt)
+                        current.set(response_chars=len(text), **usage)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                delay = self._backoff_delay(attempt)
+                logger.warning(f"Ошибка LLM ({e}), повтор {attempt + 1}/{self.max_retries} через {delay:.1f} с")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self.stats.record_request(time.perf_counter() - start, usage)
+            logger.debug(f"Получен ответ от LLM: {text}")
+            return clean_response(text)
+
+_client: Optional[LLMClient] = None
+
+def get_llm_client() -> LLMClient:
+    """Клиент LLM текущего процесса (создается при первом обращении)"""
+    global _client
+    if _client is None:
+        _client = LLMClient()
+    return _client
+
+def set_llm_client(client: Optional[LLMClient]) -> None:
+    """Подменяет клиент LLM (например, клиентом с тестовым транспортом)"""
+    global _client
+    _client = client
+
+def get_llm_stats() -> Dict[str, Any]:
+    """Счетчики запросов к LLM текущего процесса"""
+    return get_llm_client().stats.snapshot()
+
+def send_to_llm(prompt: str) -> str:
+    """
+    Отправляет промпт в Gemini API и возвращает ответ
+    """
+    try:
+        logger.debug(f"Отправляем запрос к Gemini API (модель: {MODEL_NAME})...")
+        return get_llm_client().send(prompt)
+    except IndexError as e:
+        logger.error(f"Ошибка индекса в ответе Gemini: {e}")
+        return get_fallback_response(prompt)
+    except Exception as e:
+        logger.error(f"Ошибка при обращении к Gemini API: {e}")
+        return get_fallback_response(prompt)
+
+async def asend_to_llm(prompt: str) -> str:
+    """
+    Асинхронно отправляет промпт в Gemini API и возвращает ответ
+    """
+    try:
+        logger.debug(f"Отправляем асинхронный запрос к Gemini API (модель: {MODEL_NAME})...")
+        return await get_llm_client().asend(prompt)
+    except IndexError as e:
+        logger.error(f"Ошибка индекса в ответе Gemini: {e}")
+        return get_fallback_response(prompt)
+    except Exception as e:
+        logger.error(f"Ошибка при обращении к Gemini API: {e}")
+        return get_fallback_response(prompt)
+
+def is_valid_decision(decision: Any) -> bool:
+    """Проверяет, что решение LLM имеет одну из ожидаемых структур"""
+    if not isinstance(decision, dict):
+        return False
+    if decision.get('decision') == 'rename':
+        return isinstance(decision.get('new_name'), str) and bool(decision['new_name'].strip())
+    return decision.get('decision') == 'need_more_data'
+
+def parse_batch_response(text: str, expected_ids) -> Dict[str, dict]:
+    """
+    Разбирает ответ пакетного запроса (JSON массив решений с полем "id").
+    Возвращает только корректные решения для ожидаемых идентификаторов
+    """
+    try:
+        items = json.loads(clean_response(text))
+    except (json.JSONDecodeError, TypeError) as e:
+        logger.warning(f"Ошибка разбора JSON пакетного ответа LLM: {e}")
+        return {}
+    if isinstance(items, dict):
+        items = [items]
+    if not isinstance(items, list):
+        return {}
+
+    expected_ids = set(expected_ids)
+    decisions = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        item_id = str(item.get('id'))
+        if item_id in expected_ids and item_id not in decisions and is_valid_decision(item):
+            decisions[item_id] = {k: v for k, v in item.items() if k != 'id'}
+    return decisions
+
+async def arequest_batch_decisions(entries: Dict[str, Any],
+                                   build_prompt: Callable[[Dict[str, Any]], str]) -> Dict[str, Optional[dict]]:
+    """
+    Запрашивает решения для нескольких архивов одним запросом.
+    entries - словарь {id: данные архива}, build_prompt строит по нему промпт.
+    Записи, для которых ответ не разобран, делятся пополам и запрашиваются повторно;
+    для записи, не разобранной и в одиночку, возвращается None.
+    Ошибка самого запроса (asend уже повторял его) не делится: все записи получают None
+    """
+    try:
+        text = await get_llm_client().asend(build_prompt(entries), BATCH_SYSTEM_PROMPT)
+    except Exception as e:
+        logger.error(f"Ошибка пакетного запроса к Gemini API: {e}")
+        return {entry_id: None for entry_id in entries}
+    decisions = parse_batch_response(text, entries.keys())
+
+    missing = [entry_id for entry_id in entries if entry_id not in decisions]
+    if not missing:
+        return decisions
+    if len(entries) == 1:
+        decisions[missing[0]] = None
+        return decisions
+
+    logger.info(f"Ответ не разобран для {len(missing)} из {len(entries)} архивов, повторяем по частям")
+    half = (len(missing) + 1) // 2
+    parts = [missing[:half], missing[half:]]
+    results = await asyncio.gather(*[
+        arequest_batch_decisions({entry_id: entries[entry_id] for entry_id in part}, build_prompt)
+        for part in parts if part
+    ])
+    for result in results:
+        decisions.update(result)
+    return decisions
+
+def get_fallback_response(prompt: str) -> str:
+    """
+    Возвращает fallback response на основе анализа промпта
+    """
+    try:
+        # Анализируем промпт чтобы понять контекст
+        if "pdf" in prompt.lower() or ".pdf" in prompt:
+            return json.dumps({
+                "decision": "need_more_data",
+                "action": "extract_text",
+                "target": "*.pdf",
+                "parameters": {"type": "first_chars", "amount": 1000}
+            })
+        elif "docx" in prompt.lower() or ".docx" in prompt:
+            return json.dumps({
+                "decision": "need_more_data", 
+                "action": "extract_text",
+                "target": "*.docx",
+                "parameters": {"type": "first_chars", "amount": 1000}
+            })
+        elif "txt" in prompt.lower() or ".txt" in prompt:
+            return json.dumps({
+                "decision": "need_more_data",
+                "action": "extract_text", 
+                "target": "*.txt",
+                "parameters": {"type": "first_chars", "amount": 1000}
+            })
+        else:
+            # Общий fallback
+            return json.dumps({
+                "decision": "need_more_data",
+                "action": "extract_text",
+                "target": "document.*", 
+                "parameters": {"type": "first_chars", "amount": 1000}
+            })
+    except:
+        # Ultimate fallback
+        return '{"decision": "need_more_data", "action": "extract_text", "target": "*.pdf", "parameters": {"type": "first_chars", "amount": 1000}}'
@@ -1,137 +1,528 @@
-﻿import re
-import os
-import sys
-import json
-import logging
-import tempfile
-import shutil
-import argparse
-from file_tools import identify_main_document, extract_text_data
-from llm_client import send_to_llm
-from prompts import build_initial_prompt, build_text_analysis_prompt
-from formats import get_handler_for_file
-
-# Настройка логирования
-logger = logging.getLogger(__name__)
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
-
-def rename_file(old_path, new_name):
-    """Переименовывает файл с сохранением пути"""
-    dir_path = os.path.dirname(old_path)
-    new_path = os.path.join(dir_path, new_name)
-    try:
-        os.rename(old_path, new_path)
-        logger.info(f"Файл переименован: {old_path} → {new_path}")
-        print(f"Файл переименован: {new_path}")
-    except Exception as e:
-        logger.error(f"Ошибка при переименовании файла: {e}")
-
-def handle_llm_decision(archive_path, archive_content, llm_response, auto_rename=False):
-    """
-    Обрабатывает ответ LLM, включая извлечение текста и предложение имени.
-    llm_response может быть строкой JSON или уже словарем.
-    """
-    # Если пришла строка, пытаемся преобразовать в dict
-    if isinstance(llm_response, str):
-        import re, json
-        cleaned_response_str = re.sub(r'```.*?```', '', llm_response, flags=re.DOTALL).strip()
-        try:
-            llm_response = json.loads(cleaned_response_str)
-        except json.JSONDecodeError as e:
-            logging.error(f"Ошибка разбора JSON ответа LLM: {e}\nОтвет (обрезано 500 символов): {cleaned_response_str[:500]}")
-            return
-    elif not isinstance(llm_response, dict):
-        logging.error(f"LLM вернула неожиданный тип: {type(llm_response)}")
-        return
-
-    decision = llm_response.get('decision')
-    if decision == 'rename':
-        new_name = llm_response.get('new_name')
-        logging.info(f"Предлагаемое имя архива: {new_name}")
-        print(new_name)
-        if auto_rename:
-            rename_file(archive_path, new_name)
-        else:
-            answer = input(f"Переименовать архив в '{new_name}'? [y/N]: ").strip().lower()
-            if answer == 'y':
-                rename_file(archive_path, new_name)
-    elif decision == 'need_more_data':
-        target_file = llm_response.get('target')
-        parameters = llm_response.get('parameters', {})
-
-        file_obj = next((f for f in archive_content['files'] if f['name'] == target_file), None)
-        if not file_obj:
-            main_doc_name = identify_main_document(archive_content['files'])
-            file_obj = next((f for f in archive_content['files'] if f['name'] == main_doc_name), None)
-            if not file_obj:
-                logging.error("В архиве не найдено подходящих файлов для обработки")
-                return
-            logging.info(f"Найден fallback файл: {file_obj['name']}")
-
-        extracted_text = extract_text_data(file_obj['path'], parameters)
-        logging.debug(f"Извлечено данных (первые 500 символов): {extracted_text[:500]}...")
-
-        text_prompt = build_text_analysis_prompt(
-            archive_path,
-            archive_content,
-            file_obj['name'],
-            extracted_text
-        )
-        text_response = send_to_llm(text_prompt)
-        handle_llm_decision(archive_path, archive_content, text_response, auto_rename)
-    else:
-        logging.warning("LLM вернула неизвестное решение")
-
-def analyze_archive(archive_path, auto_rename=False):
-    logger.info("Анализируем содержимое архива...")
-
-    tmp_dir = tempfile.mkdtemp()
-    files_list = []
-    try:
-        import patoolib
-        patoolib.extract_archive(archive_path, outdir=tmp_dir)
-    except Exception as e:
-        logger.error(f"Не удалось распаковать архив: {e}")
-        return
-
-    for root, _, files in os.walk(tmp_dir):
-        for f in files:
-            file_path = os.path.join(root, f)
-            size = os.path.getsize(file_path)
-            files_list.append({
-                'name': f,
-                'path': file_path,
-                'type': 'file',
-                'size': size
-            })
-
-    archive_content = {'files': files_list, 'metadata_content': {}}
-    logger.debug(f"Содержимое архива: {archive_content}")
-
-    prompt = build_initial_prompt(os.path.basename(archive_path), archive_content)
-    response_str = send_to_llm(prompt)
-    try:
-        response = json.loads(response_str)
-        handle_llm_decision(archive_path, archive_content, response, auto_rename)
-    except Exception as e:
-        logger.error(f"Ошибка разбора JSON ответа LLM: {e}")
-
-    shutil.rmtree(tmp_dir, ignore_errors=True)
-
-def main():
-    parser = argparse.ArgumentParser(description="Авто-переименование архивов")
-    parser.add_argument("--file", required=True, help="Путь к архиву")
-    parser.add_argument("--rename", action="store_true", help="Автоматически применять предложенное имя")
-    args = parser.parse_args()
-
-    if not os.path.exists(args.file):
-        logger.error(f"Файл не найден: {args.file}")
-        return
-
-    analyze_archive(args.file, auto_rename=args.rename)
-
-if __name__ == "__main__":
-    main()
+﻿import re
+import os
+import sys
+import json
+import time
+import logging
+import tempfile
+import shutil
+import asyncio
+import argparse
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional
+from file_tools import rank_documents, extract_text_data
+from llm_client import send_to_llm, arequest_batch_decisions, get_llm_client
+from prompts import build_initial_prompt, build_text_analysis_prompt, build_batch_prompt, build_combined_prompt
+from formats import get_handler_for_file, get_file_metadata, release_documents
+from archive_tools import ArchiveReader
+from tracing import stage_timer, span, task_profile, configure_tracing, write_chrome_trace, profile_report
+from library_index import get_index, watch_directory
+from naming import pick_metadata_source, name_from_metadata, set_metadata_naming, is_metadata_naming_enabled
+from result_cache import get_cache, set_cache_enabled
+from batch import collect_archives, run_batch, iter_pool, merge_stage_results, summarize_batch, format_summary
+from config import BATCH_WORKERS, LLM_MAX_CONCURRENCY, LLM_BATCH_SIZE, ONE_SHOT_ANALYSIS, PREFETCH_TEXT_CHARS, \
+    PREFETCH_CANDIDATES
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    level=logging.DEBUG,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+def rename_file(old_path, new_name) -> Optional[str]:
+    """Переименовывает файл с сохранением пути; возвращает новый путь или None"""
+    dir_path = os.path.dirname(old_path)
+    new_path = os.path.join(dir_path, new_name)
+    if os.path.exists(new_path) and os.path.abspath(new_path) != os.path.abspath(old_path):
+        logger.error(f"Файл с таким именем уже существует: {new_path}")
+        return None
+    try:
+        os.rename(old_path, new_path)
+        logger.info(f"Файл переименован: {old_path} → {new_path}")
+        print(f"Файл переименован: {new_path}")
+        return new_path
+    except Exception as e:
+        logger.error(f"Ошибка при переименовании файла: {e}")
+        return None
+
+def apply_new_name(archive_path, new_name, auto_rename=False) -> Optional[str]:
+    """
+    Применяет предложенное имя: сразу или после подтверждения пользователя.
+    Возвращает новый путь, если архив переименован
+    """
+    logging.info(f"Предлагаемое имя архива: {new_name}")
+    print(new_name)
+    if auto_rename:
+        return rename_file(archive_path, new_name)
+    answer = input(f"Переименовать архив в '{new_name}'? [y/N]: ").strip().lower()
+    if answer == 'y':
+        return rename_file(archive_path, new_name)
+    return None
+
+def resolve_llm_decision(archive_path, archive_content, llm_response, stats=None, archive=None) -> Optional[str]:
+    """
+    Обрабатывает ответ LLM, включая извлечение текста, и возвращает предложенное имя.
+    llm_response может быть строкой JSON или уже словарем.
+    archive (ArchiveReader) используется для извлечения выбранного файла по требованию.
+    """
+    # Если пришла строка, пытаемся преобразовать в dict
+    if isinstance(llm_response, str):
+        cleaned_response_str = re.sub(r'```.*?```', '', llm_response, flags=re.DOTALL).strip()
+        try:
+            llm_response = json.loads(cleaned_response_str)
+        except json.JSONDecodeError as e:
+            logging.error(f"Ошибка разбора JSON ответа LLM: {e}\nОтвет (обрезано 500 символов): {cleaned_response_str[:500]}")
+            return None
+    elif not isinstance(llm_response, dict):
+        logging.error(f"LLM вернула неожиданный тип: {type(llm_response)}")
+        return None
+
+    decision = llm_response.get('decision')
+    if decision == 'rename':
+        return llm_response.get('new_name')
+    elif decision == 'need_more_data':
+        target_file = llm_response.get('target')
+        parameters = llm_response.get('parameters', {})
+
+        # target может быть именем файла или путем внутри архива (как в описании для LLM)
+        file_obj = next((f for f in archive_content['files']
+                         if target_file in (f['name'], f.get('member'))), None)
+        if not file_obj:
+            # Первый по рангу документ, который еще не оказался пустым
+            file_obj = next((f for f in rank_documents(archive_content['files'])
+                             if f.get('text_layer') is not False), None)
+            if not file_obj:
+                logging.error("В архиве не найдено подходящих файлов для обработки")
+                return None
+            logging.info(f"Найден fallback файл: {file_obj['name']}")
+
+        if not file_obj.get('path'):
+            with stage_timer(stats, 'extract'):
+                try:
+                    archive.extract_member(file_obj)
+                except Exception as e:
+                    logging.error(f"Не удалось извлечь файл {file_obj['name']} из архива: {e}")
+                    return None
+
+        with stage_timer(stats, 'text'):
+            extracted_text = extract_text_data(file_obj['path'], parameters)
+        logging.debug(f"Извлечено данных (первые 500 символов): {extracted_text[:500]}...")
+
+        text_prompt = build_text_analysis_prompt(
+            archive_path,
+            archive_content,
+            file_obj['name'],
+            extracted_text
+        )
+        with stage_timer(stats, 'llm'):
+            text_response = send_to_llm(text_prompt)
+        return resolve_llm_decision(archive_path, archive_content, text_response, stats, archive)
+    else:
+        logging.warning("LLM вернула неизвестное решение")
+        return None
+
+def handle_llm_decision(archive_path, archive_content, llm_response, auto_rename=False, archive=None):
+    """
+    Обрабатывает ответ LLM, включая извлечение текста и предложение имени.
+    llm_response может быть строкой JSON или уже словарем.
+    """
+    new_name = resolve_llm_decision(archive_path, archive_content, llm_response, archive=archive)
+    if new_name:
+        apply_new_name(archive_path, new_name, auto_rename)
+
+def _cached_decision(archive_path, stats=None):
+    """Возвращает (хэш архива, имя из кэша); архив или его копия могли уже анализироваться"""
+    cache = get_cache()
+    if cache is None:
+        return None, None
+    with stage_timer(stats, 'cache'):
+        try:
+            archive_hash = cache.archive_hash(archive_path)
+            return archive_hash, cache.get(cache.DECISION, archive_hash)
+        except Exception as e:
+            logger.warning(f"Ошибка чтения кэша: {e}")
+            return None, None
+
+def _store_decision(archive_hash, new_name):
+    """Сохраняет итоговое имя архива в кэш"""
+    cache = get_cache()
+    if cache is not None and archive_hash and new_name:
+        try:
+            cache.put(cache.DECISION, archive_hash, new_name)
+        except Exception as e:
+            logger.warning(f"Ошибка записи в кэш: {e}")
+
+def propose_archive_name(archive_path, initial_response=None, stats=None, one_shot=False) -> Optional[str]:
+    """
+    Анализирует архив и возвращает предложенное LLM имя (без переименования).
+    initial_response - уже полученный ответ LLM на описание архива (пакетный режим).
+    one_shot - сразу передать в LLM метаданные и начало текста основного документа.
+    Время этапов добавляется в stats, если он передан.
+    """
+    logger.info(f"Анализируем содержимое архива {archive_path}...")
+
+    archive_hash, cached = _cached_decision(archive_path, stats)
+    if cached:
+        logger.info(f"Решение для архива взято из кэша: {cached}")
+        return cached
+
+    new_name = _analyze_archive_content(archive_path, stats, initial_response, one_shot)
+    _store_decision(archive_hash, new_name)
+    return new_name
+
+def _prefetch_main_document(archive, files_list, stats=None):
+    """
+    Извлекает основной документ и параллельно получает его метаданные и начало текста.
+    Кандидаты перебираются в порядке ранжирования, пока один из них не даст текст
+    (не более PREFETCH_CANDIDATES). Возвращает (имя документа, метаданные, текст)
+    """
+    candidates = rank_documents(files_list)[:PREFETCH_CANDIDATES]
+    if not candidates:
+        return "", {}, ""
+
+    result = (candidates[0]['name'], {}, "")
+    for file_obj in candidates:
+        with stage_timer(stats, 'extract'):
+            try:
+                file_path = archive.extract_member(file_obj)
+            except Exception as e:
+                logger.error(f"Не удалось извлечь файл {file_obj['name']} из архива: {e}")
+                continue
+
+        parameters = {'type': 'first_chars', 'amount': PREFETCH_TEXT_CHARS}
+        with stage_timer(stats, 'prefetch'), ThreadPoolExecutor(max_workers=2) as pool:
+            metadata_future = pool.submit(get_file_metadata, file_path)
+            text_future = pool.submit(extract_text_data, file_path, parameters)
+            try:
+                metadata = metadata_future.result()
+            except Exception as e:
+                logger.warning(f"Не удалось получить метаданные {file_obj['name']}: {e}")
+                metadata = {}
+            extracted_text = text_future.result()
+
+        has_text = bool(extracted_text.strip()) and not extracted_text.startswith("Ошибка")
+        file_obj['text_layer'] = has_text
+        if has_text:
+            return file_obj['name'], metadata, extracted_text
+        if not result[1] and metadata:
+            result = (file_obj['name'], metadata, "")
+        logger.info(f"Файл {file_obj['name']} не дал текста, пробуем следующий кандидат")
+
+    return result
+
+def _metadata_name(archive_path, archive, files_list, stats=None) -> Optional[str]:
+    """
+    Имя по метаданным основного документа без обращения к LLM.
+    None, если метаданных недостаточно или основной документ неоднозначен
+    """
+    if not is_metadata_naming_enabled():
+        return None
+    file_obj = pick_metadata_source(files_list)
+    if not file_obj:
+        return None
+
+    with stage_timer(stats, 'extract'):
+        try:
+            file_path = archive.extract_member(file_obj)
+        except Exception as e:
+            logger.error(f"Не удалось извлечь файл {file_obj['name']} из архива: {e}")
+            return None
+
+    with stage_timer(stats, 'metadata'):
+        metadata = get_file_metadata(file_path)
+    new_name = name_from_metadata(metadata, archive_path, file_obj['name'])
+    if new_name:
+        logger.info(f"Имя по метаданным {file_obj['name']}: {new_name}")
+    return new_name
+
+def _analyze_archive_content(archive_path, stats=None, initial_response=None, one_shot=False) -> Optional[str]:
+    """Читает архив и получает решение LLM"""
+    tmp_dir = tempfile.mkdtemp()
+    archive = None
+    try:
+        # Читаем только оглавление архива; файлы извлекаются по требованию
+        with stage_timer(stats, 'scan'):
+            try:
+                archive = ArchiveReader(archive_path, tmp_dir)
+                files_list = archive.list_files()
+                archive.sniff_members(files_list)
+                archive.expand_nested(files_list)
+            except Exception as e:
+                logger.error(f"Не удалось прочитать архив: {e}")
+                return None
+
+        archive_content = {'files': files_list, 'metadata_content': {}}
+        logger.debug(f"Содержимое архива: {archive_content}")
+
+        if initial_response is not None:
+            return resolve_llm_decision(archive_path, archive_content, initial_response, stats, archive)
+
+        new_name = _metadata_name(archive_path, archive, files_list, stats)
+        if new_name:
+            return new_name
+
+        if one_shot:
+            main_doc, metadata, extracted_text = _prefetch_main_document(archive, files_list, stats)
+            prompt = build_combined_prompt(os.path.basename(archive_path), archive_content,
+                                           main_doc, metadata, extracted_text)
+        else:
+            prompt = build_initial_prompt(os.path.basename(archive_path), archive_content)
+        with stage_timer(stats, 'llm'):
+            response_str = send_to_llm(prompt)
+        try:
+            response = json.loads(response_str)
+        except Exception as e:
+            logger.error(f"Ошибка разбора JSON ответа LLM: {e}")
+            return None
+        return resolve_llm_decision(archive_path, archive_content, response, stats, archive)
+    finally:
+        if archive is not None:
+            archive.close()
+        release_documents()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def scan_archive_listing(archive_path, stats=None) -> Optional[Dict[str, Any]]:
+    """
+    Первый этап пакетного режима с объединением запросов: оглавление архива
+    для общего промпта или готовое имя из кэша
+    """
+    archive_hash, cached = _cached_decision(archive_path, stats)
+    if cached:
+        return {'new_name': cached}
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        with ArchiveReader(archive_path, tmp_dir) as archive:
+            with stage_timer(stats, 'scan'):
+                files_list = archive.list_files()
+                archive.sniff_members(files_list)
+                archive.expand_nested(files_list)
+            # Архивы с хорошими метаданными не попадают в пакетные запросы к LLM
+            new_name = _metadata_name(archive_path, archive, files_list, stats)
+    finally:
+        release_documents()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if new_name:
+        _store_decision(archive_hash, new_name)
+        return {'new_name': new_name}
+
+    # Пути во временном каталоге после этого этапа недействительны
+    for file_info in files_list:
+        file_info.pop('path', None)
+    return {
+        'archive_hash': archive_hash,
+        'archive_content': {'files': files_list, 'metadata_content': {}}
+    }
+
+async def _request_batch_decisions(chunks):
+    """Отправляет пакетные запросы параллельно (в пределах лимита клиента LLM)"""
+    results = await asyncio.gather(*[arequest_batch_decisions(chunk, build_batch_prompt) for chunk in chunks])
+    decisions = {}
+    for result in results:
+        decisions.update(result)
+    return decisions
+
+def analyze_archive(archive_path, auto_rename=False, one_shot=False):
+    with task_profile(), span('archive', path=os.path.basename(archive_path)):
+        new_name = propose_archive_name(archive_path, one_shot=one_shot)
+    if new_name:
+        apply_new_name(archive_path, new_name, auto_rename)
+
+def _configure_worker(use_cache, metadata_naming=True):
+    """
+    Настройка процесса пакетной обработки: кэш, имена по метаданным и OCR без вложенного пула процессов.
+    При обработке в текущем процессе (workers == 1) пул OCR сохраняется
+    """
+    from formats.ocr_utils import configure_ocr_engine
+    set_cache_enabled(use_cache)
+    set_metadata_naming(metadata_naming)
+    if multiprocessing.parent_process() is not None:
+        configure_ocr_engine(workers=1)
+
+def analyze_library(archive_paths, auto_rename=False, workers=None, llm_slots=None, use_cache=True, llm_batch=1,
+                    one_shot=False, metadata_naming=True, index=None):
+    """
+    Пакетная обработка архивов с выводом итоговой статистики.
+    one_shot несовместим с llm_batch > 1 (пакетный запрос содержит только оглавления).
+    index (LibraryIndex) - индекс, в который записываются результаты и переименования
+    """
+    if one_shot and llm_batch > 1:
+        raise ValueError("one_shot нельзя использовать вместе с llm_batch > 1")
+
+    def on_result(result):
+        if index is not None:
+            index.record(result['path'], result['result'], result['error'])
+        if result['result']:
+            new_path = apply_new_name(result['path'], result['result'], auto_rename)
+            if new_path and index is not None:
+                index.record_rename(result['path'], new_path)
+
+    pool_options = {
+        'workers': workers,
+        'llm_slots': llm_slots,
+        'initializer': _configure_worker,
+        'initargs': (use_cache, metadata_naming)
+    }
+    if llm_batch > 1:
+        summary = _analyze_library_batched(archive_paths, llm_batch, on_result, pool_options)
+    else:
+        analyze = functools.partial(propose_archive_name, one_shot=one_shot)
+        summary = run_batch(archive_paths, analyze, on_result=on_result, **pool_options)
+    print(format_summary(summary))
+    return summary
+
+def _analyze_library_batched(archive_paths, llm_batch, on_result, pool_options):
+    """
+    Пакетная обработка с объединением описаний нескольких архивов в один запрос к LLM:
+    оглавления читаются в пуле процессов, затем по llm_batch архивов отправляются
+    одним запросом, а архивы, для которых LLM запросила текст, дообрабатываются в пуле
+    """
+    start = time.perf_counter()
+    final_results = []
+    scanned = {}
+
+    def finish(result):
+        final_results.append(result)
+        on_result(result)
+
+    tasks = [(archive_path, ()) for archive_path in archive_paths]
+    for result in iter_pool(scan_archive_listing, tasks, **pool_options):
+        listing = result['result']
+        if listing and listing.get('new_name'):
+            finish(dict(result, result=listing['new_name']))
+        elif listing:
+            scanned[result['path']] = result
+        else:
+            finish(result)
+
+    if scanned:
+        paths_by_id = {str(i): archive_path for i, archive_path in enumerate(scanned)}
+        entries = [
+            (entry_id, {
+                'archive_name': os.path.basename(archive_path),
+                'archive_content': scanned[archive_path]['result']['archive_content']
+            })
+            for entry_id, archive_path in paths_by_id.items()
+        ]
+        chunks = [dict(entries[i:i + llm_batch]) for i in range(0, len(entries), llm_batch)]
+        logger.info(f"Запросы к LLM: {len(chunks)} пакетов по {llm_batch} архивов")
+
+        get_llm_client().max_concurrency = pool_options['llm_slots'] or LLM_MAX_CONCURRENCY
+        llm_start = time.perf_counter()
+        with span('llm.batch', archives=len(scanned), requests=len(chunks)):
+            decisions = asyncio.run(_request_batch_decisions(chunks))
+        # Время пакетных запросов распределяем между архивами поровну
+        llm_share = (time.perf_counter() - llm_start) / len(scanned)
+
+        tasks = []
+        for entry_id, archive_path in paths_by_id.items():
+            result = scanned[archive_path]
+            result['stages']['llm'] = result['stages'].get('llm', 0.0) + llm_share
+            decision = decisions.get(entry_id)
+            if decision and decision['decision'] == 'rename':
+                _store_decision(result['result']['archive_hash'], decision['new_name'])
+                finish(dict(result, result=decision['new_name']))
+            else:
+                # need_more_data или ответ не разобран (None) - дообработка по одному архиву
+                tasks.append((archive_path, (decision,)))
+
+        for result in iter_pool(propose_archive_name, tasks, **pool_options):
+            finish(merge_stage_results(scanned[result['path']], result))
+
+    return summarize_batch(final_results, time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description="Авто-переименование архивов")
+    parser.add_argument("--file", help="Путь к архиву")
+    parser.add_argument("--dir", help="Каталог библиотеки для пакетной обработки (обходится рекурсивно)")
+    parser.add_argument("--glob", help="Шаблон имен архивов для --dir или glob-путь (например, 'Books/**/*.rar')")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS,
+                        help="Число процессов для распаковки и OCR в пакетном режиме")
+    parser.add_argument("--llm-slots", type=int, default=LLM_MAX_CONCURRENCY,
+                        help="Максимум одновременных запросов к LLM в пакетном режиме")
+    parser.add_argument("--llm-batch", type=int, default=LLM_BATCH_SIZE,
+                        help="Сколько архивов описывать в одном запросе к LLM в пакетном режиме")
+    parser.add_argument("--one-shot", action="store_true", default=ONE_SHOT_ANALYSIS,
+                        help="Сразу передавать в LLM метаданные и начало текста основного документа (один запрос вместо двух)")
+    parser.add_argument("--no-cache", action="store_true", help="Не использовать кэш результатов")
+    parser.add_argument("--no-metadata-names", action="store_true",
+                        help="Не называть архивы по метаданным документа без обращения к LLM")
+    parser.add_argument("--rename", action="store_true", help="Автоматически применять предложенное имя")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Обрабатывать только новые и измененные архивы (по индексу библиотеки)")
+    parser.add_argument("--watch", action="store_true",
+                        help="После обработки следить за каталогом --dir и обрабатывать новые архивы")
+    parser.add_argument("--trace", metavar="OUT.json",
+                        help="Сохранить интервалы этапов в формате Chrome Trace (chrome://tracing, Perfetto)")
+    parser.add_argument("--profile", nargs="?", const="", metavar="OUT.prof",
+                        help="Профилировать обработку (cProfile) и вывести время по этапам; "
+                             "с именем файла - сохранить статистику в формате pstats")
+    args = parser.parse_args()
+
+    configure_tracing(trace=bool(args.trace), profile=args.profile is not None)
+    try:
+        _run(parser, args)
+    finally:
+        if args.trace:
+            write_chrome_trace(args.trace)
+        if args.profile is not None:
+            print(profile_report(args.profile or None))
+
+def _run(parser, args):
+    """Обработка архивов по разобранным аргументам командной строки"""
+    if args.no_cache:
+        set_cache_enabled(False)
+    if args.no_metadata_names:
+        set_metadata_naming(False)
+
+    if args.file and (args.dir or args.glob):
+        parser.error("--file нельзя использовать вместе с --dir/--glob")
+    if not (args.file or args.dir or args.glob):
+        parser.error("укажите --file, --dir или --glob")
+    if args.watch and not args.dir:
+        parser.error("--watch используется только с --dir")
+    if args.one_shot and args.llm_batch > 1 and not args.file:
+        # В пакетном запросе к LLM уходят только оглавления архивов, без текста основного документа
+        parser.error("--one-shot нельзя использовать вместе с --llm-batch больше 1")
+
+    if args.file:
+        if not os.path.exists(args.file):
+            logger.error(f"Файл не найден: {args.file}")
+            return
+        analyze_archive(args.file, auto_rename=args.rename, one_shot=args.one_shot)
+        return
+
+    if args.dir and not os.path.isdir(args.dir):
+        logger.error(f"Каталог не найден: {args.dir}")
+        return
+
+    index = None
+    if args.incremental or args.watch:
+        index = get_index()
+        if index is None:
+            return
+
+    process = functools.partial(analyze_library, auto_rename=args.rename, workers=args.workers,
+                                llm_slots=args.llm_slots, use_cache=not args.no_cache, llm_batch=args.llm_batch,
+                                one_shot=args.one_shot, metadata_naming=not args.no_metadata_names, index=index)
+
+    archive_paths = collect_archives(args.dir, args.glob)
+    if not archive_paths and not args.watch:
+        logger.error("Не найдено архивов для обработки")
+        return
+    logger.info(f"Найдено архивов для обработки: {len(archive_paths)}")
+    if index is not None:
+        archive_paths = index.pending(archive_paths)
+        logger.info(f"Новых или измененных архивов: {len(archive_paths)}")
+    if archive_paths:
+        process(archive_paths)
+
+    if args.watch:
+        watch_directory(args.dir, process, index, args.glob)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import os
+import re
+from typing import Dict, Any, List
+from config import MANIFEST_TOKEN_BUDGET
+from formats.sniff import effective_type
+
+# Примерное число символов на токен (с запасом для кириллицы)
+CHARS_PER_TOKEN = 3
+
+# Минимальное число файлов с общим шаблоном имени, которое сворачивается в диапазон
+MIN_SEQUENCE_LENGTH = 3
+
+# Сколько непрерывных диапазонов номеров показывать для одной последовательности
+MAX_SEQUENCE_RUNS = 3
+
+# Доля бюджета на содержимое метафайлов (FILE_ID.DIZ, readme и т.п.)
+METADATA_BUDGET_SHARE = 0.3
+
+# Расширения документов: их группы выводятся первыми
+DOCUMENT_EXTENSIONS = ['.pdf', '.djvu', '.epub', '.fb2', '.docx', '.doc', '.txt', '.zip', '.rar']
+
+_SEQUENCE_RE = re.compile(r'^(.*?)(\d+)(\D*)$')
+
+
+def format_size(size: int) -> str:
+    """Размер в удобочитаемом виде"""
+    size = size or 0
+    for unit in ['Б', 'КБ', 'МБ']:
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == 'Б' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+
+def _file_type(file_info: Dict[str, Any]) -> str:
+    """Тип файла: по содержимому, если он определен, иначе по расширению"""
+    return effective_type(file_info['name'], file_info.get('kind'))
+
+
+def _file_label(file_info: Dict[str, Any]) -> str:
+    """
+    Имя файла для манифеста: путь внутри архива без временных каталогов.
+    Если содержимое не соответствует расширению, настоящий тип указывается в скобках
+    """
+    label = (file_info.get('member') or file_info['name']).replace('\\', '/')
+    kind = _file_type(file_info)
+    if kind and kind != os.path.splitext(file_info['name'])[1].lower():
+        label += f" [{kind[1:]}]"
+    return label
+
+
+def _format_runs(numbers: List[tuple]) -> str:
+    """Сворачивает отсортированные номера [(число, исходная строка)] в диапазоны"""
+    runs = []
+    start = prev = numbers[0]
+    for item in numbers[1:]:
+        if item[0] != prev[0] + 1:
+            runs.append((start, prev))
+            start = item
+        prev = item
+    runs.append((start, prev))
+
+    parts = [a[1] if a[0] == b[0] else f"{a[1]}-{b[1]}" for a, b in runs[:MAX_SEQUENCE_RUNS]]
+    if len(runs) > MAX_SEQUENCE_RUNS:
+        parts.append('…')
+    return ','.join(parts)
+
+
+def collapse_sequences(files: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Сворачивает нумерованные последовательности файлов (page_0001.jpg … page_0900.jpg)
+    в одну запись page_[0001-0900].jpg. Возвращает записи {'label', 'count', 'size'}
+    """
+    buckets = {}
+    entries = []
+
+    for file_info in files:
+        label = _file_label(file_info)
+        stem, ext = os.path.splitext(label)
+        match = _SEQUENCE_RE.match(stem)
+        if match:
+            key = (match.group(1), match.group(3) + ext)
+            buckets.setdefault(key, []).append((int(match.group(2)), match.group(2), file_info))
+        else:
+            entries.append({'label': label, 'count': 1, 'size': file_info.get('size') or 0})
+
+    for (prefix, suffix), items in buckets.items():
+        if len(items) < MIN_SEQUENCE_LENGTH:
+            for _, _, file_info in items:
+                entries.append({'label': _file_label(file_info), 'count': 1, 'size': file_info.get('size') or 0})
+            continue
+        items.sort(key=lambda item: (item[0], item[1]))
+        numbers = [(number, text) for number, text, _ in items]
+        entries.append({
+            'label': f"{prefix}[{_format_runs(numbers)}]{suffix}",
+            'count': len(items),
+            'size': sum(file_info.get('size') or 0 for _, _, file_info in items)
+        })
+
+    # Детерминированный порядок: крупные записи первыми, затем по имени
+    entries.sort(key=lambda e: (-e['size'], e['label']))
+    return entries
+
+
+def _group_by_extension(files: List[Dict[str, Any]]) -> List[tuple]:
+    """Группы файлов по типу: сначала документы, затем по убыванию общего размера"""
+    groups = {}
+    for file_info in files:
+        groups.setdefault(_file_type(file_info), []).append(file_info)
+
+    def order(item):
+        ext, group = item
+        is_document = ext in DOCUMENT_EXTENSIONS
+        return (not is_document, -sum(f.get('size') or 0 for f in group), ext)
+
+    return sorted(groups.items(), key=order)
+
+
+def build_manifest(archive_content: Dict[str, Any], token_budget: int = MANIFEST_TOKEN_BUDGET) -> str:
+    """
+    Компактное описание содержимого архива для промпта: файлы сгруппированы
+    по расширению, нумерованные последовательности свернуты в диапазоны,
+    временные пути не выводятся. Если описание не помещается в token_budget,
+    строки отбрасываются в фиксированном порядке (сначала мелкие файлы
+    второстепенных типов), а вместо них выводится число пропущенных файлов
+    """
+    files = [f for f in archive_content.get('files', []) if f.get('type', 'file') == 'file']
+    budget = token_budget * CHARS_PER_TOKEN
+    total_size = sum(f.get('size') or 0 for f in files)
+
+    lines = [f"Всего файлов: {len(files)}, общий размер: {format_size(total_size)}"]
+    used = len(lines[0])
+
+    metadata_files = archive_content.get('metadata_content', {})
+    if metadata_files:
+        metadata_budget = int(budget * METADATA_BUDGET_SHARE) // len(metadata_files)
+        lines.append("Метафайлы:")
+        for name, content in sorted(metadata_files.items()):
+            text = ' '.join(str(content).split())[:metadata_budget]
+            lines.append(f"  {name}: {text}")
+            used += len(lines[-1]) + 1
+
+    omitted_files = 0
+    omitted_size = 0
+    for ext, group in _group_by_extension(files):
+        group_size = sum(f.get('size') or 0 for f in group)
+        header = f"{ext or '(без расширения)'} – {len(group)} шт., {format_size(group_size)}:"
+        if used + len(header) > budget:
+            omitted_files += len(group)
+            omitted_size += group_size
+            continue
+        lines.append(header)
+        used += len(header) + 1
+
+        for entry in collapse_sequences(group):
+            if entry['count'] > 1:
+                line = f"  {entry['label']} ({entry['count']} шт., {format_size(entry['size'])})"
+            else:
+                line = f"  {entry['label']} ({format_size(entry['size'])})"
+            if used + len(line) > budget:
+                omitted_files += entry['count']
+                omitted_size += entry['size']
+                continue
+            lines.append(line)
+            used += len(line) + 1
+
+    if omitted_files:
+        lines.append(f"… и ещё {omitted_files} файлов ({format_size(omitted_size)}), не показаны для краткости")
+
+    return "\n".join(lines)
@@ -0,0 +1,174 @@
+import os
+import re
+import string
+import logging
+from typing import Dict, Any, List, Optional
+from file_tools import rank_documents, document_features, TEXT_TYPES
+from config import METADATA_NAMING, NAME_TEMPLATES, METADATA_MIN_QUALITY
+
+logger = logging.getLogger(__name__)
+
+# Форматы, в которых метаданные обычно заполнены автором или издателем
+METADATA_TYPES = ['.epub', '.fb2', '.pdf', '.docx', '.djvu']
+
+# Вклад полей в оценку качества метаданных
+TITLE_WEIGHT = 0.6
+AUTHOR_WEIGHT = 0.3
+YEAR_WEIGHT = 0.1
+
+MAX_NAME_LENGTH = 150
+
+# Значения, которые программы подставляют по умолчанию
+GENERIC_TITLES = {
+    'untitled', 'без названия', 'безымянный', 'document', 'документ', 'title', 'заголовок',
+    'unknown', 'noname', 'new document', 'новый документ', 'book', 'книга', 'слайд 1', 'slide 1'
+}
+GENERIC_AUTHORS = {
+    'unknown', 'неизвестен', 'неизвестный', 'неизвестный автор', 'автор', 'author', 'admin',
+    'administrator', 'администратор', 'user', 'пользователь', 'owner', 'home', 'pc', 'customer'
+}
+
+# Префиксы, которые добавляют драйверы печати в PDF
+_PRINTER_PREFIX_RE = re.compile(r'^(microsoft (word|powerpoint|excel)|документ microsoft word)\s*-\s*', re.I)
+_FILE_EXTENSION_RE = re.compile(r'\.(docx?|pdf|rtf|txt|odt|djvu|epub|fb2|indd|qxd|tex)$', re.I)
+_YEAR_RE = re.compile(r'(?<!\d)(1[5-9]\d\d|20\d\d)(?!\d)')
+_INVALID_CHARS_RE = re.compile(r'[<>"/\\|?*\x00-\x1f]')
+
+_enabled = METADATA_NAMING
+
+
+def set_metadata_naming(enabled: bool) -> None:
+    """Включает или отключает имена по метаданным для текущего процесса"""
+    global _enabled
+    _enabled = enabled
+
+
+def is_metadata_naming_enabled() -> bool:
+    return _enabled
+
+
+def _normalize(value: Any) -> str:
+    return ' '.join(str(value or '').split())
+
+
+def _looks_garbled(text: str) -> bool:
+    """Признаки неверной кодировки: символы замены, '????' или UTF-8, прочитанный как cp1251"""
+    if '\ufffd' in text or '??' in text or re.search('[ÐÑ][\x80-\xbf]', text):
+        return True
+    cyrillic = [c for c in text if '\u0400' <= c <= '\u04ff']
+    return len(cyrillic) >= 4 and sum(1 for c in cyrillic if c in 'РС') > len(cyrillic) * 0.4
+
+
+def _is_meaningful(text: str, generic: set) -> bool:
+    if not 2 <= len(text) <= 200 or text.lower() in generic:
+        return False
+    letters = sum(1 for c in text if c.isalpha())
+    return letters >= len(text) * 0.5 and not _looks_garbled(text)
+
+
+def clean_title(title: Any, file_name: str = '') -> Optional[str]:
+    """Название без мусора от программ верстки; None, если оно неинформативно"""
+    title = _PRINTER_PREFIX_RE.sub('', _normalize(title))
+    title = _FILE_EXTENSION_RE.sub('', title).strip(' .-_')
+    if not _is_meaningful(title, GENERIC_TITLES):
+        return None
+    # Название, совпадающее с именем файла, ничего не добавляет
+    if file_name and title.lower() == os.path.splitext(file_name)[0].lower().replace('_', ' '):
+        return None
+    return title
+
+
+def clean_author(author: Any) -> Optional[str]:
+    """Автор (не более трех); None для пустых и служебных значений"""
+    authors = [_normalize(a) for a in re.split(r'[;,&]| and | и ', _normalize(author))]
+    authors = [a for a in authors if _is_meaningful(a, GENERIC_AUTHORS)]
+    if not authors:
+        return None
+    if len(authors) > 3:
+        return f"{', '.join(authors[:3])} и др."
+    return ', '.join(authors)
+
+
+def extract_year(metadata: Dict[str, Any]) -> Optional[str]:
+    """Год издания (даты создания файла в PDF и DOCX не считаются годом издания)"""
+    for key in ('year', 'date'):
+        match = _YEAR_RE.search(_normalize(metadata.get(key)))
+        if match:
+            return match.group(1)
+    return None
+
+
+def metadata_fields(metadata: Dict[str, Any], file_name: str = '') -> Dict[str, str]:
+    """Очищенные поля для шаблонов имени: title, author, year, series, language"""
+    fields = {
+        'title': clean_title(metadata.get('title'), file_name),
+        'author': clean_author(metadata.get('author')),
+        'year': extract_year(metadata),
+        'series': _normalize(metadata.get('series')) or None,
+        'language': _normalize(metadata.get('language')) or None,
+    }
+    return {k: v for k, v in fields.items() if v}
+
+
+def metadata_quality(fields: Dict[str, str]) -> float:
+    """Оценка полноты метаданных от 0 до 1; без названия - 0"""
+    if 'title' not in fields:
+        return 0.0
+    score = TITLE_WEIGHT
+    if 'author' in fields:
+        score += AUTHOR_WEIGHT
+    if 'year' in fields:
+        score += YEAR_WEIGHT
+    return round(score, 2)
+
+
+def sanitize_file_name(name: str) -> str:
+    """Имя, допустимое в Windows и Linux"""
+    name = name.replace(':', ' -').replace('/', '-').replace('\\', '-')
+    name = _INVALID_CHARS_RE.sub('', name)
+    name = ' '.join(name.split())
+    return name[:MAX_NAME_LENGTH].rstrip(' .')
+
+
+def render_name(fields: Dict[str, str], templates: List[str] = None) -> Optional[str]:
+    """Имя по первому шаблону, для которого известны все поля"""
+    for template in templates or NAME_TEMPLATES:
+        placeholders = [name for _, name, _, _ in string.Formatter().parse(template) if name]
+        if all(name in fields for name in placeholders):
+            return sanitize_file_name(template.format(**fields))
+    return None
+
+
+def pick_metadata_source(files_list: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Документ, по метаданным которого можно назвать архив. None, если документов
+    с метаданными нет или в архиве несколько разных книг (такие случаи решает LLM)
+    """
+    features = document_features(files_list)
+    documents = [f for f in rank_documents(files_list) if features[id(f)]['type'] in METADATA_TYPES + TEXT_TYPES]
+    if not documents or features[id(documents[0])]['type'] not in METADATA_TYPES:
+        return None
+
+    # Один документ в нескольких форматах - одна книга, разные имена (кроме cover, sample и т.п.) - сборник
+    stems = {os.path.splitext(f['name'])[0].lower() for f in documents
+             if features[id(f)]['type'] in METADATA_TYPES and not features[id(f)]['secondary_name']}
+    if len(stems) > 1:
+        return None
+    return documents[0]
+
+
+def name_from_metadata(metadata: Dict[str, Any], archive_path: str, file_name: str = '') -> Optional[str]:
+    """
+    Имя архива по метаданным основного документа или None, если их качество
+    ниже METADATA_MIN_QUALITY (тогда архив передается LLM)
+    """
+    fields = metadata_fields(metadata, file_name)
+    quality = metadata_quality(fields)
+    if quality < METADATA_MIN_QUALITY:
+        logger.debug(f"Метаданные недостаточно полные ({quality:.1f}): {fields}")
+        return None
+
+    name = render_name(fields)
+    if not name:
+        return None
+    return name + os.path.splitext(archive_path)[1]
@@ -1,74 +1,160 @@
-﻿import os
-import json
-from typing import Dict, Any
-from file_tools import identify_main_document
-
-def build_initial_prompt(archive_name: str, archive_content: Dict[str, Any]) -> str:
-    """
-    Строит первоначальный промпт для LLM
-    """
-    # Автоматически определяем основной документ
-    main_doc = identify_main_document(archive_content['files'])
-
-    # Приоритет для FILE_ID.DIZ, readme* и nfo
-    metadata_files = archive_content.get('metadata_content', {})
-    priority_meta = list(metadata_files.keys())
-    if priority_meta:
-        main_doc_desc = f"{main_doc if main_doc else 'Не определен'} (метафайл для анализа: {', '.join(priority_meta)})"
-    else:
-        main_doc_desc = main_doc if main_doc else 'Не определен'
-
-    prompt = f"""
-Анализируй структуру архива и доступные метаданные. 
-
-Исходное имя архива: "{archive_name}"
-Расширение архива: "{os.path.splitext(archive_name)[1]}"
-Основной документ внутри: "{main_doc_desc}"
-
-Содержимое архива:
-{json.dumps(archive_content, ensure_ascii=False, indent=2)}
-
-Верни JSON ответ с одним из двух вариантов:
-
-1. Если информации ДОСТАТОЧНО для определения содержания:
-{{"decision": "rename", "new_name": "Предлагаемое_имя_архива.расширение"}}
-
-2. Если информации НЕДОСТАТОЧНО:
-{{"decision": "need_more_data", "action": "extract_text", "target": "{main_doc}", "parameters": {{"type": "first_chars", "amount": 1000}}}}
-
-ВАЖНО: 
-- Предлагаемое имя должно отражать СОДЕРЖИМОЕ АРХИВА
-- Сохрани оригинальное расширение архива ({os.path.splitext(archive_name)[1]})
-- В поле "target" всегда указывай конкретное существующее имя файла из списка выше
-"""
-    return prompt
-
-def build_text_analysis_prompt(archive_path: str, archive_content: Dict[str, Any], target_file: str, extracted_text: str) -> str:
-    """
-    Строит промпт для анализа извлеченного текста
-    """
-    # Ограничиваем текст и очищаем опасные символы
-    preview_text = extracted_text[:2000] if len(extracted_text) > 2000 else extracted_text
-    preview_text = preview_text.replace('\n', ' ').replace('"', "'").replace('\\', '/')
-
-    archive_ext = os.path.splitext(archive_path)[1]
-
-    prompt = f"""
-Проанализируй текст из файла внутри архива и предложи подходящее имя для АРХИВА.
-
-Архив: {os.path.basename(archive_path)}
-Расширение архива: {archive_ext}
-Файл внутри архива: {target_file}
-Извлечено текста: {len(extracted_text)} символов
-
-Текст: {preview_text}
-
-Верни JSON ответ:
-{{"decision": "rename", "new_name": "Предлагаемое_имя_архива{archive_ext}"}}
-
-ВАЖНО: 
-- Предлагаемое имя должно отражать СОДЕРЖИМОЕ АРХИВА
-- Сохрани оригинальное расширение архива ({archive_ext})
-- Имя должно быть понятным и описывать содержание основного документа
-"""
-    return prompt
+﻿import os
+import json
+from typing import Dict, Any
+from file_tools import identify_main_document
+from manifest import build_manifest
+from tracing import traced
+from config import MANIFEST_BATCH_TOKEN_BUDGET
+
+@traced('prompt.initial')
+def build_initial_prompt(archive_name: str, archive_content: Dict[str, Any]) -> str:
+    """
+    Строит первоначальный промпт для LLM
+    """
+    # Автоматически определяем основной документ
+    main_doc = identify_main_document(archive_content['files'])
+
+    # Приоритет для FILE_ID.DIZ, readme* и nfo
+    metadata_files = archive_content.get('metadata_content', {})
+    priority_meta = list(metadata_files.keys())
+    if priority_meta:
+        main_doc_desc = f"{main_doc if main_doc else 'Не определен'} (метафайл для анализа: {', '.join(priority_meta)})"
+    else:
+        main_doc_desc = main_doc if main_doc else 'Не определен'
+
+    prompt = f"""
+Анализируй структуру архива и доступные метаданные. 
+
+Исходное имя архива: "{archive_name}"
+Расширение архива: "{os.path.splitext(archive_name)[1]}"
+Основной документ внутри: "{main_doc_desc}"
+
+Содержимое архива:
+{build_manifest(archive_content)}
+
+Верни JSON ответ с одним из двух вариантов:
+
+1. Если информации ДОСТАТОЧНО для определения содержания:
+{{"decision": "rename", "new_name": "Предлагаемое_имя_архива.расширение"}}
+
+2. Если информации НЕДОСТАТОЧНО:
+{{"decision": "need_more_data", "action": "extract_text", "target": "{main_doc}", "parameters": {{"type": "first_chars", "amount": 1000}}}}
+
+ВАЖНО: 
+- Предлагаемое имя должно отражать СОДЕРЖИМОЕ АРХИВА
+- Сохрани оригинальное расширение архива ({os.path.splitext(archive_name)[1]})
+- В поле "target" всегда указывай конкретное существующее имя файла из списка выше (путь внутри архива)
+"""
+    return prompt
+
+def _clean_preview(text: str, limit: int = 2000) -> str:
+    """Ограничивает текст и очищает опасные символы"""
+    preview_text = text[:limit] if len(text) > limit else text
+    return preview_text.replace('\n', ' ').replace('"', "'").replace('\\', '/')
+
+@traced('prompt.text')
+def build_text_analysis_prompt(archive_path: str, archive_content: Dict[str, Any], target_file: str, extracted_text: str) -> str:
+    """
+    Строит промпт для анализа извлеченного текста
+    """
+    preview_text = _clean_preview(extracted_text)
+
+    archive_ext = os.path.splitext(archive_path)[1]
+
+    prompt = f"""
+Проанализируй текст из файла внутри архива и предложи подходящее имя для АРХИВА.
+
+Архив: {os.path.basename(archive_path)}
+Расширение архива: {archive_ext}
+Файл внутри архива: {target_file}
+Извлечено текста: {len(extracted_text)} символов
+
+Текст: {preview_text}
+
+Верни JSON ответ:
+{{"decision": "rename", "new_name": "Предлагаемое_имя_архива{archive_ext}"}}
+
+ВАЖНО: 
+- Предлагаемое имя должно отражать СОДЕРЖИМОЕ АРХИВА
+- Сохрани оригинальное расширение архива ({archive_ext})
+- Имя должно быть понятным и описывать содержание основного документа
+"""
+    return prompt
+
+@traced('prompt.batch')
+def build_batch_prompt(entries: Dict[str, Dict[str, Any]]) -> str:
+    """
+    Строит один промпт для нескольких архивов.
+    entries - словарь {id: {'archive_name': ..., 'archive_content': ...}}
+    """
+    sections = []
+    for entry_id, entry in entries.items():
+        archive_name = entry['archive_name']
+        archive_content = entry['archive_content']
+        main_doc = identify_main_document(archive_content['files'])
+        sections.append(f"""
+### Архив id="{entry_id}"
+Исходное имя архива: "{archive_name}"
+Расширение архива: "{os.path.splitext(archive_name)[1]}"
+Основной документ внутри: "{main_doc if main_doc else 'Не определен'}"
+Содержимое архива:
+{build_manifest(archive_content, MANIFEST_BATCH_TOKEN_BUDGET)}
+""")
+
+    prompt = f"""
+Анализируй структуру каждого из {len(entries)} архивов ниже и доступные метаданные.
+{''.join(sections)}
+Верни JSON массив, ровно по одному объекту на каждый архив, с его "id" и одним из двух вариантов:
+
+1. Если информации ДОСТАТОЧНО для определения содержания:
+{{"id": "...", "decision": "rename", "new_name": "Предлагаемое_имя_архива.расширение"}}
+
+2. Если информации НЕДОСТАТОЧНО:
+{{"id": "...", "decision": "need_more_data", "action": "extract_text", "target": "имя_файла_из_этого_архива", "parameters": {{"type": "first_chars", "amount": 1000}}}}
+
+ВАЖНО: 
+- Предлагаемое имя должно отражать СОДЕРЖИМОЕ соответствующего АРХИВА
+- Сохрани оригинальное расширение каждого архива
+- В поле "target" указывай конкретное существующее имя файла из списка этого же архива
+"""
+    return prompt
+
+@traced('prompt.combined')
+def build_combined_prompt(archive_name: str, archive_content: Dict[str, Any], main_doc: str,
+                          metadata: Dict[str, Any], extracted_text: str) -> str:
+    """
+    Строит промпт, в который сразу входят метаданные и начало текста основного документа,
+    чтобы в большинстве случаев имя определялось за один запрос
+    """
+    archive_ext = os.path.splitext(archive_name)[1]
+    metadata_desc = json.dumps(metadata, ensure_ascii=False, default=str) if metadata else "нет"
+    preview_text = _clean_preview(extracted_text) if extracted_text else "не извлечен"
+
+    prompt = f"""
+Анализируй структуру архива, метаданные и текст основного документа.
+
+Исходное имя архива: "{archive_name}"
+Расширение архива: "{archive_ext}"
+Основной документ внутри: "{main_doc if main_doc else 'Не определен'}"
+
+Содержимое архива:
+{build_manifest(archive_content)}
+
+Метаданные основного документа: {metadata_desc}
+
+Начало текста основного документа ({len(extracted_text)} символов): {preview_text}
+
+Верни JSON ответ с одним из двух вариантов:
+
+1. Если информации ДОСТАТОЧНО для определения содержания (ожидается в большинстве случаев):
+{{"decision": "rename", "new_name": "Предлагаемое_имя_архива{archive_ext}"}}
+
+2. Если информации НЕДОСТАТОЧНО (например, текст не извлечен или относится к другому файлу):
+{{"decision": "need_more_data", "action": "extract_text", "target": "имя_файла_из_списка", "parameters": {{"type": "first_chars", "amount": 3000}}}}
+
+ВАЖНО: 
+- Предлагаемое имя должно отражать СОДЕРЖИМОЕ АРХИВА
+- Сохрани оригинальное расширение архива ({archive_ext})
+- В поле "target" всегда указывай конкретное существующее имя файла из списка выше
+"""
+    return prompt
@@ -0,0 +1,201 @@
+import os
+import json
+import atexit
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import multiprocessing.util
+from typing import Any, Dict, Optional
+from config import CACHE_ENABLED, CACHE_PATH, CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+# Хэши уже прочитанных файлов в текущем процессе: (путь, размер, mtime) -> хэш
+_hash_memo: Dict[tuple, str] = {}
+
+
+def file_hash(file_path: str) -> str:
+    """Хэш содержимого файла (BLAKE2b), читается блоками по 1 МБ"""
+    stat = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if memo_key in _hash_memo:
+        return _hash_memo[memo_key]
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+    _hash_memo[memo_key] = digest.hexdigest()
+    return _hash_memo[memo_key]
+
+
+def parameters_key(parameters: Dict[str, Any]) -> str:
+    """Каноническая строка параметров извлечения для ключа кэша"""
+    return json.dumps(parameters or {}, sort_keys=True, ensure_ascii=False)
+
+
+class ResultCache:
+    """
+    Кэш результатов на диске (SQLite), адресуемый хэшем содержимого.
+    Хранит извлеченный текст (по файлу и параметрам), метаданные обработчиков
+    и итоговые решения LLM по архивам. При превышении max_bytes удаляются
+    записи, к которым дольше всего не обращались (LRU).
+    Время обращения при чтении записывается пакетами (TOUCH_BATCH), а размер кэша
+    ведется нарастающим итогом и сверяется с базой раз в EVICT_CHECK_INTERVAL записей
+    (в базу пишут и другие процессы) или при превышении лимита
+    """
+
+    TOUCH_BATCH = 64
+    EVICT_CHECK_INTERVAL = 100
+
+    # Виды записей
+    TEXT = 'text'
+    METADATA = 'metadata'
+    DECISION = 'decision'
+    FILE_HASH = 'file_hash'
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._touched: Dict[tuple, float] = {}
+        self._total: Optional[int] = None
+        self._puts = 0
+        self._closed = False
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (kind, key)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self._conn.commit()
+
+    def get(self, kind: str, key: str) -> Optional[Any]:
+        """Возвращает значение из кэша или None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM entries WHERE kind = ? AND key = ?", (kind, key)
+            ).fetchone()
+            if row is None:
+                return None
+            self._touched[(kind, key)] = time.time()
+            if len(self._touched) >= self.TOUCH_BATCH:
+                self._flush_touched()
+                self._conn.commit()
+        return json.loads(row[0])
+
+    def _flush_touched(self) -> None:
+        """Записывает накопленное время обращений (вызывается под self._lock, без commit)"""
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE entries SET accessed = ? WHERE kind = ? AND key = ?",
+                [(accessed, kind, key) for (kind, key), accessed in self._touched.items()]
+            )
+            self._touched = {}
+
+    def put(self, kind: str, key: str, value: Any) -> None:
+        """Сохраняет значение (несериализуемые в JSON объекты сохраняются строками)"""
+        data = json.dumps(value, ensure_ascii=False, default=str)
+        size = len(data.encode('utf-8'))
+        with self._lock:
+            old = self._conn.execute(
+                "SELECT size FROM entries WHERE kind = ? AND key = ?", (kind, key)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (kind, key, value, size, accessed) VALUES (?, ?, ?, ?, ?)",
+                (kind, key, data, size, time.time())
+            )
+            self._flush_touched()
+            self._puts += 1
+            if self._total is not None:
+                self._total += size - (old[0] if old else 0)
+            if self._total is None or self._total > self.max_bytes or self._puts % self.EVICT_CHECK_INTERVAL == 0:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        """Сверяет размер кэша с базой и удаляет самые старые по обращению записи, пока он больше лимита"""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        self._total = total
+        if total <= self.max_bytes:
+            return
+
+        # Освобождаем с запасом, чтобы не чистить кэш на каждой записи
+        to_free = total - int(self.max_bytes * 0.9)
+        freed = 0
+        victims = []
+        for kind, key, size in self._conn.execute("SELECT kind, key, size FROM entries ORDER BY accessed"):
+            victims.append((kind, key))
+            freed += size
+            if freed >= to_free:
+                break
+        self._conn.executemany("DELETE FROM entries WHERE kind = ? AND key = ?", victims)
+        self._total = total - freed
+        logger.debug(f"Из кэша удалено записей: {len(victims)} ({freed} байт)")
+
+    def archive_hash(self, archive_path: str) -> str:
+        """
+        Хэш содержимого архива. Хэш запоминается в кэше по пути, размеру и mtime,
+        чтобы при повторных запусках не перечитывать многогигабайтные архивы
+        """
+        stat = os.stat(archive_path)
+        path_key = f"{os.path.abspath(archive_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        cached = self.get(self.FILE_HASH, path_key)
+        if cached:
+            return cached
+        content_hash = file_hash(archive_path)
+        self.put(self.FILE_HASH, path_key, content_hash)
+        return content_hash
+
+    def close(self) -> None:
+        """Сохраняет отложенные обновления времени доступа и закрывает базу"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._flush_touched()
+            self._conn.commit()
+            self._conn.close()
+
+
+_cache: Optional[ResultCache] = None
+_cache_pid = None
+_enabled = CACHE_ENABLED
+
+
+def set_cache_enabled(enabled: bool) -> None:
+    """Включает или отключает кэш для текущего процесса"""
+    global _enabled
+    _enabled = enabled
+
+
+def get_cache() -> Optional[ResultCache]:
+    """Возвращает кэш текущего процесса или None, если кэш отключен или недоступен"""
+    global _cache, _cache_pid, _enabled
+    if not _enabled:
+        return None
+    # Соединение SQLite нельзя переносить в дочерний процесс (fork)
+    if _cache is None or _cache_pid != os.getpid():
+        try:
+            _cache = ResultCache(CACHE_PATH, CACHE_MAX_BYTES)
+            _cache_pid = os.getpid()
+            atexit.register(_cache.close)
+            # Процессы пула завершаются без atexit, но вызывают финализаторы multiprocessing
+            multiprocessing.util.Finalize(_cache, _cache.close, exitpriority=10)
+        except Exception as e:
+            logger.warning(f"Кэш результатов недоступен ({CACHE_PATH}): {e}")
+            _enabled = False
+            return None
+    return _cache
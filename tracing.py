@@ -0,0 +1,238 @@
+import io
+import os
+import json
+import time
+import pstats
+import asyncio
+import cProfile
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Сколько функций выводить в отчете профилировщика
+PROFILE_TOP_FUNCTIONS = 25
+
+_tracing = False
+_profiling = False
+_events: List[Dict[str, Any]] = []
+_events_lock = threading.Lock()
+_profiles: List[dict] = []
+
+
+def configure_tracing(trace: bool = False, profile: bool = False) -> None:
+    """Включает сбор интервалов (trace) и профилирование задач (profile) в текущем процессе"""
+    global _tracing, _profiling
+    # Разбивка по этапам в отчете профилировщика строится по интервалам
+    _tracing = trace or profile
+    _profiling = profile
+
+
+def is_tracing() -> bool:
+    return _tracing
+
+
+def is_profiling() -> bool:
+    return _profiling
+
+
+class Span:
+    """Интервал выполнения этапа; счетчики (bytes, chars и т.п.) задаются через set"""
+
+    __slots__ = ('name', 'args')
+
+    def __init__(self, name: str, args: Dict[str, Any]):
+        self.name = name
+        self.args = args
+
+    def set(self, **values) -> None:
+        self.args.update(values)
+
+
+class _NullSpan:
+    """Заглушка, когда интервалы не собираются"""
+
+    def set(self, **values) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def _track_id() -> int:
+    """Дорожка интервала: поток, а для корутин - задача asyncio (их интервалы пересекаются)"""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return id(task) % 2 ** 31 if task is not None else threading.get_ident() % 2 ** 31
+
+
+@contextmanager
+def span(name: str, stats: Optional[Dict[str, float]] = None, **args):
+    """
+    Интервал выполнения этапа name. Длительность добавляется в stats[name] (если он передан),
+    а при включенной трассировке интервал с args сохраняется для --trace и --profile
+    """
+    if not _tracing and stats is None:
+        yield _NULL_SPAN
+        return
+
+    current = Span(name, args)
+    start = time.perf_counter_ns()
+    try:
+        yield current
+    finally:
+        duration = time.perf_counter_ns() - start
+        if stats is not None:
+            stats[name] = stats.get(name, 0.0) + duration / 1e9
+        if _tracing:
+            event = {
+                'name': name,
+                'cat': name.split('.')[0],
+                'ph': 'X',
+                'ts': start / 1000,
+                'dur': duration / 1000,
+                'pid': os.getpid(),
+                'tid': _track_id(),
+                'args': current.args,
+            }
+            with _events_lock:
+                _events.append(event)
+
+
+def stage_timer(stats, stage):
+    """Добавляет время выполнения этапа в словарь stats (если он передан)"""
+    return span(stage, stats)
+
+
+def traced(name: str):
+    """Декоратор: вызов функции - интервал name; для строкового результата записывается его длина"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name) as current:
+                result = func(*args, **kwargs)
+                if isinstance(result, str):
+                    current.set(chars=len(result))
+                return result
+        return wrapper
+    return decorator
+
+
+class _ProfileData:
+    """Статистика cProfile, переданная из другого процесса (для pstats.Stats.add)"""
+
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self) -> None:
+        pass
+
+
+@contextmanager
+def task_profile():
+    """Профилирует обработку одной задачи (архива), если профилирование включено"""
+    if not _profiling:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.create_stats()
+        _profiles.append(profiler.stats)
+
+
+def drain() -> Dict[str, Any]:
+    """Забирает накопленные интервалы и профили (для передачи из процесса-обработчика)"""
+    global _events, _profiles
+    with _events_lock:
+        data = {'events': _events, 'profiles': _profiles}
+        _events, _profiles = [], []
+    return data
+
+
+def merge(data: Optional[Dict[str, Any]]) -> None:
+    """Добавляет интервалы и профили, полученные из другого процесса"""
+    if not data:
+        return
+    with _events_lock:
+        _events.extend(data.get('events', ()))
+        _profiles.extend(data.get('profiles', ()))
+
+
+def write_chrome_trace(path: str) -> None:
+    """Сохраняет интервалы в формате Chrome Trace (chrome://tracing, Perfetto)"""
+    with _events_lock:
+        events = list(_events)
+    main_pid = os.getpid()
+    names = [{
+        'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+        'args': {'name': 'main' if pid == main_pid else f'worker {pid}'}
+    } for pid in sorted({event['pid'] for event in events})]
+
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': names + events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False, default=str)
+    logger.info(f"Трасса сохранена: {path} (интервалов: {len(events)})")
+
+
+def summarize_spans() -> Dict[str, Dict[str, float]]:
+    """Сводка по именам интервалов: число, суммарное и максимальное время, байты и символы"""
+    with _events_lock:
+        events = list(_events)
+    summary = {}
+    for event in events:
+        item = summary.setdefault(event['name'], {'count': 0, 'total': 0.0, 'max': 0.0, 'bytes': 0, 'chars': 0})
+        seconds = event['dur'] / 1e6
+        item['count'] += 1
+        item['total'] += seconds
+        item['max'] = max(item['max'], seconds)
+        for key in ('bytes', 'chars'):
+            value = event['args'].get(key)
+            if isinstance(value, (int, float)):
+                item[key] += value
+    return summary
+
+
+def format_breakdown() -> str:
+    """Таблица времени по этапам (интервалы вложены, поэтому суммы этапов не складываются)"""
+    summary = summarize_spans()
+    if not summary:
+        return "Интервалы не записаны"
+    lines = [f"{'этап':<24} {'кол-во':>7} {'всего, с':>10} {'среднее, мс':>12} {'макс, мс':>10} {'байт':>12} {'символов':>10}"]
+    for name, item in sorted(summary.items(), key=lambda kv: -kv[1]['total']):
+        lines.append(
+            f"{name:<24} {item['count']:>7} {item['total']:>10.3f} "
+            f"{item['total'] / item['count'] * 1000:>12.1f} {item['max'] * 1000:>10.1f} "
+            f"{item['bytes']:>12} {item['chars']:>10}"
+        )
+    return "\n".join(lines)
+
+
+def profile_report(output_path: Optional[str] = None) -> str:
+    """
+    Отчет профилировщика по всем задачам (включая процессы-обработчики):
+    разбивка по этапам и функции с наибольшим суммарным временем.
+    output_path - файл для сохранения статистики в формате pstats (snakeviz и т.п.)
+    """
+    if not _profiles:
+        return format_breakdown()
+
+    # pstats изменяет переданные словари, поэтому складываются копии
+    stats = pstats.Stats(_ProfileData(dict(_profiles[0])))
+    for data in _profiles[1:]:
+        stats.add(_ProfileData(dict(data)))
+    if output_path:
+        stats.dump_stats(output_path)
+        logger.info(f"Статистика профилировщика сохранена: {output_path}")
+
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+    return f"Время по этапам:\n{format_breakdown()}\n\nФункции по суммарному времени:\n{stream.getvalue()}"